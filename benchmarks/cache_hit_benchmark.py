@@ -0,0 +1,60 @@
+# CPU на один cache hit GET /users/{id}: старый путь (json.loads -> dict -> валидация UserOut -> JSONResponse)
+# против нового (unpack_entry -> Response с готовыми байтами).
+# python -m benchmarks.cache_hit_benchmark --iterations 20000 --projects 10 --tasks 10
+import argparse
+import asyncio
+import json
+import time
+from datetime import datetime
+from types import SimpleNamespace
+from fastapi.responses import JSONResponse,Response
+from fastapi.routing import serialize_response
+from fastapi.utils import create_model_field
+from db1.Cache.cache import pack_entry,unpack_entry
+from db1.PydanticModels.Pydantic import UserOut,ProjectOut,TaskOut
+from db1.Security.security import UserPolicy
+
+
+def build_user(projects:int,tasks:int):
+    now=datetime.utcnow()
+    task_list=[TaskOut(id=i,title=f'task {i}',status='pending',project_id=1,assignee_id=1,created_at=now) for i in range(tasks)]
+    return UserOut(
+        id=1,username='user',email='user@example.com',role='user',created_at=now,
+        projects=[ProjectOut(id=i,title=f'project {i}',owner_id=1,created_at=now,tasks=task_list) for i in range(projects)],
+        tasks=task_list,
+    )
+
+async def old_path(cached:str,field,policy):
+    data=json.loads(cached)
+    policy.can_read(SimpleNamespace(**data))
+    content=await serialize_response(field=field,response_content=data)
+    return JSONResponse(content).body
+
+async def new_path(entry:str,field,policy):
+    meta,payload=unpack_entry(entry)
+    policy.can_read(SimpleNamespace(**meta))
+    return Response(content=payload,media_type='application/json').body
+
+async def measure(func,value,field,policy,iterations:int):
+    start=time.process_time()
+    for _ in range(iterations):
+        await func(value,field,policy)
+    return (time.process_time()-start)/iterations*1_000_000
+
+async def main(args):
+    user=build_user(args.projects,args.tasks)
+    payload=user.model_dump_json()
+    entry=pack_entry({'id':user.id},payload)
+    field=create_model_field(name='Response_get_user',type_=UserOut,mode='serialization')
+    policy=UserPolicy(SimpleNamespace(id=1,role='user'))
+    assert json.loads(await old_path(payload,field,policy))==json.loads(await new_path(entry,field,policy))
+    print(f"payload={len(payload)} bytes iterations={args.iterations}")
+    for name,func,value in (('reparse',old_path,payload),('raw',new_path,entry)):
+        print(f"{name:8} {await measure(func,value,field,policy,args.iterations):10.1f} us CPU per hit")
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser()
+    parser.add_argument('--iterations',type=int,default=20000)
+    parser.add_argument('--projects',type=int,default=10)
+    parser.add_argument('--tasks',type=int,default=10)
+    asyncio.run(main(parser.parse_args()))
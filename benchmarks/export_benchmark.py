@@ -0,0 +1,42 @@
+# Пропускная способность и пиковая память потокового экспорта /users/export на большой таблице users.
+# python -m benchmarks.export_benchmark --rows 3000000 --seed   (только на отдельной базе — seed пишет в users)
+import argparse
+import asyncio
+import resource
+import time
+from sqlalchemy import text
+from benchmarks.search_benchmark import seed
+from db1.Database.database import engine
+from db1.Export.export import export_query,stream_rows
+from db1.Filters.fields import USER_FIELDS
+from db1.Filters.filters import UserFilter
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+
+async def main(args):
+    if args.seed:
+        async with engine.connect() as conn:
+            await seed(conn,args.rows)
+    async with engine.connect() as conn:
+        total=(await conn.execute(text("SELECT count(*) FROM users"))).scalar()
+    selection=USER_FIELDS.cheap
+    query=export_query(selection,UserFilter())
+    baseline=peak_rss_mb()
+    for fmt in ('ndjson','csv'):
+        rows=size=0
+        start=time.perf_counter()
+        async for chunk in stream_rows(query,selection.columns,fmt,'users'):
+            size+=len(chunk)
+            rows+=chunk.count(b'\n')
+        elapsed=time.perf_counter()-start
+        print(f"{fmt:6} users={total} rows={rows} {rows/elapsed:10.0f} rows/s {size/elapsed/2**20:7.1f} MiB/s "
+              f"peak_rss={peak_rss_mb():7.1f} MiB (start {baseline:.1f} MiB)")
+    await engine.dispose()
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser()
+    parser.add_argument('--rows',type=int,default=3_000_000)
+    parser.add_argument('--seed',action='store_true')
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,66 @@
+# Пропускная способность проверки лимита: fastapi_limiter (Lua-скрипт в Redis на каждый вызов)
+# против HybridRateLimiter в обычном (локальные счётчики + пакетная синхронизация) и строгом режимах.
+# python -m benchmarks.ratelimit_benchmark --requests 20000 --concurrency 50 --clients 100   (нужен живой Redis)
+import argparse
+import asyncio
+import time
+import redis.asyncio as redis
+from fastapi import Depends,FastAPI
+from fastapi_limiter import FastAPILimiter
+from fastapi_limiter.depends import RateLimiter
+from starlette.requests import Request
+from starlette.responses import Response
+from config import settings
+from db1.RateLimit.ratelimit import RateLimit,rate_limiter
+
+LIMIT=10**9
+
+
+def build_app(dependency):
+    app=FastAPI()
+    @app.get('/items',dependencies=[Depends(dependency)])
+    async def items():
+        return []
+    return app,app.routes[-1]
+
+def make_request(app,route,client:int):
+    return Request({'type':'http','method':'GET','path':'/items','headers':[],'query_string':b'',
+                    'client':(f'10.0.{client//256}.{client%256}',1234),'app':app,'route':route})
+
+async def run(name,call,args):
+    counter=iter(range(args.requests))
+    async def worker():
+        for i in counter:
+            await call(i%args.clients)
+    start=time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    elapsed=time.perf_counter()-start
+    print(f"{name:22} {args.requests/elapsed:10.0f} checks/s {elapsed/args.requests*1e6:8.1f} us/check")
+
+async def main(args):
+    redis_conn=redis.from_url(settings.REDIS_URL,decode_responses=True)
+    await redis_conn.flushdb()
+    await FastAPILimiter.init(redis_conn)
+    limiter=RateLimiter(times=LIMIT,hours=1)
+    app,route=build_app(limiter)
+    async def fastapi_limiter_call(client):
+        await limiter(make_request(app,route,client),Response())
+    await run('fastapi_limiter',fastapi_limiter_call,args)
+
+    rate_limiter.bind(redis_conn)
+    sync_task=asyncio.create_task(rate_limiter.run())
+    for name,strict in (('hybrid',False),('hybrid strict',True)):
+        dependency=RateLimit(times=LIMIT,seconds=3600,strict=strict,name=name)
+        app,route=build_app(dependency)
+        async def hybrid_call(client,dependency=dependency,app=app,route=route):
+            await dependency(make_request(app,route,client))
+        await run(name,hybrid_call,args)
+    sync_task.cancel()
+    await redis_conn.aclose()
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser()
+    parser.add_argument('--requests',type=int,default=20000)
+    parser.add_argument('--concurrency',type=int,default=50)
+    parser.add_argument('--clients',type=int,default=100)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,84 @@
+# p50/p99 ротации refresh-токена: исходная цепочка main.refresh (select user, поиск токена перебором argon2-хешей
+# в validate и delete, DELETE+commit, argon2-хеш нового токена и INSERT+commit+refresh) против rotate_refresh_token
+# (HMAC-digest, одна команда с CTE и один commit).
+# python -m benchmarks.refresh_benchmark --iterations 200   (только на отдельной базе — создаёт пользователя)
+import argparse
+import asyncio
+import statistics
+import time
+from sqlalchemy import delete,select
+from benchmarks.search_benchmark import percentile
+from db1.Database.database import async_factory,engine
+from db1.models.Base1 import RefreshTokenDB,User
+from db1.Security.security import Utils
+from db1.Tokens.tokens import create_refresh_token,refresh_token_expiry,rotate_refresh_token,save_refresh_token
+
+
+class NoRedis:
+    async def set(self,*args,**kwargs):
+        pass
+    async def eval(self,*args):
+        return []
+
+async def ensure_user(db):
+    user=(await db.execute(select(User).where(User.username == 'refresh_bench'))).scalars().first()
+    if user is None:
+        user=User(username='refresh_bench',email='refresh_bench@example.com',hashed_password='x',role='user')
+        db.add(user)
+        await db.commit()
+    await db.execute(delete(RefreshTokenDB).where(RefreshTokenDB.user_id == user.id))
+    await db.commit()
+    return user.id,user.role
+
+async def old_save(db,user_id:int,token:str):
+    db_token=RefreshTokenDB(user_id=user_id,token=Utils.password_hash(token),expires_at=refresh_token_expiry())
+    db.add(db_token)
+    await db.commit()
+    await db.refresh(db_token)
+
+async def old_rotation(db,user_id:int,token:str):
+    user=(await db.execute(select(User).where(User.id == user_id))).scalars().first()
+    # validate_refresh_token: первая строка пользователя и argon2-проверка
+    stored=(await db.execute(select(RefreshTokenDB).where(RefreshTokenDB.user_id == user.id))).scalars().first()
+    Utils.password_verify(token,stored.token)
+    # delete_refresh_token: все строки пользователя, argon2-проверка каждой до совпадения
+    for token1 in (await db.execute(select(RefreshTokenDB).where(RefreshTokenDB.user_id == user.id))).scalars().all():
+        if Utils.password_verify(token,token1.token):
+            await db.delete(token1)
+            await db.commit()
+            break
+    new_token=create_refresh_token(user.id,user.role)
+    await old_save(db,user.id,new_token)
+    return new_token
+
+async def new_rotation(db,user_id:int,token:str):
+    new_token=create_refresh_token(user_id,'user')
+    await rotate_refresh_token(db,NoRedis(),user_id,token,new_token)
+    return new_token
+
+async def new_save(db,user_id:int,token:str):
+    await save_refresh_token(db,NoRedis(),user_id,token)
+
+async def measure(save,rotation,user_id:int,role:str,iterations:int):
+    timings=[]
+    async with async_factory() as db:
+        token=create_refresh_token(user_id,role)
+        await save(db,user_id,token)
+        for _ in range(iterations):
+            start=time.perf_counter()
+            token=await rotation(db,user_id,token)
+            timings.append((time.perf_counter()-start)*1000)
+    return timings
+
+async def main(args):
+    for name,save,rotation in (('before',old_save,old_rotation),('after',new_save,new_rotation)):
+        async with async_factory() as db:
+            user_id,role=await ensure_user(db)
+        timings=await measure(save,rotation,user_id,role,args.iterations)
+        print(f"{name:7} p50={statistics.median(timings):7.2f}ms p99={percentile(timings,0.99):7.2f}ms max={max(timings):7.2f}ms")
+    await engine.dispose()
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser()
+    parser.add_argument('--iterations',type=int,default=200)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,71 @@
+# Задержка поиска UserFilter(search=...) на большой таблице users: trigram GIN против последовательного скана.
+# python -m benchmarks.search_benchmark --rows 1000000 --seed   (только на отдельной базе — seed пишет в users)
+import argparse
+import asyncio
+import random
+import statistics
+import time
+from sqlalchemy import select,text
+from sqlalchemy.ext.asyncio import create_async_engine
+from config import settings
+from db1.Filters.filters import UserFilter
+from db1.models.Base1 import User
+
+SEED_SQL="""
+INSERT INTO users (username,email,hashed_password,role,created_at)
+SELECT 'user_'||substr(md5(g::text),1,10)||'_'||g,'mail_'||substr(md5(g::text),11,10)||'_'||g||'@example.com','x','user',now()
+FROM generate_series(:start,:stop) AS g
+ON CONFLICT DO NOTHING
+"""
+
+def percentile(values,p):
+    values=sorted(values)
+    return values[min(len(values)-1,int(len(values)*p))]
+
+async def seed(conn,rows:int):
+    existing=(await conn.execute(text("SELECT count(*) FROM users"))).scalar()
+    for start in range(existing+1,rows+1,100_000):
+        await conn.execute(text(SEED_SQL),{'start':start,'stop':min(rows,start+99_999)})
+        await conn.commit()
+    await conn.execute(text("ANALYZE users"))
+    await conn.commit()
+
+async def run_mode(conn,mode:str,terms:list,search_mode:str):
+    timings=[]
+    for term in terms:
+        if search_mode=='prefix':
+            term='user_'+term
+        user_filter=UserFilter(search=term,search_mode=search_mode)
+        query=user_filter.sort(user_filter.filter(select(User.id,User.username))).limit(50)
+        async with conn.begin():
+            if mode=='seqscan':
+                await conn.execute(text("SET LOCAL enable_bitmapscan=off"))
+                await conn.execute(text("SET LOCAL enable_indexscan=off"))
+            start=time.perf_counter()
+            (await conn.execute(query)).all()
+            timings.append((time.perf_counter()-start)*1000)
+    return timings
+
+async def main(args):
+    engine=create_async_engine(settings.DATABASE_URL)
+    async with engine.connect() as conn:
+        if args.seed:
+            await seed(conn,args.rows)
+        await conn.commit()
+        total=(await conn.execute(text("SELECT count(*) FROM users"))).scalar()
+        await conn.commit()
+        terms=[format(random.getrandbits(16),'x')[:args.term_length] for _ in range(args.queries)]
+        print(f"users={total} queries={args.queries} term_length={args.term_length}")
+        for search_mode in ('contains','prefix'):
+            for mode in ('seqscan','trigram'):
+                timings=await run_mode(conn,mode,terms,search_mode)
+                print(f"{search_mode:9} {mode:8} p50={statistics.median(timings):8.2f}ms p95={percentile(timings,0.95):8.2f}ms max={max(timings):8.2f}ms")
+    await engine.dispose()
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser()
+    parser.add_argument('--rows',type=int,default=1_000_000)
+    parser.add_argument('--seed',action='store_true')
+    parser.add_argument('--queries',type=int,default=50)
+    parser.add_argument('--term-length',type=int,default=4)
+    asyncio.run(main(parser.parse_args()))
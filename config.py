@@ -1,13 +1,75 @@
 from pydantic_settings import BaseSettings,SettingsConfigDict
+from typing import Optional,Literal,Dict,List
 
 class Settings(BaseSettings):
     DATABASE_URL:str
+    DATABASE_READ_URLS:str=''
+    READ_REPLICA_STRATEGY:Literal['round_robin','least_loaded']='round_robin'
+    READ_REPLICA_MAX_LAG:float=5.0
+    READ_REPLICA_CHECK_INTERVAL:float=5.0
+    DB_ECHO:bool=False
+    DB_POOL_SIZE:int=10
+    DB_MAX_OVERFLOW:int=20
+    DB_POOL_TIMEOUT:float=30.0
+    DB_POOL_RECYCLE:int=1800
+    DB_POOL_PRE_PING:bool=True
+    DB_STATEMENT_CACHE_SIZE:int=100
+    DB_STATEMENT_TIMEOUT_MS:int=5000
+    DB_RETRY_ATTEMPTS:int=3
+    DB_RETRY_BASE_DELAY:float=0.05
+    DB_RETRY_MAX_DELAY:float=1.0
     REDIS_URL:str
     SECRET_KEY:str
     ALGORITHM:str
     ACCESS_TOKEN_EXPIRE_MINUTES:int=30
     REFRESH_TOKEN_EXPIRE_DAYS:int=30
-    REDIS_TIME:int=60
+    REFRESH_TOKEN_HMAC_KEY:Optional[str]=None
+    REFRESH_TOKEN_LEGACY_FALLBACK:bool=True
+    TOKEN_SWEEP_INTERVAL:float=300.0
+    TOKEN_SWEEP_BATCH:int=1000
+    TOKEN_SWEEP_MAX_BATCHES:int=100
+    TOKEN_SWEEP_PAUSE:float=0.05
+    TASK_STATS_RECONCILE_INTERVAL:float=3600.0
+    REDIS_TIME:int=3600
+    REDIS_STALE_TIME:int=30
+    CACHE_TTL_JITTER:float=0.1
+    CACHE_LOCK_MS:int=2000
+    CACHE_TOMBSTONE_MS:int=5000
+    HASH_POOL_SIZE:int=4
+    HASH_QUEUE_SIZE:int=64
+    TRUST_TOKEN_CLAIMS:bool=False
+    EXPORT_BATCH_SIZE:int=1000
+    BLOOM_CAPACITY:int=1_000_000
+    BLOOM_ERROR_RATE:float=0.01
+    BLOOM_REBUILD_LEASE:int=600
+    BLOOM_READY_POLL_SECONDS:float=1.0
+    SQL_DEBUG_HEADER:bool=False
+    SQL_REPEAT_THRESHOLD:int=3
+    ADMISSION_CONCURRENCY:Dict[str,int]={'auth':8,'read':64,'write':32,'export':2}
+    ADMISSION_QUEUE:Dict[str,int]={'auth':32,'read':256,'write':128,'export':2}
+    ADMISSION_QUEUE_TIMEOUT:float=2.0
+    ADMISSION_RETRY_AFTER:float=1.0
+    ADMISSION_EXEMPT:List[str]=['/metrics']
+    REQUEST_TIMEOUTS:Dict[str,float]={'auth':10.0,'read':5.0,'write':10.0,'export':600.0}
+    RATE_LIMIT_DEFAULT_TIMES:int=600
+    RATE_LIMIT_DEFAULT_SECONDS:int=60
+    RATE_LIMIT_SYNC_MS:int=10
+    RATE_LIMIT_ERROR:float=0.05
+    RATE_LIMIT_EXEMPT:List[str]=['/metrics']
+    # адреса или подсети прокси, чьему X-Forwarded-For можно верить; пусто — ключ лимита по адресу соединения
+    TRUSTED_PROXIES:List[str]=[]
+    SENTRY_DSN:Optional[str]=None
+    SENTRY_TRACE_RATE:float=0.05
+    SENTRY_HEAD_TRACE_RATE:float=1.0
+    SENTRY_ROUTE_TRACE_RATES:Dict[str,float]={'/metrics':0.0}
+    SENTRY_SLOW_REQUEST_SECONDS:float=1.0
+    SENTRY_TRACE_BUDGET_PER_SECOND:float=5.0
+    SENTRY_PROFILES_SAMPLE_RATE:float=0.01
+    PROFILE_DIR:str='profiles'
+    PROFILE_INTERVAL:float=0.005
+    L1_CACHE_TTL:float=5.0
+    L1_CACHE_MAX_ITEMS:int=10000
+    L1_CACHE_MAX_BYTES:int=32*1024*1024
 
     model_config = SettingsConfigDict(env_file='.env',env_file_encoding='utf-8',extra='ignore')
 
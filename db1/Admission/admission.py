@@ -0,0 +1,93 @@
+import asyncio
+import math
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from fastapi.responses import JSONResponse
+from config import settings
+from db1.Metrics.metrics import REGISTRY
+
+ADMISSION_QUEUE_TIME=REGISTRY.histogram('admission_queue_seconds','Time a request waited for a concurrency slot',('route_class',))
+ADMISSION_REJECTED=REGISTRY.counter('admission_rejected_total','Requests shed before reaching the handler',('route_class','reason'))
+
+# монотонный момент, к которому запрос должен закончиться; сессии БД берут из него statement_timeout
+request_deadline:ContextVar=ContextVar('request_deadline',default=None)
+
+AUTH_ROUTES={'/users/login','/users/register','/users/refresh'}
+
+
+def remaining_time():
+    deadline=request_deadline.get()
+    return None if deadline is None else deadline-time.monotonic()
+
+def route_class(method:str,path:str):
+    # классы маршрутов со своим бюджетом: argon2-тяжёлые auth не должны выедать слоты дешёвых чтений
+    if path in AUTH_ROUTES:
+        return 'auth'
+    if path.endswith('/export'):
+        return 'export'
+    return 'read' if method in ('GET','HEAD') else 'write'
+
+class Overloaded(Exception):
+    def __init__(self,reason:str):
+        self.reason=reason
+
+class AdmissionLimiter:
+    def __init__(self,name:str,concurrency:int,max_queue:int):
+        self.name=name
+        self.concurrency=concurrency
+        self.max_queue=max_queue
+        self.semaphore=asyncio.Semaphore(concurrency)
+        self.waiting=0
+        self.active=0
+    @asynccontextmanager
+    async def admit(self,timeout:float):
+        if not self.semaphore.locked():
+            # свободный слот берётся сразу, без wait_for и лишней задачи на горячем пути
+            await self.semaphore.acquire()
+            ADMISSION_QUEUE_TIME.observe(0.0,self.name)
+        elif self.waiting>=self.max_queue:
+            raise Overloaded('queue_full')
+        else:
+            start=time.perf_counter()
+            self.waiting+=1
+            try:
+                await asyncio.wait_for(self.semaphore.acquire(),timeout)
+            except asyncio.TimeoutError:
+                raise Overloaded('queue_timeout')
+            finally:
+                self.waiting-=1
+                ADMISSION_QUEUE_TIME.observe(time.perf_counter()-start,self.name)
+        self.active+=1
+        try:
+            yield
+        finally:
+            self.active-=1
+            self.semaphore.release()
+
+limiters={name:AdmissionLimiter(name,concurrency,settings.ADMISSION_QUEUE[name]) for name,concurrency in settings.ADMISSION_CONCURRENCY.items()}
+REGISTRY.gauge('admission_in_flight','Requests holding a concurrency slot',('route_class',),
+               function=lambda:[((name,),limiter.active) for name,limiter in limiters.items()])
+REGISTRY.gauge('admission_queue_depth','Requests waiting for a concurrency slot',('route_class',),
+               function=lambda:[((name,),limiter.waiting) for name,limiter in limiters.items()])
+
+
+class AdmissionMiddleware:
+    # чистый ASGI, а не BaseHTTPMiddleware: слот держится, пока не отправлено всё тело, в том числе у потоковых ответов
+    def __init__(self,app):
+        self.app=app
+    async def __call__(self,scope,receive,send):
+        if scope['type']!='http' or scope['path'] in settings.ADMISSION_EXEMPT:
+            return await self.app(scope,receive,send)
+        name=route_class(scope['method'],scope['path'])
+        limiter=limiters[name]
+        timeout=settings.REQUEST_TIMEOUTS[name]
+        request_deadline.set(time.monotonic()+timeout)
+        try:
+            async with limiter.admit(min(settings.ADMISSION_QUEUE_TIMEOUT,timeout)):
+                return await self.app(scope,receive,send)
+        except Overloaded as e:
+            ADMISSION_REJECTED.inc(name,e.reason)
+            response=JSONResponse({'detail':'Server is overloaded, retry later'},status_code=503,
+                                  headers={'Retry-After':str(math.ceil(settings.ADMISSION_RETRY_AFTER))})
+            await response(scope,receive,send)
@@ -0,0 +1,128 @@
+import asyncio
+import hashlib
+import logging
+import math
+import uuid
+from datetime import datetime,timedelta
+from sqlalchemy import select,or_
+from config import settings
+from db1.Database.database import async_factory
+from db1.Maintenance.sweeper import LeaderLease
+from db1.Metrics.metrics import REGISTRY
+from db1.models.Base1 import User
+
+logger=logging.getLogger(__name__)
+
+# запас на транзакции, начатые до снимка и закоммиченные после него, и на расхождение часов серверов
+REBUILD_OVERLAP=timedelta(minutes=1)
+ADD_BATCH=256
+
+# биты ставятся только в собранную карту: BITFIELD SET по отсутствующему ключу создал бы частичный фильтр
+ADD_SCRIPT="""
+if redis.call('exists',KEYS[1])==0 then
+    return 0
+end
+redis.call('bitfield',KEYS[1],unpack(ARGV))
+return 1
+"""
+
+BLOOM_CHECKS=REGISTRY.counter('bloom_checks_total','Availability checks answered by the Bloom filter or by Postgres',('field','answer'))
+
+
+def bloom_size(capacity:int,error_rate:float):
+    bits=math.ceil(-capacity*math.log(error_rate)/math.log(2)**2)
+    return bits,max(1,round(bits/capacity*math.log(2)))
+
+class BloomFilter:
+    # битовая карта в обычном ключе Redis (модуль RedisBloom не нужен): k битов на значение по двойному хешированию,
+    # чтение и запись — одна команда BITFIELD. Ложноположительные ответы перепроверяются в БД, ложноотрицательных нет,
+    # пока фильтр собран; удалить значение нельзя, поэтому освобождённые имена остаются «возможно заняты» до пересборки.
+    def __init__(self,redis_conn,name:str,capacity:int=None,error_rate:float=None):
+        self.redis=redis_conn
+        self.key=f'bloom:{name}'
+        self.ready_key=f'bloom:{name}:ready'
+        self.bits,self.hashes=bloom_size(capacity or settings.BLOOM_CAPACITY,error_rate or settings.BLOOM_ERROR_RATE)
+    def offsets(self,value:str):
+        digest=hashlib.blake2b(value.encode(),digest_size=16).digest()
+        first,second=int.from_bytes(digest[:8],'big'),int.from_bytes(digest[8:],'big')|1
+        return [(first+i*second)%self.bits for i in range(self.hashes)]
+    async def is_ready(self):
+        return await self.redis.exists(self.key,self.ready_key)==2
+    async def might_contain(self,value:str):
+        # None — фильтр не собран до конца (нет метки ready) или карта пропала из Redis; ответить может только БД
+        args=[]
+        for offset in self.offsets(value):
+            args+=['GET','u1',offset]
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.exists(self.key,self.ready_key)
+            pipe.execute_command('BITFIELD',self.key,*args)
+            exists,bits=await pipe.execute()
+        if exists<2:
+            return None
+        return all(bits)
+    async def add(self,*values:str):
+        # пачками: unpack(ARGV) в Lua ограничен размером стека
+        for start in range(0,len(values),ADD_BATCH):
+            args=[]
+            for value in values[start:start+ADD_BATCH]:
+                for offset in self.offsets(value):
+                    args+=['SET','u1',offset,1]
+            if args:
+                await self.redis.eval(ADD_SCRIPT,1,self.key,*args)
+    async def rebuild(self,column):
+        # собираем карту в памяти из потока строк и подменяем ключ атомарно через RENAME
+        bitmap=bytearray((self.bits+7)//8)
+        count=0
+        since=datetime.utcnow()-REBUILD_OVERLAP
+        async with async_factory() as db:
+            result=await db.stream(select(column).execution_options(yield_per=settings.EXPORT_BATCH_SIZE))
+            async for values in result.scalars().partitions():
+                for value in values:
+                    for offset in self.offsets(value):
+                        bitmap[offset>>3]|=0x80>>(offset&7)
+                count+=len(values)
+        staging=f'{self.key}:build:{uuid.uuid4().hex}'
+        await self.redis.set(staging,bytes(bitmap))
+        await self.redis.rename(staging,self.key)
+        # add() во время сборки писал в старую карту (или никуда) — дописываем строки, появившиеся или изменённые после снимка
+        async with async_factory() as db:
+            recent=(await db.execute(select(column).where(or_(User.created_at >= since,User.updated_at >= since)))).scalars().all()
+        await self.add(*recent)
+        await self.redis.set(self.ready_key,1)
+        logger.info("Rebuilt %s from %d rows (%d bits, %d hashes)",self.key,count,self.bits,self.hashes)
+        return count
+
+def user_filters(redis_conn):
+    return {'username':BloomFilter(redis_conn,'username'),'email':BloomFilter(redis_conn,'email')}
+
+async def add_user_values(redis_conn,values:dict):
+    # вызывается после коммита: запись уже в БД, и сбой Redis не должен превращать её в 500 —
+    # пропущенное значение фильтр лишь считает свободным, а вставку всё равно сторожит уникальный индекс
+    filters=user_filters(redis_conn)
+    try:
+        for field,value in values.items():
+            if value is not None:
+                await filters[field].add(value)
+    except Exception:
+        logger.exception("Failed to add %s to user Bloom filters",sorted(values))
+
+async def rebuild_user_filters(redis_conn):
+    # фильтры общие в Redis: собирает один держатель аренды, остальные воркеры ждут метки ready и подхватывают
+    # сборку, только если аренда истекла. После сборки аренда не снимается — деплой, перезапускающий воркеры
+    # по очереди, не стримит таблицу users на каждом из них
+    lease=LeaderLease(redis_conn,'bloom-rebuild',settings.BLOOM_REBUILD_LEASE*1000)
+    filters=user_filters(redis_conn)
+    try:
+        while True:
+            if await lease.acquire():
+                for field,bloom in filters.items():
+                    await bloom.rebuild(getattr(User,field))
+                return
+            if all([await bloom.is_ready() for bloom in filters.values()]):
+                return
+            await asyncio.sleep(settings.BLOOM_READY_POLL_SECONDS)
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        # без фильтра доступность просто проверяется в БД
+        logger.exception("Failed to rebuild user Bloom filters")
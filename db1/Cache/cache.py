@@ -0,0 +1,372 @@
+import asyncio
+import json
+import logging
+import random
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Optional
+from fastapi import HTTPException,Request
+from config import settings
+from db1.Database.database import async_factory
+from db1.Metrics.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_CHANNEL='cache:invalidate'
+
+CACHE_HITS=REGISTRY.counter('cache_hits_total','Entity cache hits',('entity','tier'))
+CACHE_MISSES=REGISTRY.counter('cache_misses_total','Entity cache misses',('entity','tier'))
+CACHE_EVICTIONS=REGISTRY.counter('cache_evictions_total','Entries evicted from the in-process cache',('entity',))
+CACHE_LOADS=REGISTRY.counter('cache_loads_total','Cache misses loaded from the database',('entity','mode'))
+CACHE_COALESCED=REGISTRY.counter('cache_coalesced_total','Cache misses served by another in-flight load',('entity','scope'))
+
+# вложенные коллекции ответа -> сущность, чей кэш-ключ становится тегом записи
+NESTED_ENTITIES={'projects':'project','tasks':'task'}
+
+# запись вместе с тегами: ключ попадает в tags:{зависимость} для каждой вложенной сущности.
+# Надгробие purged:{key} не даёт загрузке, начатой до инвалидации, положить в кэш старые данные
+STORE_SCRIPT="""
+if redis.call('exists',KEYS[2])==1 then
+    return 0
+end
+redis.call('set',KEYS[1],ARGV[1],'PX',ARGV[2])
+for i=3,#KEYS do
+    redis.call('sadd',KEYS[i],KEYS[1])
+    redis.call('pexpire',KEYS[i],ARGV[3])
+end
+return 1
+"""
+
+# удаляет сами ключи и всех, кто от них зависит, ставит надгробия и рассылает список одним сообщением
+PURGE_SCRIPT="""
+local purged={}
+for _,key in ipairs(KEYS) do
+    purged[#purged+1]=key
+    local tag='tags:'..key
+    for _,dependent in ipairs(redis.call('smembers',tag)) do
+        purged[#purged+1]=dependent
+    end
+    redis.call('del',tag)
+end
+for _,key in ipairs(purged) do
+    redis.call('del',key)
+    redis.call('set','purged:'..key,'1','PX',ARGV[1])
+end
+redis.call('publish',ARGV[2],table.concat(purged,' '))
+return purged
+"""
+
+RELEASE_LOCK_SCRIPT="""
+if redis.call('get',KEYS[1])==ARGV[1] then
+    return redis.call('del',KEYS[1])
+end
+return 0
+"""
+
+_inflight={}
+_refreshing=set()
+_background_tasks=set()
+
+class LoadAbandoned(Exception):
+    pass
+
+
+def pack_entry(meta:dict,payload:str):
+    # первая строка — поля для проверки политик, дальше готовый JSON ответа (model_dump_json не содержит переводов строк)
+    return json.dumps(meta,separators=(',',':'))+'\n'+payload
+def unpack_entry(value:str):
+    meta,sep,payload=value.partition('\n')
+    if not sep:
+        return json.loads(value),value
+    return json.loads(meta),payload
+
+def dependency_keys(payload:str):
+    # ключи сущностей, вложенных в ответ на любой глубине (UserOut.projects[].tasks[] тоже)
+    keys=[]
+    def walk(data):
+        for field,entity in NESTED_ENTITIES.items():
+            for item in data.get(field) or ():
+                keys.append(f'{entity}:{item["id"]}')
+                walk(item)
+    data=json.loads(payload)
+    if isinstance(data,dict):
+        walk(data)
+    return list(dict.fromkeys(keys))
+
+
+class LocalCache:
+    def __init__(self,max_items:int,max_bytes:int,ttl:float):
+        self.max_items=max_items
+        self.max_bytes=max_bytes
+        self.ttl=ttl
+        self._data=OrderedDict()
+        self._bytes=0
+    def __len__(self):
+        return len(self._data)
+    def get(self,key:str):
+        entry=self._data.get(key)
+        if entry is None:
+            return None
+        value,size,expires_at=entry
+        if expires_at<=time.monotonic():
+            self._remove(key)
+            return None
+        self._data.move_to_end(key)
+        return value
+    def set(self,key:str,value:str):
+        size=len(value)
+        if size>self.max_bytes:
+            return
+        self._remove(key)
+        self._data[key]=(value,size,time.monotonic()+self.ttl)
+        self._bytes+=size
+        while len(self._data)>self.max_items or self._bytes>self.max_bytes:
+            evicted_key,evicted=self._data.popitem(last=False)
+            self._bytes-=evicted[1]
+            CACHE_EVICTIONS.inc(evicted_key.split(':',1)[0])
+    def delete(self,key:str):
+        self._remove(key)
+    def clear(self):
+        self._data.clear()
+        self._bytes=0
+    def _remove(self,key:str):
+        entry=self._data.pop(key,None)
+        if entry is not None:
+            self._bytes-=entry[1]
+
+local_cache=LocalCache(settings.L1_CACHE_MAX_ITEMS,settings.L1_CACHE_MAX_BYTES,settings.L1_CACHE_TTL)
+
+
+@asynccontextmanager
+async def fill_session(db):
+    # промахи кэша читаются с primary: запись живёт до REDIS_TIME, а надгробие — CACHE_TOMBSTONE_MS, так что строка
+    # с реплики, отстающей до READ_REPLICA_MAX_LAG, могла бы вернуть в кэш версию, уже снятую инвалидацией
+    if getattr(db,'replica',None) is None:
+        yield db
+        return
+    async with async_factory() as primary:
+        yield primary
+
+class EntityCache:
+    def __init__(self,redis_conn,entity:str,local:LocalCache=local_cache,ttl:Optional[int]=None,stale:Optional[int]=None,required:tuple=()):
+        self.redis=redis_conn
+        self.entity=entity
+        self.local=local
+        self.required=required
+        self.ttl=ttl or settings.REDIS_TIME
+        self.stale=settings.REDIS_STALE_TIME if stale is None else stale
+    def key(self,obj_id):
+        return f'{self.entity}:{obj_id}'
+    def usable(self,value:Optional[str]):
+        # записи старого формата без полей политики (owner_id, assignee_id) считаются промахом и перезаписываются загрузкой
+        if value is None:
+            return False
+        if not self.required:
+            return True
+        meta=unpack_entry(value)[0]
+        return all(name in meta for name in self.required)
+    def local_get(self,key:str):
+        value=self.local.get(key)
+        if value is not None and not self.usable(value):
+            self.local.delete(key)
+            return None
+        return value
+    def expiry_ms(self):
+        # джиттер только укорачивает TTL: истечения разносятся во времени, а заданная граница не превышается
+        soft=self.ttl*random.uniform(1-settings.CACHE_TTL_JITTER,1)
+        return int((soft+self.stale)*1000)
+    async def lookup(self,obj_id):
+        key=self.key(obj_id)
+        value=self.local_get(key)
+        if value is not None:
+            CACHE_HITS.inc(self.entity,'local')
+            return value,False
+        CACHE_MISSES.inc(self.entity,'local')
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.get(key)
+            pipe.pttl(key)
+            value,pttl=await pipe.execute()
+        if not self.usable(value):
+            CACHE_MISSES.inc(self.entity,'redis')
+            return None,False
+        CACHE_HITS.inc(self.entity,'redis')
+        self.local.set(key,value)
+        return value,0<=pttl<=self.stale*1000
+    async def get_or_load(self,obj_id,loader,db):
+        value,stale=await self.lookup(obj_id)
+        if value is None:
+            return await self.load_once(obj_id,loader,db)
+        if stale:
+            self.refresh_in_background(obj_id,loader)
+        return value
+    async def load_once(self,obj_id,loader,db):
+        key=self.key(obj_id)
+        inflight=_inflight.get(key)
+        if inflight is not None:
+            try:
+                value=await asyncio.shield(inflight)
+                CACHE_COALESCED.inc(self.entity,'process')
+                return value
+            except LoadAbandoned:
+                pass
+        future=asyncio.get_running_loop().create_future()
+        future.add_done_callback(lambda done:done.exception())
+        _inflight[key]=future
+        try:
+            value=await self.load_locked(obj_id,loader,db)
+        except asyncio.CancelledError:
+            future.set_exception(LoadAbandoned())
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(value)
+            return value
+        finally:
+            if _inflight.get(key) is future:
+                del _inflight[key]
+    async def load_locked(self,obj_id,loader,db):
+        key=self.key(obj_id)
+        lock_key=f'lock:{key}'
+        token=uuid.uuid4().hex
+        if await self.redis.set(lock_key,token,nx=True,px=settings.CACHE_LOCK_MS):
+            try:
+                return await self.load(obj_id,loader,db,'sync')
+            finally:
+                await self.redis.eval(RELEASE_LOCK_SCRIPT,1,lock_key,token)
+        deadline=time.monotonic()+settings.CACHE_LOCK_MS/1000
+        while time.monotonic()<deadline:
+            await asyncio.sleep(0.025)
+            value=await self.redis.get(key)
+            if self.usable(value):
+                CACHE_COALESCED.inc(self.entity,'cluster')
+                self.local.set(key,value)
+                return value
+        return await self.load(obj_id,loader,db,'sync')
+    async def load(self,obj_id,loader,db,mode:str):
+        CACHE_LOADS.inc(self.entity,mode)
+        async with fill_session(db) as fill_db:
+            value=await loader(fill_db,obj_id)
+        await self.set(obj_id,value)
+        return value
+    def refresh_in_background(self,obj_id,loader):
+        key=self.key(obj_id)
+        if key in _refreshing:
+            return
+        _refreshing.add(key)
+        task=asyncio.create_task(self.refresh(obj_id,loader))
+        _background_tasks.add(task)
+        task.add_done_callback(lambda done:(_background_tasks.discard(done),_refreshing.discard(key)))
+    async def refresh(self,obj_id,loader):
+        lock_key=f'lock:{self.key(obj_id)}'
+        token=uuid.uuid4().hex
+        try:
+            if not await self.redis.set(lock_key,token,nx=True,px=settings.CACHE_LOCK_MS):
+                return
+            try:
+                async with async_factory() as db:
+                    await self.load(obj_id,loader,db,'background')
+            except HTTPException:
+                await self.invalidate(obj_id)
+            finally:
+                await self.redis.eval(RELEASE_LOCK_SCRIPT,1,lock_key,token)
+        except Exception as e:
+            logger.warning("Background refresh of %s failed: %s",self.key(obj_id),e)
+    async def get(self,obj_id)->Optional[str]:
+        key=self.key(obj_id)
+        value=self.local_get(key)
+        if value is not None:
+            CACHE_HITS.inc(self.entity,'local')
+            return value
+        CACHE_MISSES.inc(self.entity,'local')
+        value=await self.redis.get(key)
+        if not self.usable(value):
+            CACHE_MISSES.inc(self.entity,'redis')
+            return None
+        CACHE_HITS.inc(self.entity,'redis')
+        self.local.set(key,value)
+        return value
+    async def get_many(self,obj_ids:list)->dict:
+        found={}
+        remote=[]
+        for obj_id in obj_ids:
+            value=self.local_get(self.key(obj_id))
+            if value is not None:
+                found[obj_id]=value
+            else:
+                remote.append(obj_id)
+        CACHE_HITS.inc(self.entity,'local',amount=len(found))
+        if not remote:
+            return found
+        CACHE_MISSES.inc(self.entity,'local',amount=len(remote))
+        values=await self.redis.mget([self.key(obj_id) for obj_id in remote])
+        hits=0
+        for obj_id,value in zip(remote,values):
+            if self.usable(value):
+                found[obj_id]=value
+                self.local.set(self.key(obj_id),value)
+                hits+=1
+        CACHE_HITS.inc(self.entity,'redis',amount=hits)
+        CACHE_MISSES.inc(self.entity,'redis',amount=len(remote)-hits)
+        return found
+    def store_args(self,obj_id,value:str):
+        key=self.key(obj_id)
+        tags=[f'tags:{dependency}' for dependency in dependency_keys(unpack_entry(value)[1])]
+        # тег живёт не меньше самой долгой записи: джиттер только укорачивает expiry_ms
+        tag_ttl=(self.ttl+self.stale)*1000
+        return (STORE_SCRIPT,2+len(tags),key,f'purged:{key}',*tags,value,self.expiry_ms(),tag_ttl)
+    async def set_many(self,values:dict):
+        if not values:
+            return
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for obj_id,value in values.items():
+                pipe.eval(*self.store_args(obj_id,value))
+            stored=await pipe.execute()
+        for (obj_id,value),ok in zip(values.items(),stored):
+            if ok:
+                self.local.set(self.key(obj_id),value)
+    async def set(self,obj_id,value:str):
+        if await self.redis.eval(*self.store_args(obj_id,value)):
+            self.local.set(self.key(obj_id),value)
+    async def invalidate(self,obj_id):
+        await invalidate_keys(self.redis,[self.key(obj_id)],self.local)
+    async def invalidate_many(self,obj_ids):
+        await invalidate_keys(self.redis,[self.key(obj_id) for obj_id in obj_ids],self.local)
+
+
+async def invalidate_keys(redis_conn,keys,local:LocalCache=local_cache):
+    # один EVAL на весь набор: ключи, их зависимые по тегам, надгробия и одно сообщение (ключи через пробел)
+    keys=list(dict.fromkeys(keys))
+    if not keys:
+        return []
+    purged=await redis_conn.eval(PURGE_SCRIPT,len(keys),*keys,settings.CACHE_TOMBSTONE_MS,INVALIDATION_CHANNEL)
+    for key in purged:
+        local.delete(key)
+    return purged
+
+
+async def get_redis(request:Request):
+    return request.app.state.redis
+
+async def listen_invalidations(redis_conn):
+    while True:
+        pubsub=redis_conn.pubsub()
+        try:
+            await pubsub.subscribe(INVALIDATION_CHANNEL)
+            # сообщения, пропущенные пока подписки не было, не восстановить — сбрасываем L1
+            local_cache.clear()
+            async for message in pubsub.listen():
+                if message['type']=='message':
+                    for key in message['data'].split():
+                        local_cache.delete(key)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("Cache invalidation listener failed: %s",e)
+            local_cache.clear()
+            await asyncio.sleep(1)
+        finally:
+            await pubsub.aclose()
@@ -0,0 +1,96 @@
+import hashlib
+from datetime import datetime,timezone
+from email.utils import format_datetime,parsedate_to_datetime
+from typing import Optional
+from fastapi import Request
+from fastapi.responses import Response
+from pydantic import BaseModel
+from sqlalchemy import inspect
+
+
+def http_date(value:Optional[datetime]):
+    if value is None:
+        return None
+    value=value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value.astimezone(timezone.utc)
+    return format_datetime(value,usegmt=True)
+
+def make_etag(*parts):
+    return '"'+hashlib.blake2b('|'.join(map(str,parts)).encode(),digest_size=12).hexdigest()+'"'
+
+def entity_validators(data:BaseModel):
+    # ETag из версий корня и всех вложенных строк: правка задачи меняет ETag пользователя, в чей ответ она вложена.
+    # У строк без version (refresh_tokens) в расчёт идёт id — выпуск и удаление токена тоже видны
+    parts=[]
+    latest=None
+    def walk(name,item):
+        nonlocal latest
+        parts.append(f'{name}:{item.id}:{getattr(item,"version",None)}')
+        updated_at=getattr(item,'updated_at',None)
+        if updated_at is not None and (latest is None or updated_at>latest):
+            latest=updated_at
+        for field in type(item).model_fields:
+            value=getattr(item,field)
+            if isinstance(value,list):
+                for child in value:
+                    if isinstance(child,BaseModel):
+                        walk(field,child)
+    walk(type(data).__name__,data)
+    return make_etag(*parts),http_date(latest)
+
+def row_parts(obj,parts:list):
+    # только загруженные атрибуты: незагруженная связь не тянет ленивый запрос, а в ответ она и так не попадает.
+    # Обходятся коллекции (projects, tasks, refresh_tokens); у строк без version в расчёт идёт id
+    state=inspect(obj)
+    loaded=state.dict
+    parts.append(f'{type(obj).__name__}:{loaded.get("id")}:{loaded.get("version")}')
+    latest=loaded.get('updated_at')
+    for relation in state.mapper.relationships:
+        children=loaded.get(relation.key)
+        if isinstance(children,list):
+            for child in children:
+                child_latest=row_parts(child,parts)
+                if child_latest is not None and (latest is None or child_latest>latest):
+                    latest=child_latest
+    return latest
+
+def page_validators(request:Request,rows,*extra):
+    # ETag из строк, которые реально уходят в ответ, а не из агрегата по всей выборке: страница N не стоит
+    # лишнего скана. extra — total или курсоры страницы; параметры запроса (страница, поля, expand) входят в ETag
+    parts=[request.url.path,sorted(request.query_params.multi_items()),*extra]
+    latest=None
+    for row in rows:
+        row_latest=row_parts(row,parts)
+        if row_latest is not None and (latest is None or row_latest>latest):
+            latest=row_latest
+    return make_etag(*parts),http_date(latest)
+
+def validator_headers(etag:Optional[str],last_modified:Optional[str]):
+    headers={}
+    if etag:
+        headers['ETag']=etag
+    if last_modified:
+        headers['Last-Modified']=last_modified
+    return headers
+
+def not_modified(request:Request,etag:Optional[str],last_modified:Optional[str]):
+    if_none_match=request.headers.get('if-none-match')
+    if if_none_match is not None:
+        # If-None-Match главнее If-Modified-Since; для GET сравнение слабое, поэтому W/ отбрасываем
+        if etag is None:
+            return False
+        return if_none_match.strip()=='*' or etag in [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+    if_modified_since=request.headers.get('if-modified-since')
+    if not if_modified_since or not last_modified:
+        return False
+    try:
+        return parsedate_to_datetime(last_modified)<=parsedate_to_datetime(if_modified_since)
+    except (TypeError,ValueError):
+        return False
+
+def not_modified_response(etag:Optional[str],last_modified:Optional[str]):
+    return Response(status_code=304,headers=validator_headers(etag,last_modified))
+
+def conditional_json_response(request:Request,content:str,etag:Optional[str],last_modified:Optional[str]):
+    if not_modified(request,etag,last_modified):
+        return not_modified_response(etag,last_modified)
+    return Response(content=content,media_type='application/json',headers=validator_headers(etag,last_modified))
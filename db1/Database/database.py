@@ -1,8 +1,266 @@
+import asyncio
+import itertools
+import logging
+import random
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from fastapi import HTTPException
+from sqlalchemy import event, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import DBAPIError, InterfaceError, OperationalError
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from config import settings
+from db1.Metrics.metrics import REGISTRY
+from db1.Admission.admission import remaining_time
 
-engine = create_async_engine(settings.DATABASE_URL, echo=True)
+logger = logging.getLogger(__name__)
+
+REPLICA_LAG_SQL = text(
+    "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+)
+
+POOL_CHECKOUT_WAIT = REGISTRY.histogram('db_pool_checkout_wait_seconds', 'Time spent waiting for a pooled connection', ('pool',))
+POOL_HOLD_TIME = REGISTRY.histogram('db_connection_hold_seconds', 'Time a connection stays checked out of the pool', ('pool',))
+DB_RETRIES = REGISTRY.counter('db_retries_total', 'Read statements retried after a transient error', ('reason',))
+
+# 40001 serialization_failure, 40P01 deadlock_detected; 57014 (statement_timeout) повторять бессмысленно — дедлайн уже съеден
+RETRYABLE_SQLSTATES = {'40001', '40P01'}
+
+# счётчики SQL текущего запроса; middleware кладёт сюда свой QueryStats, события курсора его пополняют
+query_stats: ContextVar = ContextVar('query_stats', default=None)
+
+
+class QueryStats:
+    __slots__ = ('statements', 'rows', 'duration', 'by_statement')
+
+    def __init__(self):
+        self.statements = 0
+        self.rows = 0
+        self.duration = 0.0
+        self.by_statement = Counter()
+
+    def repeated(self, threshold: int = None):
+        # один и тот же SQL, выполненный много раз за запрос, — почти всегда ленивая загрузка в цикле (N+1)
+        threshold = threshold or settings.SQL_REPEAT_THRESHOLD
+        return {statement: count for statement, count in self.by_statement.items() if count >= threshold}
+
+    def header(self):
+        return (f"statements={self.statements}; rows={self.rows}; time_ms={self.duration * 1000:.1f}; "
+                f"repeated={sum(self.repeated().values())}")
+
+
+@contextmanager
+def track_queries():
+    stats = QueryStats()
+    token = query_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        query_stats.reset(token)
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    pool_name = 'primary'
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            POOL_CHECKOUT_WAIT.observe(time.perf_counter() - start, self.pool_name)
+
+
+def on_checkout(dbapi_connection, connection_record, connection_proxy):
+    connection_record.info['checked_out_at'] = time.perf_counter()
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._query_started_at = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = query_stats.get()
+    if stats is not None:
+        stats.statements += 1
+        stats.rows += max(cursor.rowcount, 0)
+        stats.duration += time.perf_counter() - context._query_started_at
+        stats.by_statement[statement] += 1
+
+
+def build_engine(url: str, name: str = 'primary'):
+    url = make_url(url)
+    connect_args = {}
+    if url.drivername.endswith('asyncpg'):
+        url = url.update_query_dict({'prepared_statement_cache_size': str(settings.DB_STATEMENT_CACHE_SIZE)})
+        connect_args['server_settings'] = {'statement_timeout': str(settings.DB_STATEMENT_TIMEOUT_MS)}
+    new_engine = create_async_engine(
+        url,
+        connect_args=connect_args,
+        echo=settings.DB_ECHO,
+        poolclass=TimedQueuePool,
+        pool_size=settings.DB_POOL_SIZE,
+        max_overflow=settings.DB_MAX_OVERFLOW,
+        pool_timeout=settings.DB_POOL_TIMEOUT,
+        pool_recycle=settings.DB_POOL_RECYCLE,
+        pool_pre_ping=settings.DB_POOL_PRE_PING,
+    )
+
+    def on_checkin(dbapi_connection, connection_record):
+        checked_out_at = connection_record.info.pop('checked_out_at', None)
+        if checked_out_at is not None:
+            POOL_HOLD_TIME.observe(time.perf_counter() - checked_out_at, name)
+
+    new_engine.pool.pool_name = name
+    event.listen(new_engine.sync_engine, 'checkout', on_checkout)
+    event.listen(new_engine.sync_engine, 'checkin', on_checkin)
+    event.listen(new_engine.sync_engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(new_engine.sync_engine, 'after_cursor_execute', after_cursor_execute)
+    return new_engine
+
+engine = build_engine(settings.DATABASE_URL)
 async_factory = async_sessionmaker(bind=engine, expire_on_commit=False, class_=AsyncSession)
+lazy_engine = engine.execution_options(isolation_level='AUTOCOMMIT')
+
+
+class Replica:
+    def __init__(self, url: str, index: int):
+        self.engine = build_engine(url, f'replica{index}')
+        self.lazy_engine = self.engine.execution_options(isolation_level='AUTOCOMMIT')
+        self.name = self.engine.url.render_as_string(hide_password=True)
+        self.healthy = True
+        self.lag = 0.0
+
+    def load(self):
+        return self.engine.pool.checkedout()
+
+
+class ReadRouter:
+    def __init__(self, urls: list, strategy: str):
+        self.replicas = [Replica(url, index) for index, url in enumerate(urls)]
+        self.strategy = strategy
+        self._counter = itertools.count()
+
+    def choose(self):
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        if not healthy:
+            return None
+        if self.strategy == 'least_loaded':
+            return min(healthy, key=Replica.load)
+        return healthy[next(self._counter) % len(healthy)]
+
+    def mark_failed(self, replica: Replica, reason):
+        if replica.healthy:
+            logger.warning("Read replica %s disabled: %s", replica.name, reason)
+        replica.healthy = False
+
+    async def check(self, replica: Replica):
+        try:
+            async with replica.engine.connect() as conn:
+                replica.lag = float((await conn.execute(REPLICA_LAG_SQL)).scalar() or 0)
+        except Exception as e:
+            self.mark_failed(replica, e)
+            return
+        if replica.lag > settings.READ_REPLICA_MAX_LAG:
+            self.mark_failed(replica, f"lag {replica.lag:.1f}s")
+        elif not replica.healthy:
+            logger.info("Read replica %s back in rotation", replica.name)
+            replica.healthy = True
+
+    async def monitor(self):
+        while True:
+            await asyncio.gather(*(self.check(replica) for replica in self.replicas))
+            await asyncio.sleep(settings.READ_REPLICA_CHECK_INTERVAL)
+
+    async def dispose(self):
+        for replica in self.replicas:
+            await replica.engine.dispose()
+
+read_router = ReadRouter([url.strip() for url in settings.DATABASE_READ_URLS.split(',') if url.strip()],
+                         settings.READ_REPLICA_STRATEGY)
+
+
+def pool_gauge(name: str, documentation: str, read):
+    def samples():
+        for pooled_engine in [engine] + [replica.engine for replica in read_router.replicas]:
+            yield (pooled_engine.pool.pool_name,), read(pooled_engine.pool)
+    REGISTRY.gauge(name, documentation, ('pool',), function=samples)
+
+pool_gauge('db_pool_size', 'Configured pool size', lambda pool: pool.size())
+pool_gauge('db_pool_checked_out', 'Connections currently checked out', lambda pool: pool.checkedout())
+pool_gauge('db_pool_idle', 'Idle connections kept in the pool', lambda pool: pool.checkedin())
+pool_gauge('db_pool_overflow', 'Connections opened above pool_size', lambda pool: max(pool.overflow(), 0))
+
+
+@event.listens_for(Session, 'after_begin')
+def apply_deadline(session, transaction, connection):
+    # дедлайн запроса превращается в statement_timeout транзакции; AUTOCOMMIT-сессиям хватает
+    # DB_STATEMENT_TIMEOUT_MS из server_settings — SET LOCAL вне транзакции ничего не делает
+    remaining = remaining_time()
+    if remaining is None or connection.get_execution_options().get('isolation_level') == 'AUTOCOMMIT':
+        return
+    if remaining <= 0:
+        raise HTTPException(status_code=503, detail="Request deadline exceeded", headers={'Retry-After': '1'})
+    connection.exec_driver_sql(f"SET LOCAL statement_timeout = {max(1, int(remaining * 1000))}")
+
+
+def is_connection_error(e):
+    return isinstance(e, (OperationalError, InterfaceError, OSError)) or getattr(e, 'connection_invalidated', False)
+
+
+def is_retryable(e):
+    sqlstate = getattr(getattr(e, 'orig', None), 'sqlstate', None)
+    if sqlstate == '57014':
+        return False
+    return sqlstate in RETRYABLE_SQLSTATES or is_connection_error(e)
+
+
+def backoff(attempt: int):
+    # full jitter: повторы от разных запросов не бьют в базу одной волной
+    return random.uniform(0, min(settings.DB_RETRY_MAX_DELAY, settings.DB_RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+
+
+class LazySession(AsyncSession):
+    # соединение берётся из пула только на первом запросе и возвращается сразу после него:
+    # сессия работает в AUTOCOMMIT, поэтому возврат не стоит ни BEGIN, ни ROLLBACK.
+    # Каждый запрос — отдельное чтение, так что его безопасно повторить: при отказе реплики сразу на primary,
+    # при прочих временных ошибках — с задержкой, пока она укладывается в дедлайн запроса.
+    replica = None
+
+    async def _run(self, method, *args, **kwargs):
+        try:
+            for attempt in itertools.count(1):
+                try:
+                    return await method(*args, **kwargs)
+                except (DBAPIError, OSError) as e:
+                    if not is_retryable(e) or attempt >= settings.DB_RETRY_ATTEMPTS:
+                        raise
+                    await self.close()
+                    if self.replica is not None and is_connection_error(e):
+                        read_router.mark_failed(self.replica, e)
+                        self.replica = None
+                        self.sync_session.bind = lazy_engine.sync_engine
+                        DB_RETRIES.inc('replica_failover')
+                        continue
+                    delay = backoff(attempt)
+                    remaining = remaining_time()
+                    if remaining is not None and delay >= remaining:
+                        raise
+                    DB_RETRIES.inc('transient')
+                    await asyncio.sleep(delay)
+        finally:
+            await self.close()
+
+    async def execute(self, *args, **kwargs):
+        return await self._run(super().execute, *args, **kwargs)
+
+    async def scalar(self, *args, **kwargs):
+        return await self._run(super().scalar, *args, **kwargs)
+
 
 async def get_db():
     async with async_factory() as db:
@@ -12,4 +270,14 @@ async def get_db():
             await db.rollback()
             raise
         finally:
-            await db.close()
\ No newline at end of file
+            await db.close()
+
+async def get_lazy_db():
+    async with LazySession(bind=lazy_engine, expire_on_commit=False) as db:
+        yield db
+
+async def get_read_db():
+    replica = read_router.choose()
+    async with LazySession(bind=(replica.lazy_engine if replica else lazy_engine), expire_on_commit=False) as db:
+        db.replica = replica
+        yield db
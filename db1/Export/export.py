@@ -0,0 +1,56 @@
+import csv
+import io
+from datetime import datetime
+from typing import Literal
+from fastapi.responses import StreamingResponse
+from pydantic_core import to_json
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from config import settings
+from db1.Database.database import engine,read_router
+from db1.Filters.fields import FieldSelection
+from db1.Filters.filters import SearchFilter
+from db1.Metrics.metrics import REGISTRY
+
+EXPORT_ROWS=REGISTRY.counter('export_rows_total','Rows streamed by export endpoints',('entity','format'))
+MEDIA_TYPES={'ndjson':'application/x-ndjson','csv':'text/csv'}
+
+ExportFormat=Literal['ndjson','csv']
+
+
+def export_query(selection:FieldSelection,export_filter:SearchFilter):
+    # только колонки, без ORM-объектов и selectinload: строка курсора сразу превращается в строку ответа
+    model=selection.field_set.model
+    query=export_filter.filter(select(*[getattr(model,name) for name in selection.columns]))
+    return export_filter.sort(query) if export_filter.search else query.order_by(model.id)
+
+def csv_value(value):
+    return value.isoformat() if isinstance(value,datetime) else value
+
+def render_ndjson(rows,columns:tuple):
+    return b''.join(to_json(dict(zip(columns,row)))+b'\n' for row in rows)
+
+def render_csv(rows,columns:tuple):
+    buffer=io.StringIO()
+    csv.writer(buffer).writerows([csv_value(value) for value in row] for row in rows)
+    return buffer.getvalue().encode()
+
+async def stream_rows(query,columns:tuple,fmt:ExportFormat,entity:str):
+    # свой сеанс на всё время ответа: сессия зависимости закрывается раньше, чем клиент дочитает тело.
+    # stream_results + yield_per держат в памяти одну пачку, а не всю таблицу
+    render=render_ndjson if fmt=='ndjson' else render_csv
+    if fmt=='csv':
+        yield render_csv([columns],columns)
+    replica=read_router.choose()
+    async with AsyncSession(bind=replica.engine if replica else engine) as db:
+        result=await db.stream(query.execution_options(yield_per=settings.EXPORT_BATCH_SIZE))
+        async for rows in result.partitions():
+            EXPORT_ROWS.inc(entity,fmt,amount=len(rows))
+            yield render(rows,columns)
+
+def export_response(selection:FieldSelection,export_filter:SearchFilter,fmt:ExportFormat,entity:str):
+    return StreamingResponse(
+        stream_rows(export_query(selection,export_filter),selection.columns,fmt,entity),
+        media_type=MEDIA_TYPES[fmt],
+        headers={'Content-Disposition':f'attachment; filename="{entity}.{fmt}"'},
+    )
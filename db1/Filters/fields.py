@@ -0,0 +1,96 @@
+from functools import lru_cache
+from typing import Callable,Dict,Iterable,Optional
+from fastapi import HTTPException,Query
+from pydantic import BaseModel,ConfigDict,create_model
+from sqlalchemy.orm import load_only,selectinload
+from db1.models.Base1 import User,Project,Task
+from db1.PydanticModels.Pydantic import UserOut,ProjectOut,TaskOut
+from db1.Cache.cache import pack_entry
+from db1.Conditional.conditional import entity_validators
+
+
+@lru_cache(maxsize=None)
+def partial_schema(schema:type[BaseModel]):
+    fields={name:(Optional[field.annotation],None) for name,field in schema.model_fields.items()}
+    return create_model(f'{schema.__name__}Fields',__config__=ConfigDict(from_attributes=True),**fields)
+
+@lru_cache(maxsize=256)
+def derived_schema(schema:type[BaseModel],names:frozenset):
+    if names==frozenset(schema.model_fields):
+        return schema
+    fields={name:(field.annotation,field) for name,field in schema.model_fields.items() if name in names}
+    return create_model(f'{schema.__name__}Partial',__config__=ConfigDict(from_attributes=True),**fields)
+
+class FieldSelection:
+    def __init__(self,field_set:'FieldSet',columns:tuple,relations:tuple):
+        self.field_set=field_set
+        self.columns=columns
+        self.relations=relations
+        self.names=frozenset(columns+relations)
+        self.schema=derived_schema(field_set.schema,self.names)
+    @property
+    def is_full(self):
+        return self.schema is self.field_set.schema
+    def options(self,*extra_columns):
+        model=self.field_set.model
+        options=[load_only(*[getattr(model,name) for name in self.columns],*extra_columns)]
+        options.extend(self.field_set.relations[name]() for name in self.relations)
+        return options
+    def dump(self,obj):
+        return self.schema.model_validate(obj)
+    def project(self,data:dict):
+        return {name:data[name] for name in self.names if name in data}
+
+class FieldSet:
+    def __init__(self,model,schema:type[BaseModel],relations:Dict[str,Callable],policy_fields:tuple=('id',)):
+        self.model=model
+        self.schema=schema
+        self.relations=relations
+        self.policy_fields=policy_fields
+        self.columns=tuple(name for name in schema.model_fields if name not in relations)
+        self.partial=partial_schema(schema)
+        self.full=FieldSelection(self,self.columns,tuple(relations))
+        self.cheap=FieldSelection(self,self.columns,())
+    def cache_entry(self,obj):
+        data=self.schema.model_validate(obj)
+        meta={name:getattr(data,name) for name in self.policy_fields}
+        # валидаторы считаются один раз при заполнении кэша: 304 потом отвечается без БД и без сериализации
+        meta['etag'],meta['modified']=entity_validators(data)
+        return pack_entry(meta,data.model_dump_json())
+    def select(self,fields:Optional[str],expand:Optional[str],default:FieldSelection):
+        if fields is None and expand is None:
+            return default
+        columns=self._parse(fields,self.columns) if fields is not None else self.columns
+        relations=self._parse(expand,tuple(self.relations)) if expand is not None else ()
+        if 'id' not in columns:
+            columns=('id',)+columns
+        return FieldSelection(self,columns,relations)
+    def _parse(self,value:str,allowed:Iterable[str]):
+        names=tuple(dict.fromkeys(name.strip() for name in value.split(',') if name.strip()))
+        unknown=[name for name in names if name not in allowed]
+        if unknown:
+            raise HTTPException(status_code=400,detail=f"Unknown fields: {', '.join(unknown)}")
+        return names
+    def list_dependency(self):
+        def dependency(fields:Optional[str]=Query(None),expand:Optional[str]=Query(None)):
+            return self.select(fields,expand,self.cheap)
+        return dependency
+    def detail_dependency(self):
+        def dependency(fields:Optional[str]=Query(None),expand:Optional[str]=Query(None)):
+            return self.select(fields,expand,self.full)
+        return dependency
+    def export_dependency(self):
+        def dependency(fields:Optional[str]=Query(None)):
+            return self.select(fields,None,self.cheap)
+        return dependency
+
+
+USER_FIELDS=FieldSet(User,UserOut,{
+    'projects':lambda:selectinload(User.projects).selectinload(Project.tasks),
+    'tasks':lambda:selectinload(User.tasks),
+    'refresh_tokens':lambda:selectinload(User.refresh_tokens),
+})
+PROJECT_FIELDS=FieldSet(Project,ProjectOut,{
+    'tasks':lambda:selectinload(Project.tasks),
+},policy_fields=('id','owner_id'))
+TASK_FIELDS=FieldSet(Task,TaskOut,{},policy_fields=('id','assignee_id'))
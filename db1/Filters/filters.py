@@ -1,20 +1,66 @@
+from fastapi import HTTPException,Query
 from fastapi_filter.contrib.sqlalchemy import Filter
-from typing import Optional
+from typing import Optional,Literal
+from sqlalchemy import func,or_
 from db1.models.Base1 import User,Project,Task
 
 
-class UserFilter(Filter):
+MAX_BATCH_IDS=100
+
+def batch_ids(ids:str=Query(...,description="Comma-separated ids")):
+    try:
+        parsed=list(dict.fromkeys(int(obj_id) for obj_id in ids.split(',') if obj_id.strip()))
+    except ValueError:
+        raise HTTPException(status_code=400,detail="ids must be integers")
+    if not parsed or len(parsed)>MAX_BATCH_IDS:
+        raise HTTPException(status_code=400,detail=f"Pass between 1 and {MAX_BATCH_IDS} ids")
+    return parsed
+
+def escape_like(value:str):
+    return value.replace('\\','\\\\').replace('%','\\%').replace('_','\\_')
+
+class SearchFilter(Filter):
+    # подстрочный поиск по search_model_fields; ILIKE обслуживается GIN-индексами pg_trgm
+    search:Optional[str]=None
+    search_mode:Literal['contains','prefix']='contains'
+    @property
+    def filtering_fields(self):
+        fields=self.model_dump(exclude_none=True,exclude_unset=True)
+        fields.pop(self.Constants.ordering_field_name,None)
+        fields.pop('search',None)
+        fields.pop('search_mode',None)
+        return fields.items()
+    def search_columns(self):
+        return [getattr(self.Constants.model,name) for name in self.Constants.search_model_fields]
+    def filter(self,query):
+        query=super().filter(query)
+        if not self.search:
+            return query
+        term=escape_like(self.search)
+        pattern=f'{term}%' if self.search_mode=='prefix' else f'%{term}%'
+        return query.where(or_(*[column.ilike(pattern,escape='\\') for column in self.search_columns()]))
+    def sort(self,query):
+        if not self.search:
+            return query
+        scores=[func.similarity(column,self.search) for column in self.search_columns()]
+        rank=func.greatest(*scores) if len(scores)>1 else scores[0]
+        return query.order_by(rank.desc(),self.Constants.model.id)
+
+class UserFilter(SearchFilter):
     username__ilike:Optional[str]=None
     email__ilike:Optional[str]=None
     class Constants(Filter.Constants):
        model=User
-class ProjectFilter(Filter):
+       search_model_fields=['username','email']
+class ProjectFilter(SearchFilter):
     title__ilike:Optional[str]=None
     owner_id__eq:Optional[int]=None
     class Constants(Filter.Constants):
         model=Project
+        search_model_fields=['title']
 
-class TaskFilter(Filter):
+class TaskFilter(SearchFilter):
     title__ilike:Optional[str]=None
     class Constants(Filter.Constants):
         model=Task
+        search_model_fields=['title']
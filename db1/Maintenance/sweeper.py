@@ -0,0 +1,90 @@
+import asyncio
+import logging
+import time
+import uuid
+from datetime import datetime
+from sqlalchemy import delete,select
+from sqlalchemy.ext.asyncio import AsyncSession
+from config import settings
+from db1.Cache.cache import EntityCache
+from db1.Database.database import async_factory
+from db1.Metrics.metrics import REGISTRY
+from db1.models.Base1 import RefreshTokenDB
+
+logger=logging.getLogger(__name__)
+
+TOKENS_PURGED=REGISTRY.counter('refresh_tokens_purged_total','Expired refresh tokens deleted by the sweeper')
+SWEEP_DURATION=REGISTRY.histogram('token_sweep_seconds','Duration of one refresh token sweep',buckets=(0.01,0.05,0.1,0.5,1.0,5.0,10.0,30.0,60.0))
+SWEEP_LEADER=REGISTRY.gauge('token_sweeper_leader','1 while this instance holds the sweeper lock')
+
+# захват или продление аренды одним вызовом: лидер продлевает свой ключ, остальные получают 0
+ACQUIRE_LEASE_SCRIPT="""
+local current=redis.call('get',KEYS[1])
+if not current then
+    redis.call('set',KEYS[1],ARGV[1],'PX',ARGV[2])
+    return 1
+end
+if current==ARGV[1] then
+    redis.call('pexpire',KEYS[1],ARGV[2])
+    return 1
+end
+return 0
+"""
+
+
+class LeaderLease:
+    def __init__(self,redis_conn,name:str,ttl_ms:int):
+        self.redis=redis_conn
+        self.key=f'lock:{name}'
+        self.token=uuid.uuid4().hex
+        self.ttl_ms=ttl_ms
+    async def acquire(self):
+        return bool(await self.redis.eval(ACQUIRE_LEASE_SCRIPT,1,self.key,self.token,self.ttl_ms))
+
+async def purge_expired_tokens(db:AsyncSession,batch_size:int,now:datetime):
+    # короткая транзакция на пачку: SKIP LOCKED не ждёт строк, которые сейчас ротирует /users/refresh
+    expired=select(RefreshTokenDB.id).where(RefreshTokenDB.expires_at < now).limit(batch_size).with_for_update(skip_locked=True)
+    result=await db.execute(
+        delete(RefreshTokenDB).where(RefreshTokenDB.id.in_(expired)).returning(RefreshTokenDB.user_id)
+        .execution_options(synchronize_session=False)
+    )
+    user_ids=result.scalars().all()
+    await db.commit()
+    return user_ids
+
+class TokenSweeper:
+    def __init__(self,redis_conn):
+        self.lease=LeaderLease(redis_conn,'token-sweeper',int(settings.TOKEN_SWEEP_INTERVAL*2000))
+        self.user_cache=EntityCache(redis_conn,'user')
+    async def sweep(self):
+        start=time.perf_counter()
+        now=datetime.utcnow()
+        total=0
+        try:
+            for _ in range(settings.TOKEN_SWEEP_MAX_BATCHES):
+                async with async_factory() as db:
+                    user_ids=await purge_expired_tokens(db,settings.TOKEN_SWEEP_BATCH,now)
+                total+=len(user_ids)
+                TOKENS_PURGED.inc(amount=len(user_ids))
+                # UserOut в кэше содержит refresh_tokens — удалённые строки не должны в нём оставаться
+                await self.user_cache.invalidate_many(user_ids)
+                if len(user_ids)<settings.TOKEN_SWEEP_BATCH:
+                    break
+                await asyncio.sleep(settings.TOKEN_SWEEP_PAUSE)
+        finally:
+            SWEEP_DURATION.observe(time.perf_counter()-start)
+        if total:
+            logger.info("Purged %d expired refresh tokens",total)
+        return total
+    async def run(self):
+        while True:
+            try:
+                leader=await self.lease.acquire()
+                SWEEP_LEADER.set(int(leader))
+                if leader:
+                    await self.sweep()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Refresh token sweep failed")
+            await asyncio.sleep(settings.TOKEN_SWEEP_INTERVAL)
@@ -0,0 +1,97 @@
+from bisect import bisect_left
+from collections import defaultdict
+from typing import Callable,Iterable,Optional
+
+DEFAULT_BUCKETS=(0.005,0.01,0.025,0.05,0.1,0.25,0.5,1.0,2.5,5.0,10.0)
+
+
+def _format_labels(labelnames:tuple,values:tuple,extra:str=''):
+    pairs=[f'{name}="{value}"' for name,value in zip(labelnames,values)]
+    if extra:
+        pairs.append(extra)
+    return '{'+','.join(pairs)+'}' if pairs else ''
+
+# всё пишется из потока event loop одного воркера: без блокировок, каждый процесс агрегирует своё
+class Counter:
+    kind='counter'
+    def __init__(self,name:str,documentation:str,labelnames:Iterable[str]=()):
+        self.name=name
+        self.documentation=documentation
+        self.labelnames=tuple(labelnames)
+        self._values=defaultdict(float)
+    def inc(self,*labels,amount:float=1.0):
+        self._values[labels]+=amount
+    def value(self,*labels):
+        return self._values.get(labels,0.0)
+    def samples(self):
+        for labels,value in list(self._values.items()):
+            yield self.name,_format_labels(self.labelnames,labels),value
+
+class Gauge(Counter):
+    kind='gauge'
+    def __init__(self,name:str,documentation:str,labelnames:Iterable[str]=(),function:Optional[Callable[[],float]]=None):
+        super().__init__(name,documentation,labelnames)
+        self.function=function
+    def set(self,value:float,*labels):
+        self._values[labels]=value
+    def dec(self,*labels,amount:float=1.0):
+        self._values[labels]-=amount
+    def samples(self):
+        if self.function is None:
+            yield from super().samples()
+        elif self.labelnames:
+            # функция с метками возвращает пары (значения меток, значение)
+            for labels,value in self.function():
+                yield self.name,_format_labels(self.labelnames,labels),value
+        else:
+            yield self.name,'',self.function()
+
+class Histogram:
+    kind='histogram'
+    def __init__(self,name:str,documentation:str,labelnames:Iterable[str]=(),buckets:Iterable[float]=DEFAULT_BUCKETS):
+        self.name=name
+        self.documentation=documentation
+        self.labelnames=tuple(labelnames)
+        self.buckets=tuple(sorted(buckets))
+        self._counts={}
+        self._sums=defaultdict(float)
+    def observe(self,value:float,*labels):
+        counts=self._counts.get(labels)
+        if counts is None:
+            counts=self._counts[labels]=[0]*(len(self.buckets)+1)
+        counts[bisect_left(self.buckets,value)]+=1
+        self._sums[labels]+=value
+    def count(self,*labels):
+        return sum(self._counts.get(labels,()))
+    def samples(self):
+        for labels,counts in list(self._counts.items()):
+            cumulative=0
+            for bound,count in zip(self.buckets+(float('inf'),),counts):
+                cumulative+=count
+                le='+Inf' if bound==float('inf') else repr(bound)
+                yield f'{self.name}_bucket',_format_labels(self.labelnames,labels,f'le="{le}"'),cumulative
+            yield f'{self.name}_sum',_format_labels(self.labelnames,labels),self._sums[labels]
+            yield f'{self.name}_count',_format_labels(self.labelnames,labels),cumulative
+
+class Registry:
+    def __init__(self):
+        self._metrics={}
+    def register(self,metric):
+        self._metrics[metric.name]=metric
+        return metric
+    def counter(self,name:str,documentation:str,labelnames:Iterable[str]=()):
+        return self._metrics.get(name) or self.register(Counter(name,documentation,labelnames))
+    def gauge(self,name:str,documentation:str,labelnames:Iterable[str]=(),function:Optional[Callable[[],float]]=None):
+        return self._metrics.get(name) or self.register(Gauge(name,documentation,labelnames,function))
+    def histogram(self,name:str,documentation:str,labelnames:Iterable[str]=(),buckets:Iterable[float]=DEFAULT_BUCKETS):
+        return self._metrics.get(name) or self.register(Histogram(name,documentation,labelnames,buckets))
+    def render(self):
+        lines=[]
+        for metric in self._metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name,labels,value in metric.samples():
+                lines.append(f'{name}{labels} {value}')
+        return '\n'.join(lines)+'\n'
+
+REGISTRY=Registry()
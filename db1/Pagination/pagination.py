@@ -0,0 +1,45 @@
+import base64
+import json
+from fastapi import HTTPException
+from sqlalchemy.ext.asyncio import AsyncSession
+from db1.PydanticModels.Pydantic import CursorParams
+
+
+def encode_cursor(obj_id:int,direction:str):
+    raw=json.dumps({'id':obj_id,'dir':direction},separators=(',',':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+def decode_cursor(cursor:str):
+    try:
+        data=json.loads(base64.urlsafe_b64decode(cursor+'='*(-len(cursor)%4)))
+        obj_id,direction=int(data['id']),data['dir']
+    except (ValueError,KeyError,TypeError):
+        raise HTTPException(status_code=400,detail="Invalid cursor")
+    if direction not in ('next','prev'):
+        raise HTTPException(status_code=400,detail="Invalid cursor")
+    return obj_id,direction
+
+async def cursor_paginate(db:AsyncSession,query,model,params:CursorParams):
+    # keyset по первичному ключу: id неизменяем и уже проиндексирован, поэтому страница N стоит как страница 1
+    key=model.id
+    last_id,direction=decode_cursor(params.cursor) if params.cursor else (None,'next')
+    if direction=='next':
+        if last_id is not None:
+            query=query.where(key > last_id)
+        query=query.order_by(key.asc())
+    else:
+        query=query.where(key < last_id).order_by(key.desc())
+    result=await db.execute(query.limit(params.size+1))
+    items=list(result.scalars().unique().all())
+    has_more=len(items)>params.size
+    items=items[:params.size]
+    if direction=='prev':
+        items.reverse()
+        has_next,has_prev=True,has_more
+    else:
+        has_next,has_prev=has_more,last_id is not None
+    return {
+        'items':items,
+        'size':params.size,
+        'next_cursor':encode_cursor(items[-1].id,'next') if items and has_next else None,
+        'prev_cursor':encode_cursor(items[0].id,'prev') if items and has_prev else None,
+    }
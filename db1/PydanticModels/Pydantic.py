@@ -1,7 +1,9 @@
 from pydantic import BaseModel,constr,Field,ConfigDict
-from typing import Optional,List
+from typing import Optional,List,Dict,Generic,TypeVar
 from datetime import datetime
 
+T=TypeVar('T')
+
 class CreateUser(BaseModel):
     username:str
     email:str
@@ -30,7 +32,6 @@ class RefreshToken(BaseModel):
     refresh_token:str
 class RefreshDBTokenOut(BaseModel):
     id:int
-    token:str
     expires_at:Optional[datetime]=None
 
     model_config = ConfigDict(from_attributes=True)
@@ -38,16 +39,30 @@ class TaskOut(BaseModel):
     id:int
     title:str
     status:str
+    project_id:Optional[int]=None
+    assignee_id:Optional[int]=None
     created_at:Optional[datetime]=None
+    updated_at:Optional[datetime]=None
+    version:Optional[int]=None
 
     model_config = ConfigDict(from_attributes=True)
 class ProjectOut(BaseModel):
     id:int
     title:str
+    owner_id:Optional[int]=None
     created_at:Optional[datetime]=None
+    updated_at:Optional[datetime]=None
+    version:Optional[int]=None
     tasks:List[TaskOut]=Field(default_factory=list)
 
     model_config = ConfigDict(from_attributes=True)
+class AvailabilityOut(BaseModel):
+    username:Optional[bool]=None
+    email:Optional[bool]=None
+class TaskStatsOut(BaseModel):
+    id:int
+    counts:Dict[str,int]=Field(default_factory=dict)
+    total:int=0
 class UserSimpleOut(BaseModel):
     id: int
     username: str
@@ -62,11 +77,18 @@ class UserOut(BaseModel):
     email:str
     role:str
     created_at:Optional[datetime]=None
+    updated_at:Optional[datetime]=None
+    version:Optional[int]=None
     projects:List[ProjectOut]=Field(default_factory=list)
     tasks:List[TaskOut]=Field(default_factory=list)
     refresh_tokens:List[RefreshDBTokenOut]=Field(default_factory=list)
 
     model_config = ConfigDict(from_attributes=True,arbitrary_types_allowed=True)
+class Principal(BaseModel):
+    id:int
+    role:str
+
+    model_config = ConfigDict(from_attributes=True)
 class UpdateUser(BaseModel):
     username:Optional[str]=None
     password:Optional[str]=None
@@ -84,4 +106,30 @@ class UpdateTask(BaseModel):
     status:Optional[str]=None
     created_at:Optional[datetime]=None
 
-    model_config = ConfigDict(from_attributes=True)
\ No newline at end of file
+    model_config = ConfigDict(from_attributes=True)
+class CursorParams(BaseModel):
+    cursor:Optional[str]=None
+    size:int=Field(50,ge=1,le=100)
+class CursorPage(BaseModel,Generic[T]):
+    items:List[T]
+    size:int
+    next_cursor:Optional[str]=None
+    prev_cursor:Optional[str]=None
+class BatchOut(BaseModel,Generic[T]):
+    items:List[T]
+    not_found:List[int]=Field(default_factory=list)
+    forbidden:List[int]=Field(default_factory=list)
+MAX_BULK_ITEMS=10000
+class BulkCreateTasks(BaseModel):
+    items:List[CreateTask]=Field(min_length=1,max_length=MAX_BULK_ITEMS)
+class BulkCreateProjects(BaseModel):
+    items:List[CreateProject]=Field(min_length=1,max_length=MAX_BULK_ITEMS)
+class BulkTaskStatus(BaseModel):
+    ids:List[int]=Field(min_length=1,max_length=MAX_BULK_ITEMS)
+    status:str
+class BulkTaskAssignee(BaseModel):
+    ids:List[int]=Field(min_length=1,max_length=MAX_BULK_ITEMS)
+    assignee_id:int
+class BulkOut(BaseModel):
+    ids:List[int]
+    not_found:List[int]=Field(default_factory=list)
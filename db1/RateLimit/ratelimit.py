@@ -0,0 +1,183 @@
+import asyncio
+import ipaddress
+import logging
+import math
+import time
+from functools import lru_cache
+from fastapi import HTTPException,Request
+from redis.exceptions import RedisError
+from config import settings
+from db1.Metrics.metrics import REGISTRY
+
+logger=logging.getLogger(__name__)
+
+RATE_LIMITED=REGISTRY.counter('rate_limited_total','Requests rejected by the rate limiter',('route','mode'))
+RATE_LIMIT_SYNCS=REGISTRY.histogram('rate_limit_sync_seconds','Duration of one batched counter sync to Redis')
+RATE_LIMIT_SYNC_ERRORS=REGISTRY.counter('rate_limit_sync_errors_total','Failed counter syncs (limiter runs local-only until the next success)')
+
+
+class Window:
+    # счётчик одного окна одного ключа: remote — последнее известное значение в Redis (с чужими воркерами),
+    # pending — локальные попадания, ещё не отправленные в Redis
+    __slots__=('remote','pending')
+    def __init__(self):
+        self.remote=0
+        self.pending=0
+    @property
+    def total(self):
+        return self.remote+self.pending
+
+class HybridRateLimiter:
+    # скользящее окно, приближённое двумя фиксированными: prev*(1-доля прошедшего окна)+current.
+    # Обычный режим решает по локальным счётчикам и раз в RATE_LIMIT_SYNC_MS одним конвейером отправляет
+    # накопленные инкременты в Redis, получая обратно общие значения; строгий режим ходит в Redis на каждый запрос.
+    # Пока Redis недоступен, оба режима считают только локально.
+    def __init__(self,prefix:str='rl'):
+        self.prefix=prefix
+        self.redis=None
+        self.windows={}
+        self.dirty=set()
+        self.degraded=False
+    def bind(self,redis_conn):
+        self.redis=redis_conn
+    def redis_key(self,key:str,period:int,index:int):
+        return f'{self.prefix}:{key}:{period}:{index}'
+    def window(self,key:str,period:int,index:int):
+        window=self.windows.get((key,period,index))
+        if window is None:
+            window=self.windows[(key,period,index)]=Window()
+        return window
+    def estimate(self,key:str,period:int,now:float):
+        index,offset=divmod(now,period)
+        index=int(index)
+        previous=self.windows.get((key,period,index-1))
+        weight=1-offset/period
+        return (previous.total*weight if previous else 0)+self.window(key,period,index).total,index
+    def retry_after(self,period:int,now:float):
+        return max(1,math.ceil(period-now%period))
+    async def hit(self,key:str,times:int,period:int,strict:bool=False):
+        now=time.time()
+        if strict and self.redis is not None and not self.degraded:
+            try:
+                return await self.hit_strict(key,times,period,now)
+            except (RedisError,OSError) as e:
+                self.mark_degraded(e)
+        count,index=self.estimate(key,period,now)
+        if count>=times:
+            return False,self.retry_after(period,now)
+        window=self.window(key,period,index)
+        window.pending+=1
+        self.dirty.add((key,period,index))
+        # граница ошибки: воркер может обогнать общий счётчик не больше чем на RATE_LIMIT_ERROR*times попаданий
+        if window.pending>=max(1,int(times*settings.RATE_LIMIT_ERROR)) and self.redis is not None and not self.degraded:
+            await self.sync([(key,period,index)])
+        return True,0
+    async def hit_strict(self,key:str,times:int,period:int,now:float):
+        index,offset=divmod(now,period)
+        index=int(index)
+        current=self.redis_key(key,period,index)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.incr(current)
+            pipe.pexpire(current,period*2000)
+            pipe.get(self.redis_key(key,period,index-1))
+            count,_,previous=await pipe.execute()
+        self.window(key,period,index).remote=count
+        self.window(key,period,index-1).remote=int(previous or 0)
+        if int(previous or 0)*(1-offset/period)+count>times:
+            return False,self.retry_after(period,now)
+        return True,0
+    async def sync(self,entries=None):
+        if entries is None:
+            dirty,self.dirty=self.dirty,set()
+        else:
+            dirty={entry for entry in entries if entry in self.dirty}
+            self.dirty-=dirty
+        if not dirty:
+            return
+        batch=[(entry,self.windows[entry].pending) for entry in dirty if entry in self.windows]
+        start=time.perf_counter()
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for (key,period,index),pending in batch:
+                    current=self.redis_key(key,period,index)
+                    pipe.incrby(current,pending)
+                    pipe.pexpire(current,period*2000)
+                    pipe.get(self.redis_key(key,period,index-1))
+                results=await pipe.execute()
+        except (RedisError,OSError) as e:
+            self.dirty|=dirty
+            self.mark_degraded(e)
+            return
+        RATE_LIMIT_SYNCS.observe(time.perf_counter()-start)
+        if self.degraded:
+            logger.info("Rate limiter back in sync with Redis")
+            self.degraded=False
+        for i,((key,period,index),pending) in enumerate(batch):
+            window=self.windows.get((key,period,index))
+            if window is None:
+                continue
+            # попадания, пришедшие во время await, остаются в pending до следующей синхронизации
+            window.pending-=pending
+            window.remote=results[i*3]
+            self.window(key,period,index-1).remote=int(results[i*3+2] or 0)
+    def mark_degraded(self,error):
+        RATE_LIMIT_SYNC_ERRORS.inc()
+        if not self.degraded:
+            logger.warning("Rate limiter degraded to local-only counters: %s",error)
+        self.degraded=True
+    def evict(self,now:float):
+        # окна старше предыдущего уже не влияют на оценку
+        stale=[entry for entry in self.windows if entry[2]<int(now//entry[1])-1]
+        for entry in stale:
+            del self.windows[entry]
+            self.dirty.discard(entry)
+    async def run(self):
+        while True:
+            await asyncio.sleep(settings.RATE_LIMIT_SYNC_MS/1000)
+            self.evict(time.time())
+            if self.redis is not None:
+                await self.sync()
+
+rate_limiter=HybridRateLimiter()
+REGISTRY.gauge('rate_limit_degraded','1 while the rate limiter runs without Redis',function=lambda:int(rate_limiter.degraded))
+REGISTRY.gauge('rate_limit_tracked_windows','Counter windows kept in process',function=lambda:len(rate_limiter.windows))
+
+
+@lru_cache(maxsize=8)
+def trusted_networks(proxies:tuple):
+    return [ipaddress.ip_network(proxy,strict=False) for proxy in proxies]
+
+def is_trusted_proxy(host:str):
+    try:
+        address=ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return any(address in network for network in trusted_networks(tuple(settings.TRUSTED_PROXIES)))
+
+def client_identifier(request:Request):
+    # X-Forwarded-For пишет клиент, поэтому ему верим только за доверенным прокси и берём самый правый
+    # недоверенный хоп: левые значения клиент подставляет сам и получал бы новый бакет на каждый запрос
+    peer=request.client.host if request.client else 'unknown'
+    if not is_trusted_proxy(peer):
+        return peer
+    hops=[hop.strip() for hop in request.headers.get('X-Forwarded-For','').split(',') if hop.strip()]
+    for hop in reversed(hops):
+        if not is_trusted_proxy(hop):
+            return hop
+    return hops[0] if hops else peer
+
+class RateLimit:
+    def __init__(self,times:int,seconds:int,strict:bool=False,name:str=None):
+        self.times=times
+        self.seconds=seconds
+        self.strict=strict
+        self.name=name
+    async def __call__(self,request:Request):
+        route=request.scope.get('route')
+        name=self.name or (route.path if route is not None else request.url.path)
+        if name in settings.RATE_LIMIT_EXEMPT:
+            return
+        allowed,retry_after=await rate_limiter.hit(f'{name}:{client_identifier(request)}',self.times,self.seconds,self.strict)
+        if not allowed:
+            RATE_LIMITED.inc(name,'strict' if self.strict else 'local')
+            raise HTTPException(status_code=429,detail="Too Many Requests",headers={'Retry-After':str(retry_after)})
@@ -1,12 +1,49 @@
+import asyncio
+import hashlib
+import hmac
+import time
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import HTTPException
 from fastapi.security import OAuth2PasswordBearer,OAuth2PasswordRequestForm
 from passlib.context import CryptContext
 from abc import ABC, abstractmethod
 from db1.models.Base1 import User,Project,Task
 from typing import Any
+from config import settings
+from db1.Metrics.metrics import REGISTRY
 
 
 password_context = CryptContext(schemes=["argon2"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/users/login")
+
+HASH_LATENCY=REGISTRY.histogram('password_hash_seconds','Time spent hashing or verifying a password, queue wait included',('operation',))
+HASH_REJECTED=REGISTRY.counter('password_hash_rejected_total','Password operations rejected because the hashing queue was full',('operation',))
+
+class HashingPool:
+    # argon2-cffi отпускает GIL, поэтому потоков достаточно, процессы не нужны
+    def __init__(self,workers:int,max_queue:int):
+        self.workers=workers
+        self.max_pending=workers+max_queue
+        self.pending=0
+        self.executor=ThreadPoolExecutor(max_workers=workers,thread_name_prefix='argon2')
+    def queue_depth(self):
+        return max(0,self.pending-self.workers)
+    async def run(self,operation:str,func,*args):
+        if self.pending>=self.max_pending:
+            HASH_REJECTED.inc(operation)
+            raise HTTPException(status_code=503,detail="Server is busy, try again later",headers={"Retry-After":"1"})
+        self.pending+=1
+        start=time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor,func,*args)
+        finally:
+            self.pending-=1
+            HASH_LATENCY.observe(time.perf_counter()-start,operation)
+
+hashing_pool=HashingPool(settings.HASH_POOL_SIZE,settings.HASH_QUEUE_SIZE)
+REGISTRY.gauge('password_hash_queue_depth','Password operations waiting for a hashing thread',function=hashing_pool.queue_depth)
+REGISTRY.gauge('password_hash_in_flight','Password operations queued or running',function=lambda:hashing_pool.pending)
+
 class Utils:
     @staticmethod
     def password_hash(password:str):
@@ -14,6 +51,16 @@ class Utils:
     @staticmethod
     def password_verify(password:str,password_hash:str):
         return password_context.verify(password,password_hash)
+    @staticmethod
+    async def password_hash_async(password:str):
+        return await hashing_pool.run('hash',password_context.hash,password)
+    @staticmethod
+    async def password_verify_async(password:str,password_hash:str):
+        return await hashing_pool.run('verify',password_context.verify,password,password_hash)
+    @staticmethod
+    def token_digest(token:str):
+        key=(settings.REFRESH_TOKEN_HMAC_KEY or settings.SECRET_KEY).encode()
+        return hmac.new(key,token.encode(),hashlib.sha256).hexdigest()
 
 class BaseUserPolicy(ABC):
     def __init__(self,user:User):
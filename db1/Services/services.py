@@ -1,56 +1,125 @@
 import json
-from sqlalchemy import select
+import logging
+from collections import Counter
+from datetime import datetime
+from types import SimpleNamespace
+from sqlalchemy import select,exists,update,func,literal,column,any_,Integer,String,DateTime
+from sqlalchemy.dialects.postgresql import insert,ARRAY
 from sqlalchemy.ext.asyncio import AsyncSession
-from db1.models.Base1 import User,Project,Task
+from db1.models.Base1 import User,Project,Task,ProjectTaskStats,UserTaskStats
 from db1.Security.security import Utils
 from fastapi import HTTPException
 from db1.Security.security import BaseService,CreateService,BaseProjectPolicy,BaseUserPolicy,BaseTaskPolicy
-from sqlalchemy.orm import selectinload,joinedload
 from db1.PydanticModels.Pydantic import *
-from config import settings
 from db1.Filters.filters import UserFilter,ProjectFilter,TaskFilter
-from fastapi_pagination.ext.sqlalchemy import paginate
+from fastapi_pagination.ext.sqlalchemy import apaginate
+from db1.Filters.fields import FieldSelection,USER_FIELDS,PROJECT_FIELDS,TASK_FIELDS
+from db1.Pagination.pagination import cursor_paginate
+from db1.Cache.cache import EntityCache,fill_session,unpack_entry,invalidate_keys
+from db1.Cache.bloom import user_filters,add_user_values,BLOOM_CHECKS
+from db1.Tokens.tokens import invalidate_principal
+from db1.Conditional.conditional import page_validators
+from db1.Stats.stats import apply_task_deltas,upsert_counts,grouped_task_counts,summarize
 
+logger=logging.getLogger(__name__)
 
 
+
+async def fetch_many(db:AsyncSession,cache:EntityCache,field_set,ids:list,can_read):
+    # один MGET, один запрос WHERE id IN (...) для промахов и конвейерная запись промахов обратно в кэш
+    found=await cache.get_many(ids)
+    missing=[obj_id for obj_id in ids if obj_id not in found]
+    if missing:
+        model=field_set.model
+        async with fill_session(db) as fill_db:
+            result=await fill_db.execute(select(model).options(*field_set.full.options()).where(model.id.in_(missing)))
+            loaded={obj.id:field_set.cache_entry(obj) for obj in result.scalars().all()}
+        await cache.set_many(loaded)
+        found.update(loaded)
+    batch={'items':[],'not_found':[],'forbidden':[]}
+    for obj_id in ids:
+        entry=found.get(obj_id)
+        if entry is None:
+            batch['not_found'].append(obj_id)
+            continue
+        meta,payload=unpack_entry(entry)
+        if not can_read(SimpleNamespace(**meta)):
+            batch['forbidden'].append(obj_id)
+        else:
+            batch['items'].append(payload)
+    return batch
+
+def unnest_rows(**columns):
+    # по массиву на колонку вместо VALUES: 10k строк — пять параметров, а не 50k (asyncpg не примет больше 32767)
+    arrays=[literal(values,ARRAY(type_)) for values,type_ in columns.values()]
+    return func.unnest(*arrays).table_valued(*[column(name,type_) for name,(values,type_) in columns.items()]).render_derived()
+
+def id_array(ids):
+    return literal(list(ids),ARRAY(Integer))
+
+def entity_keys(prefix:str,ids):
+    return [f'{prefix}:{obj_id}' for obj_id in ids if obj_id is not None]
+
+async def missing_references(db:AsyncSession,project_ids:set,user_ids:set):
+    # проекты и исполнители проверяются одним UNION ALL вместо запроса на каждую строку
+    query=select(literal('project').label('kind'),Project.id).where(Project.id == any_(id_array(project_ids))).union_all(
+        select(literal('user').label('kind'),User.id).where(User.id == any_(id_array(user_ids))))
+    found={'project':set(),'user':set()}
+    for kind,obj_id in (await db.execute(query)).all():
+        found[kind].add(obj_id)
+    return sorted(project_ids-found['project']),sorted(user_ids-found['user'])
+
 class AuthService:
-    def __init__(self,db:AsyncSession):
+    def __init__(self,db:AsyncSession,redis_conn=None):
         self.db = db
+        self.redis=redis_conn
 
     async def register_user(self, username: str, password: str, email: str):
         try:
-            # Существующие проверки
-            result = await self.db.execute(select(User).where(User.username == username))
-            user = result.scalars().first()
-            if user:
-                raise HTTPException(status_code=409, detail="User already exists")
-
-            result1 = await self.db.execute(select(User).where(User.email == email))
-            user1 = result1.scalars().first()
-            if user1:
-                raise HTTPException(status_code=409, detail="User already exists")
-
-            # Создание пользователя
-            hashed_password = Utils.password_hash(password)
-            new_user = User(
-                username=username,
-                email=email,
-                hashed_password=hashed_password,
-                role='user'
+            hashed_password = await Utils.password_hash_async(password)
+            # проверка уникальности и вставка — одна команда; гонки за имя разруливают уникальные индексы
+            result = await self.db.execute(
+                insert(User)
+                .values(username=username, email=email, hashed_password=hashed_password, role='user')
+                .on_conflict_do_nothing()
+                .returning(User.id, User.username, User.email, User.role, User.created_at)
             )
-            self.db.add(new_user)
+            new_user = result.mappings().first()
+            if new_user is None:
+                raise HTTPException(status_code=409, detail="User already exists")
             await self.db.commit()
-            await self.db.refresh(new_user)
-            return new_user
-
-        except Exception as e:
-            print(f"DEBUG Ошибка в register_user: {e}")  # Вывод в консоль
+        except HTTPException:
+            await self.db.rollback()
+            raise
+        except Exception:
+            logger.exception("Failed to register user %s",username)
             await self.db.rollback()
             raise HTTPException(status_code=500, detail="Internal server error")
+        if self.redis is not None:
+            await add_user_values(self.redis,{'username':username,'email':email})
+        return dict(new_user)
+
+    async def availability(self,values:dict):
+        # «точно свободно» отвечает фильтр; «возможно занято» и несобранный фильтр перепроверяются в БД
+        filters=user_filters(self.redis)
+        answer={}
+        for field,value in values.items():
+            if value is None:
+                continue
+            maybe_taken=await filters[field].might_contain(value)
+            if maybe_taken is False:
+                BLOOM_CHECKS.inc(field,'bloom_free')
+                answer[field]=True
+                continue
+            taken=(await self.db.execute(select(exists().where(getattr(User,field) == value)))).scalar()
+            BLOOM_CHECKS.inc(field,'db_taken' if taken else 'db_free')
+            answer[field]=not taken
+        return answer
+
     async def login_user(self,username:str,password:str):
         result=await self.db.execute(select(User).where(User.username==username))
         user=result.scalars().first()
-        if not user or not Utils.password_verify(password,user.hashed_password):
+        if not user or not await Utils.password_verify_async(password,user.hashed_password):
             raise HTTPException(status_code=409,detail="Incorrect password")
         return user
 class UserService(BaseService):
@@ -58,25 +127,62 @@ class UserService(BaseService):
         self.db = db
         self.redis=redis_conn
         self.policy=policy
-    async def get_all(self,user_filter:UserFilter):
-        result=select(User).options(selectinload(User.projects),selectinload(User.tasks),selectinload(User.refresh_tokens))
-        user=user_filter.filter(result)
-        return paginate(self.db,user)
-    async def get_by_id(self,user_id:int):
-        cache_key=f'user:{user_id}'
-        cache_user=await self.redis.get(cache_key)
+        self.cache=EntityCache(redis_conn,'user',required=USER_FIELDS.policy_fields)
+    async def get_all(self,user_filter:UserFilter,request,selection:FieldSelection=USER_FIELDS.cheap):
+        # version и updated_at грузятся всегда — из них строятся валидаторы страницы, в ответ они не попадают
+        rows=[]
+        def transform(items):
+            rows.extend(items)
+            return [selection.dump(item) for item in items]
+        result=select(User).options(*selection.options(User.version,User.updated_at))
+        page=await apaginate(self.db,user_filter.sort(user_filter.filter(result)),transformer=transform)
+        return page,page_validators(request,rows,page.total)
+    async def get_all_cursor(self,user_filter:UserFilter,params:CursorParams,request,selection:FieldSelection=USER_FIELDS.cheap):
+        result=select(User).options(*selection.options(User.version,User.updated_at))
+        page=await cursor_paginate(self.db,user_filter.filter(result),User,params)
+        validators=page_validators(request,page['items'],page['next_cursor'],page['prev_cursor'])
+        page['items']=[selection.dump(item) for item in page['items']]
+        return page,validators
+    async def load_cached(self,db:AsyncSession,user_id:int):
+        result=await db.execute(select(User).options(*USER_FIELDS.full.options()).where(User.id == user_id))
+        user=result.scalars().first()
+        if not user:
+            raise HTTPException(status_code=404,detail="User not found")
+        return USER_FIELDS.cache_entry(user)
+    def authorize_entry(self,entry:str):
+        meta,payload=unpack_entry(entry)
+        if not self.policy.can_read(SimpleNamespace(**meta)):
+            raise HTTPException(status_code=401,detail="Not authorized")
+        return meta,payload
+    async def get_by_id_raw(self,user_id:int):
+        return self.authorize_entry(await self.cache.get_or_load(user_id,self.load_cached,self.db))
+    async def get_by_id(self,user_id:int,selection:FieldSelection=USER_FIELDS.full):
+        if selection.is_full:
+            cache_user=await self.cache.get_or_load(user_id,self.load_cached,self.db)
+        else:
+            cache_user=await self.cache.get(user_id)
         if cache_user:
-            return json.loads(cache_user)
-        result=await self.db.execute(select(User).options(selectinload(User.projects),selectinload(User.tasks),selectinload(User.refresh_tokens)).where(User.id == user_id))
+            return selection.project(json.loads(self.authorize_entry(cache_user)[1]))
+        result=await self.db.execute(select(User).options(*selection.options()).where(User.id == user_id))
         user=result.scalars().first()
         if not user:
             raise HTTPException(status_code=404,detail="User not found")
         if not self.policy.can_read(user):
             raise HTTPException(status_code=401,detail="Not authorized")
-        user_data = UserOut.model_validate(user)
-        user_json=user_data.model_dump()
-        await self.redis.set(cache_key,user_data.model_dump_json(),ex=settings.REDIS_TIME)
-        return user_json
+        return selection.dump(user).model_dump()
+    async def get_many(self,user_ids:List[int]):
+        return await fetch_many(self.db,self.cache,USER_FIELDS,user_ids,self.policy.can_read)
+    async def task_stats(self,user_id:int):
+        # счётчики из user_task_stats вместо загрузки User.tasks; outer join отличает «нет задач» от «нет пользователя»
+        result=await self.db.execute(
+            select(User.id,UserTaskStats.status,UserTaskStats.count)
+            .outerjoin(UserTaskStats,UserTaskStats.user_id == User.id).where(User.id == user_id))
+        rows=result.all()
+        if not rows:
+            raise HTTPException(status_code=404,detail="User not found")
+        if not self.policy.can_read(SimpleNamespace(id=user_id)):
+            raise HTTPException(status_code=401,detail="Not authorized")
+        return {'id':user_id,**summarize((row.status,row.count) for row in rows)}
     async def update(self,user_id:int,user_update:UpdateUser):
         result=await self.db.execute(select(User).where(User.id == user_id))
         user=result.scalars().first()
@@ -87,13 +193,15 @@ class UserService(BaseService):
         if user_update.username is not None:
             user.username=user_update.username
         if user_update.password is not None:
-            user.hashed_password=Utils.password_hash(user_update.password)
+            user.hashed_password=await Utils.password_hash_async(user_update.password)
         if user_update.email is not None:
             user.email=user_update.email
         if user_update.created_at is not None:
             user.created_at=user_update.created_at
         await self.db.commit()
-        await self.redis.delete(f'user:{user_id}')
+        await self.cache.invalidate(user_id)
+        await invalidate_principal(self.redis,user_id)
+        await add_user_values(self.redis,{'username':user_update.username,'email':user_update.email})
         await self.db.refresh(user)
         return user
     async def delete(self,user_id:int):
@@ -103,9 +211,14 @@ class UserService(BaseService):
             raise HTTPException(status_code=404,detail="User not found")
         if not self.policy.can_delete(user):
             raise HTTPException(status_code=403,detail="Forbidden")
+        # проекты и задачи пользователя теряют owner_id/assignee_id, а эти поля лежат в кэше для политик
+        owned=await self.db.execute(select(literal('project'),Project.id).where(Project.owner_id == user_id)
+                                    .union_all(select(literal('task'),Task.id).where(Task.assignee_id == user_id)))
+        keys=[f'{entity}:{obj_id}' for entity,obj_id in owned.all()]
         await self.db.delete(user)
         await self.db.commit()
-        await self.redis.delete(f'user:{user_id}')
+        await invalidate_keys(self.redis,[self.cache.key(user_id)]+keys)
+        await invalidate_principal(self.redis,user_id)
         return user
 
 class ProjectService(BaseService, CreateService):
@@ -113,28 +226,66 @@ class ProjectService(BaseService, CreateService):
         self.db = db
         self.redis = redis_conn
         self.policy = policy
+        self.cache = EntityCache(redis_conn, 'project', required=PROJECT_FIELDS.policy_fields)
 
-    async def get_all(self, project_filter: ProjectFilter):
-        result = select(Project).options(joinedload(Project.owner), selectinload(Project.tasks))
-        project = project_filter.filter(result)
-        return paginate(self.db, project)
+    async def get_all(self, project_filter: ProjectFilter, selection: FieldSelection = PROJECT_FIELDS.cheap):
+        result = select(Project).options(*selection.options())
+        project = project_filter.sort(project_filter.filter(result))
+        return await apaginate(self.db, project, transformer=lambda items: [selection.dump(item) for item in items])
 
-    async def get_by_id(self, project_id: int):
-        cache_key = f'project:{project_id}'
-        cache_project = await self.redis.get(cache_key)
+    async def get_all_cursor(self, project_filter: ProjectFilter, params: CursorParams, selection: FieldSelection = PROJECT_FIELDS.cheap):
+        result = select(Project).options(*selection.options())
+        page = await cursor_paginate(self.db, project_filter.filter(result), Project, params)
+        page['items'] = [selection.dump(item) for item in page['items']]
+        return page
+
+    async def load_cached(self, db: AsyncSession, project_id: int):
+        result = await db.execute(
+            select(Project).options(*PROJECT_FIELDS.full.options()).where(Project.id == project_id))
+        project = result.scalars().first()
+        if not project:
+            raise HTTPException(status_code=404, detail="Project not found")
+        return PROJECT_FIELDS.cache_entry(project)
+
+    def authorize_entry(self, entry: str):
+        meta, payload = unpack_entry(entry)
+        if not self.policy.can_read(SimpleNamespace(**meta)):
+            raise HTTPException(status_code=403, detail="Forbidden")
+        return meta, payload
+
+    async def get_by_id_raw(self, project_id: int):
+        return self.authorize_entry(await self.cache.get_or_load(project_id, self.load_cached, self.db))
+
+    async def get_by_id(self, project_id: int, selection: FieldSelection = PROJECT_FIELDS.full):
+        if selection.is_full:
+            cache_project = await self.cache.get_or_load(project_id, self.load_cached, self.db)
+        else:
+            cache_project = await self.cache.get(project_id)
         if cache_project:
-            return json.loads(cache_project)
+            return selection.project(json.loads(self.authorize_entry(cache_project)[1]))
         result = await self.db.execute(
-            select(Project).options(joinedload(Project.owner), selectinload(Project.tasks)).where(
+            select(Project).options(*selection.options(Project.owner_id)).where(
                 Project.id == project_id))
         project = result.scalars().first()
         if not project:
             raise HTTPException(status_code=404, detail="Project not found")
         if not self.policy.can_read(project):
             raise HTTPException(status_code=403, detail="Forbidden")
-        project_data = ProjectOut.model_validate(project).model_dump_json()
-        await self.redis.set(cache_key, project_data, ex=settings.REDIS_TIME)
-        return project_data
+        return selection.dump(project).model_dump()
+
+    async def get_many(self, project_ids: List[int]):
+        return await fetch_many(self.db, self.cache, PROJECT_FIELDS, project_ids, self.policy.can_read)
+
+    async def task_stats(self, project_id: int):
+        result = await self.db.execute(
+            select(Project.owner_id, ProjectTaskStats.status, ProjectTaskStats.count)
+            .outerjoin(ProjectTaskStats, ProjectTaskStats.project_id == Project.id).where(Project.id == project_id))
+        rows = result.all()
+        if not rows:
+            raise HTTPException(status_code=404, detail="Project not found")
+        if not self.policy.can_read(SimpleNamespace(id=project_id, owner_id=rows[0].owner_id)):
+            raise HTTPException(status_code=403, detail="Forbidden")
+        return {'id': project_id, **summarize((row.status, row.count) for row in rows)}
 
     async def create(self, project_in: CreateProject):
         result = await self.db.execute(select(Project).where(Project.title == project_in.title))
@@ -146,9 +297,25 @@ class ProjectService(BaseService, CreateService):
         new_project = Project(title=project_in.title, owner_id=self.policy.user.id, created_at=project_in.created_at)
         self.db.add(new_project)
         await self.db.commit()
+        await invalidate_keys(self.redis, entity_keys('user', [self.policy.user.id]))
         await self.db.refresh(new_project)
         return new_project
 
+    async def create_many(self, projects_in: List[CreateProject]):
+        if not self.policy.can_create():
+            raise HTTPException(status_code=403, detail="Forbidden")
+        now = datetime.utcnow()
+        rows = unnest_rows(title=([p.title for p in projects_in], String),
+                           created_at=([p.created_at or now for p in projects_in], DateTime))
+        result = await self.db.execute(
+            insert(Project).from_select(['title', 'owner_id', 'created_at'],
+                                        select(rows.c.title, literal(self.policy.user.id), rows.c.created_at))
+            .returning(Project.id))
+        ids = list(result.scalars().all())
+        await self.db.commit()
+        await invalidate_keys(self.redis, entity_keys('user', [self.policy.user.id]))
+        return {'ids': ids}
+
     async def update(self, project_id: int, project_update: UpdateProject):
         result = await self.db.execute(select(Project).where(Project.id == project_id))
         project = result.scalars().first()
@@ -161,7 +328,7 @@ class ProjectService(BaseService, CreateService):
         if project_update.created_at is not None:
             project.created_at = project_update.created_at
         await self.db.commit()
-        await self.redis.delete(f'project:{project_id}')
+        await self.cache.invalidate(project_id)
         await self.db.refresh(project)
         return project
 
@@ -172,34 +339,60 @@ class ProjectService(BaseService, CreateService):
             raise HTTPException(status_code=404, detail="Project not found")
         if not self.policy.can_delete(project):
             raise HTTPException(status_code=403, detail="Forbidden")
+        # задачи уходят каскадом вместе с project_task_stats, а счётчики исполнителей вычитаем одним upsert'ом
+        removed = grouped_task_counts(Task.assignee_id, Task.project_id == project_id).subquery()
+        await self.db.execute(upsert_counts(UserTaskStats, 'user_id',
+                                            select(removed.c.assignee_id, removed.c.status, -removed.c['count'])))
+        task_ids = (await self.db.execute(select(Task.id).where(Task.project_id == project_id))).scalars().all()
         await self.db.delete(project)
         await self.db.commit()
-        await self.redis.delete(f'project:{project_id}')
+        # проект и его задачи; владелец и исполнители снимаются по тегам этих ключей
+        await invalidate_keys(self.redis, [self.cache.key(project_id)] + entity_keys('task', task_ids))
         return project
 class TaskService(BaseService,CreateService):
     def __init__(self,db:AsyncSession,redis_conn,policy:BaseTaskPolicy):
         self.db = db
         self.redis=redis_conn
         self.policy=policy
-    async def get_all(self,task_filter:TaskFilter):
-        result=select(Task).options(joinedload(Task.assignee),joinedload(Task.project))
-        task=task_filter.filter(result)
-        return paginate(self.db,task)
-    async def get_by_id(self,task_id:int):
-        cache_key=f'task:{task_id}'
-        cache_task=await self.redis.get(cache_key)
+        self.cache=EntityCache(redis_conn,'task',required=TASK_FIELDS.policy_fields)
+    async def get_all(self,task_filter:TaskFilter,selection:FieldSelection=TASK_FIELDS.cheap):
+        result=select(Task).options(*selection.options())
+        task=task_filter.sort(task_filter.filter(result))
+        return await apaginate(self.db,task,transformer=lambda items:[selection.dump(item) for item in items])
+    async def get_all_cursor(self,task_filter:TaskFilter,params:CursorParams,selection:FieldSelection=TASK_FIELDS.cheap):
+        result=select(Task).options(*selection.options())
+        page=await cursor_paginate(self.db,task_filter.filter(result),Task,params)
+        page['items']=[selection.dump(item) for item in page['items']]
+        return page
+    async def load_cached(self,db:AsyncSession,task_id:int):
+        result=await db.execute(select(Task).options(*TASK_FIELDS.full.options()).where(Task.id == task_id))
+        task=result.scalars().first()
+        if not task:
+            raise HTTPException(status_code=404,detail="Task not found")
+        return TASK_FIELDS.cache_entry(task)
+    def authorize_entry(self,entry:str):
+        meta,payload=unpack_entry(entry)
+        if not self.policy.can_read(SimpleNamespace(**meta)):
+            raise HTTPException(status_code=403,detail="Forbidden")
+        return meta,payload
+    async def get_by_id_raw(self,task_id:int):
+        return self.authorize_entry(await self.cache.get_or_load(task_id,self.load_cached,self.db))
+    async def get_by_id(self,task_id:int,selection:FieldSelection=TASK_FIELDS.full):
+        if selection.is_full:
+            cache_task=await self.cache.get_or_load(task_id,self.load_cached,self.db)
+        else:
+            cache_task=await self.cache.get(task_id)
         if cache_task:
-            return json.loads(cache_task)
-        result=await self.db.execute(select(Task).options(joinedload(Task.assignee),joinedload(Task.project)).where(Task.id == task_id))
+            return selection.project(json.loads(self.authorize_entry(cache_task)[1]))
+        result=await self.db.execute(select(Task).options(*selection.options(Task.assignee_id)).where(Task.id == task_id))
         task=result.scalars().first()
         if not task:
             raise HTTPException(status_code=404,detail="Task not found")
         if not self.policy.can_read(task):
             raise HTTPException(status_code=403,detail="Forbidden")
-        task_pydantic=TaskOut.model_validate(task)
-        task_data=task_pydantic.model_dump()
-        await self.redis.set(cache_key,task_pydantic.model_dump_json(),ex=settings.REDIS_TIME)
-        return task_data
+        return selection.dump(task).model_dump()
+    async def get_many(self,task_ids:List[int]):
+        return await fetch_many(self.db,self.cache,TASK_FIELDS,task_ids,self.policy.can_read)
     async def create(self,task_in:CreateTask):
         result=await self.db.execute(select(Task).where(Task.title == task_in.title))
         task=result.scalars().first()
@@ -215,11 +408,70 @@ class TaskService(BaseService,CreateService):
         user=result3.scalars().first()
         if not user:
             raise HTTPException(status_code=404,detail="User not found")
-        new_task=Task(title=task_in.title,project_id=task_in.project_id,assignee_id=task_in.assignee_id or self.policy.user.id,created_at=task_in.created_at)
+        new_task=Task(title=task_in.title,status=task_in.status,project_id=task_in.project_id,assignee_id=task_in.assignee_id or self.policy.user.id,created_at=task_in.created_at)
         self.db.add(new_task)
+        await apply_task_deltas(self.db,[(new_task.project_id,new_task.assignee_id,new_task.status,1)])
         await self.db.commit()
+        await invalidate_keys(self.redis,entity_keys('project',[new_task.project_id])+entity_keys('user',[new_task.assignee_id]))
         await self.db.refresh(new_task)
         return new_task
+    async def create_many(self,tasks_in:List[CreateTask]):
+        if not all(self.policy.can_create(task_in) for task_in in tasks_in):
+            raise HTTPException(status_code=403,detail="Forbidden")
+        titles=[task_in.title for task_in in tasks_in]
+        duplicates={title for title,count in Counter(titles).items() if count>1}
+        duplicates.update((await self.db.execute(select(Task.title).where(Task.title == any_(literal(titles,ARRAY(String)))))).scalars().all())
+        if duplicates:
+            raise HTTPException(status_code=409,detail=f"Tasks already exist: {', '.join(sorted(duplicates))}")
+        project_ids={task_in.project_id for task_in in tasks_in}
+        assignee_ids={task_in.assignee_id for task_in in tasks_in}
+        missing_projects,missing_users=await missing_references(self.db,project_ids,assignee_ids)
+        if missing_projects or missing_users:
+            raise HTTPException(status_code=404,detail={'projects':missing_projects,'users':missing_users})
+        now=datetime.utcnow()
+        rows=unnest_rows(
+            title=(titles,String),
+            status=([task_in.status for task_in in tasks_in],String),
+            project_id=([task_in.project_id for task_in in tasks_in],Integer),
+            assignee_id=([task_in.assignee_id for task_in in tasks_in],Integer),
+            created_at=([task_in.created_at or now for task_in in tasks_in],DateTime),
+        )
+        columns=['title','status','project_id','assignee_id','created_at']
+        result=await self.db.execute(insert(Task).from_select(columns,select(*[rows.c[name] for name in columns])).returning(Task.id))
+        ids=list(result.scalars().all())
+        await apply_task_deltas(self.db,[(task_in.project_id,task_in.assignee_id,task_in.status,1) for task_in in tasks_in])
+        await self.db.commit()
+        await invalidate_keys(self.redis,entity_keys('project',project_ids)+entity_keys('user',assignee_ids))
+        return {'ids':ids}
+    async def update_many(self,task_ids:List[int],**values):
+        # права проверяем до UPDATE, как в create_many: иначе отказ приходит после блокировки до 10k строк.
+        # TaskPolicy.can_update смотрит только на роль, поэтому строки для проверки не нужны
+        if not all(self.policy.can_update(SimpleNamespace(id=task_id)) for task_id in task_ids):
+            raise HTTPException(status_code=403,detail="Forbidden")
+        # прежние статус и исполнитель нужны счётчикам и инвалидации — берём их из того же UPDATE через подзапрос
+        previous=(select(Task.id,Task.status,Task.assignee_id).where(Task.id == any_(id_array(task_ids)))
+                  .with_for_update().subquery('previous'))
+        statement=(update(Task).where(Task.id == previous.c.id).values(**values,version=Task.version+1)
+                   .returning(Task.id,Task.project_id,Task.status,Task.assignee_id,
+                              previous.c.status.label('previous_status'),previous.c.assignee_id.label('previous_assignee_id')))
+        rows=(await self.db.execute(statement.execution_options(synchronize_session=False))).all()
+        changes=[]
+        for row in rows:
+            changes.append((row.project_id,row.previous_assignee_id,row.previous_status,-1))
+            changes.append((row.project_id,row.assignee_id,row.status,1))
+        await apply_task_deltas(self.db,changes)
+        await self.db.commit()
+        ids=[row.id for row in rows]
+        users={row.assignee_id for row in rows}|{row.previous_assignee_id for row in rows}
+        await invalidate_keys(self.redis,entity_keys('task',ids)+entity_keys('project',{row.project_id for row in rows})+entity_keys('user',users))
+        found=set(ids)
+        return {'ids':ids,'not_found':[task_id for task_id in dict.fromkeys(task_ids) if task_id not in found]}
+    async def update_status_many(self,task_ids:List[int],status:str):
+        return await self.update_many(task_ids,status=status)
+    async def reassign_many(self,task_ids:List[int],assignee_id:int):
+        if (await self.db.execute(select(User.id).where(User.id == assignee_id))).scalar() is None:
+            raise HTTPException(status_code=404,detail="User not found")
+        return await self.update_many(task_ids,assignee_id=assignee_id)
     async def update(self,task_id:int,task_in:UpdateTask):
         result=await self.db.execute(select(Task).where(Task.id == task_id))
         task=result.scalars().first()
@@ -229,10 +481,13 @@ class TaskService(BaseService,CreateService):
             raise HTTPException(status_code=403,detail="Forbidden")
         if task_in.title is not None:
             task.title=task_in.title
+        if task_in.status is not None and task_in.status!=task.status:
+            await apply_task_deltas(self.db,[(task.project_id,task.assignee_id,task.status,-1),(task.project_id,task.assignee_id,task_in.status,1)])
+            task.status=task_in.status
         if task_in.created_at is not None:
             task.created_at=task_in.created_at
         await self.db.commit()
-        await self.redis.delete(f'task:{task_id}')
+        await self.cache.invalidate(task_id)
         await self.db.refresh(task)
         return task
     async def delete(self,task_id:int):
@@ -242,7 +497,8 @@ class TaskService(BaseService,CreateService):
             raise HTTPException(status_code=404,detail="Task not found")
         if not self.policy.can_delete(task):
             raise HTTPException(status_code=403,detail="Forbidden")
+        await apply_task_deltas(self.db,[(task.project_id,task.assignee_id,task.status,-1)])
         await self.db.delete(task)
         await self.db.commit()
-        await self.redis.delete(f'task:{task_id}')
+        await self.cache.invalidate(task_id)
         return task
\ No newline at end of file
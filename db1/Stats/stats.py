@@ -0,0 +1,121 @@
+import asyncio
+import logging
+import time
+from collections import Counter
+from sqlalchemy import select,delete,func,literal,column,and_,any_,text,Integer,String,BigInteger
+from sqlalchemy.dialects.postgresql import insert,ARRAY
+from sqlalchemy.ext.asyncio import AsyncSession
+from config import settings
+from db1.Database.database import async_factory
+from db1.Maintenance.sweeper import LeaderLease
+from db1.Metrics.metrics import REGISTRY
+from db1.models.Base1 import Task,ProjectTaskStats,UserTaskStats
+
+logger=logging.getLogger(__name__)
+
+STATS_DRIFT=REGISTRY.counter('task_stats_drift_total','Entities whose task status counters were repaired by reconciliation',('table',))
+RECONCILE_DURATION=REGISTRY.histogram('task_stats_reconcile_seconds','Duration of one task stats reconciliation',buckets=(0.1,0.5,1.0,5.0,10.0,30.0,60.0,300.0))
+
+# таблица счётчиков -> (её ключ, колонка Task, по которой считаем)
+STATS_TABLES={
+    ProjectTaskStats:('project_id',Task.project_id),
+    UserTaskStats:('user_id',Task.assignee_id),
+}
+
+
+def upsert_counts(table,key:str,source):
+    # source отдаёт (key, status, delta); счётчик сдвигается на delta в той же транзакции, что и запись в tasks
+    statement=insert(table).from_select([key,'status','count'],source)
+    return statement.on_conflict_do_update(index_elements=[key,'status'],set_={'count':table.count+statement.excluded.count})
+
+def task_deltas(changes):
+    # changes: (project_id, assignee_id, status, delta) на каждую затронутую задачу
+    deltas={table:Counter() for table in STATS_TABLES}
+    for project_id,assignee_id,status,delta in changes:
+        if status is None:
+            continue
+        if project_id is not None:
+            deltas[ProjectTaskStats][project_id,status]+=delta
+        if assignee_id is not None:
+            deltas[UserTaskStats][assignee_id,status]+=delta
+    return deltas
+
+async def apply_task_deltas(db:AsyncSession,changes):
+    for table,counts in task_deltas(changes).items():
+        # нулевые сдвиги не пишем; сортировка задаёт один порядок блокировок строк для параллельных bulk-операций
+        rows=sorted((obj_id,status,delta) for (obj_id,status),delta in counts.items() if delta)
+        if not rows:
+            continue
+        key=STATS_TABLES[table][0]
+        ids,statuses,amounts=zip(*rows)
+        source=func.unnest(literal(list(ids),ARRAY(Integer)),literal(list(statuses),ARRAY(String)),literal(list(amounts),ARRAY(BigInteger)))\
+            .table_valued(column(key,Integer),column('status',String),column('delta',BigInteger)).render_derived()
+        await db.execute(upsert_counts(table,key,select(source.c[key],source.c.status,source.c.delta)))
+
+def grouped_task_counts(group_column,*criteria):
+    return (select(group_column,Task.status,func.count().label('count'))
+            .where(group_column.is_not(None),Task.status.is_not(None),*criteria)
+            .group_by(group_column,Task.status))
+
+def summarize(rows):
+    # rows: (status, count) из таблицы счётчиков; outer join даёт (None, None) для сущности без задач
+    counts={status:count for status,count in rows if status is not None and count}
+    return {'counts':counts,'total':sum(counts.values())}
+
+def drifted_keys(table,ids=None):
+    # ключи сущностей, у которых хоть один счётчик расходится с GROUP BY по tasks; ids сужает обе стороны
+    key,group_column=STATS_TABLES[table]
+    stored=getattr(table,key)
+    actual=grouped_task_counts(group_column,*([group_column == any_(ids)] if ids is not None else [])).cte('actual')
+    counters=select(table).where(*([stored == any_(ids)] if ids is not None else [])).cte('counters')
+    joined=actual.join(counters,and_(actual.c[group_column.key] == counters.c[key],actual.c.status == counters.c.status),full=True)
+    return (select(func.coalesce(actual.c[group_column.key],counters.c[key])).distinct().select_from(joined)
+            .where(func.coalesce(actual.c['count'],0) != func.coalesce(counters.c['count'],0)))
+
+async def reconcile_table(db:AsyncSession,table):
+    key,group_column=STATS_TABLES[table]
+    # полный GROUP BY — без блокировки, сервисы продолжают писать; расхождение может оказаться транзакцией в полёте,
+    # поэтому найденные ключи перепроверяются и пересчитываются уже под блокировкой
+    candidates=sorted((await db.execute(drifted_keys(table))).scalars().all())
+    if not candidates:
+        await db.commit()
+        return 0
+    # SHARE ROW EXCLUSIVE конфликтует с ROW EXCLUSIVE upsert'ов: пока идёт пересчёт, сервисы ждут, а транзакции,
+    # уже сдвинувшие счётчики, успевают закоммититься до того, как мы прочитаем tasks
+    await db.execute(text(f'LOCK TABLE {table.__tablename__} IN SHARE ROW EXCLUSIVE MODE'))
+    ids=literal(candidates,ARRAY(Integer))
+    drifted=(await db.execute(drifted_keys(table,ids))).scalars().all()
+    if drifted:
+        ids=literal(sorted(drifted),ARRAY(Integer))
+        await db.execute(delete(table).where(getattr(table,key) == any_(ids)))
+        await db.execute(insert(table).from_select([key,'status','count'],grouped_task_counts(group_column,group_column == any_(ids))))
+    await db.commit()
+    return len(drifted)
+
+class TaskStatsReconciler:
+    def __init__(self,redis_conn):
+        self.lease=LeaderLease(redis_conn,'task-stats-reconciler',int(settings.TASK_STATS_RECONCILE_INTERVAL*2000))
+    async def reconcile(self):
+        start=time.perf_counter()
+        repaired={}
+        try:
+            for table in STATS_TABLES:
+                async with async_factory() as db:
+                    drift=await reconcile_table(db,table)
+                STATS_DRIFT.inc(table.__tablename__,amount=drift)
+                repaired[table.__tablename__]=drift
+        finally:
+            RECONCILE_DURATION.observe(time.perf_counter()-start)
+        if any(repaired.values()):
+            logger.warning("Task stats drift repaired: %s",repaired)
+        return repaired
+    async def run(self):
+        while True:
+            try:
+                if await self.lease.acquire():
+                    await self.reconcile()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Task stats reconciliation failed")
+            await asyncio.sleep(settings.TASK_STATS_RECONCILE_INTERVAL)
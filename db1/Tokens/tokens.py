@@ -1,3 +1,5 @@
+import logging
+import uuid
 from sqlalchemy.ext.asyncio import AsyncSession
 from config import settings
 from datetime import datetime,timedelta
@@ -5,8 +7,15 @@ from jose import jwt,JWTError
 from db1.models.Base1 import RefreshTokenDB,User
 from db1.Security.security import Utils,oauth2_scheme
 from fastapi import HTTPException, Depends
-from sqlalchemy import select
-from db1.Database.database import get_db
+from sqlalchemy import select,delete,insert,update,literal,DateTime,String
+from db1.Database.database import get_lazy_db
+from db1.Cache.cache import EntityCache,get_redis
+from db1.PydanticModels.Pydantic import Principal
+from db1.Metrics.metrics import REGISTRY
+
+logger=logging.getLogger(__name__)
+
+REFRESH_REPLAYS=REGISTRY.counter('refresh_token_replays_total','Retired refresh tokens presented again; all of the user\'s tokens were revoked')
 
 
 
@@ -14,30 +23,95 @@ def create_access_token(user_id:int,role:str):
     payload = {'sub':str(user_id),'role':role,'type':'access','exp':datetime.utcnow()+timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES) }
     return jwt.encode(payload,settings.SECRET_KEY,algorithm=settings.ALGORITHM)
 def create_refresh_token(user_id:int,role:str):
-    payload={'sub':str(user_id),'role':role,'type':'refresh','exp':datetime.utcnow()+timedelta(days=settings.REFRESH_TOKEN_EXPIRE_DAYS)}
+    # jti: два токена, выданные в одну секунду, иначе совпадут вместе с digest
+    payload={'sub':str(user_id),'role':role,'type':'refresh','jti':uuid.uuid4().hex,'exp':datetime.utcnow()+timedelta(days=settings.REFRESH_TOKEN_EXPIRE_DAYS)}
     return jwt.encode(payload,settings.SECRET_KEY,algorithm=settings.ALGORITHM)
-async def save_refresh_token(db:AsyncSession,user_id:int,refresh_token:str):
-    hashed_refresh=Utils.password_hash(refresh_token)
-    db_token=RefreshTokenDB(user_id=user_id,token=hashed_refresh,expires_at=datetime.utcnow()+timedelta(days=settings.REFRESH_TOKEN_EXPIRE_DAYS))
-    db.add(db_token)
+def refresh_token_expiry():
+    return datetime.utcnow()+timedelta(days=settings.REFRESH_TOKEN_EXPIRE_DAYS)
+async def invalidate_user_entry(redis_conn,user_id:int):
+    # UserOut в кэше вкладывает refresh_tokens (и ETag считается по ним): выпуск, ротация и удаление токена снимают запись
+    await EntityCache(redis_conn,'user').invalidate(user_id)
+async def save_refresh_token(db:AsyncSession,redis_conn,user_id:int,refresh_token:str):
+    # вставка и commit без refresh(): вызывающим не нужна перечитанная строка
+    await db.execute(insert(RefreshTokenDB).values(user_id=user_id,token_digest=Utils.token_digest(refresh_token),expires_at=refresh_token_expiry()))
+    await db.commit()
+    await invalidate_user_entry(redis_conn,user_id)
+def rotation_statement(user_id:int,refresh_token:str,new_refresh_token:str):
+    # одна команда: DELETE старого токена, INSERT нового только если старый нашёлся, и роль для access-токена
+    retired=(delete(RefreshTokenDB)
+         .where(RefreshTokenDB.token_digest == Utils.token_digest(refresh_token),RefreshTokenDB.user_id == user_id,
+                RefreshTokenDB.expires_at > datetime.utcnow())
+         .returning(RefreshTokenDB.user_id)
+         .cte('retired'))
+    issued=(insert(RefreshTokenDB)
+            .from_select(['user_id','token_digest','expires_at'],
+                         select(retired.c.user_id,literal(Utils.token_digest(new_refresh_token),String),literal(refresh_token_expiry(),DateTime)))
+            .returning(RefreshTokenDB.user_id)
+            .cte('issued'))
+    return select(User.role).join(issued,issued.c.user_id == User.id)
+async def revoke_refresh_tokens(db:AsyncSession,redis_conn,user_id:int):
+    await db.execute(delete(RefreshTokenDB).where(RefreshTokenDB.user_id == user_id).execution_options(synchronize_session=False))
+    await db.commit()
+    await invalidate_principal(redis_conn,user_id)
+    await invalidate_user_entry(redis_conn,user_id)
+async def rotate_refresh_token(db:AsyncSession,redis_conn,user_id:int,refresh_token:str,new_refresh_token:str):
+    user_id=int(user_id)
+    role=(await db.execute(rotation_statement(user_id,refresh_token,new_refresh_token))).scalar()
+    if role is None:
+        legacy=await find_legacy_refresh_token(db,user_id,refresh_token)
+        if legacy is None:
+            # подпись и срок валидны, а строки нет: токен уже ротирован или отозван — считаем утечкой и гасим все сессии
+            await db.rollback()
+            REFRESH_REPLAYS.inc()
+            logger.warning("Refresh token replay for user %s, revoking all refresh tokens",user_id)
+            await revoke_refresh_tokens(db,redis_conn,user_id)
+            raise HTTPException(status_code=401,detail="Refresh token reuse detected")
+        await db.delete(legacy)
+        await db.execute(insert(RefreshTokenDB).values(user_id=user_id,token_digest=Utils.token_digest(new_refresh_token),expires_at=refresh_token_expiry()))
+        role=(await db.execute(select(User.role).where(User.id == user_id))).scalar()
+    await db.commit()
+    await invalidate_user_entry(redis_conn,user_id)
+    return role
+async def issue_rotated_tokens(db:AsyncSession,redis_conn,user_id:int,refresh_token:str):
+    # роль для нового refresh-токена — текущая (принципал сбрасывается при смене роли), а не из старого токена,
+    # иначе смена роли переживала бы всю цепочку ротаций. Если ротация вернула из БД другую роль,
+    # перевыпускаем токен и подменяем digest только что вставленной строки
+    user_id=int(user_id)
+    minted_role=(await load_principal(db,redis_conn,user_id)).role
+    new_refresh=create_refresh_token(user_id,minted_role)
+    role=await rotate_refresh_token(db,redis_conn,user_id,refresh_token,new_refresh)
+    if role!=minted_role:
+        corrected=create_refresh_token(user_id,role)
+        await db.execute(update(RefreshTokenDB).where(RefreshTokenDB.token_digest == Utils.token_digest(new_refresh))
+                         .values(token_digest=Utils.token_digest(corrected)).execution_options(synchronize_session=False))
+        await db.commit()
+        new_refresh=corrected
+    return create_access_token(user_id,role),new_refresh
+async def find_legacy_refresh_token(db:AsyncSession,user_id:int,refresh_token:str):
+    # строки, сохранённые до перехода на HMAC, хранят argon2-хеш; при совпадении переводим их на digest
+    if not settings.REFRESH_TOKEN_LEGACY_FALLBACK:
+        return None
+    result=await db.execute(select(RefreshTokenDB).where(RefreshTokenDB.user_id == user_id,RefreshTokenDB.token_digest.is_(None)))
+    for token1 in result.scalars().all():
+        if await Utils.password_verify_async(refresh_token,token1.token):
+            token1.token_digest=Utils.token_digest(refresh_token)
+            token1.token=None
+            return token1
+    return None
+async def delete_refresh_token(db:AsyncSession,redis_conn,user_id:int,refresh_token:str):
+    user_id=int(user_id)
+    result=await db.execute(
+        delete(RefreshTokenDB)
+        .where(RefreshTokenDB.token_digest == Utils.token_digest(refresh_token),RefreshTokenDB.user_id == user_id)
+        .returning(RefreshTokenDB.id)
+        .execution_options(synchronize_session=False))
+    if result.first() is None:
+        legacy=await find_legacy_refresh_token(db,user_id,refresh_token)
+        if not legacy:
+            raise HTTPException(status_code=404,detail="Refresh Token Not Found")
+        await db.delete(legacy)
     await db.commit()
-    await db.refresh(db_token)
-    return db_token
-async def delete_refresh_token(db:AsyncSession,user_id:int,refresh_token:str):
-    result=await db.execute(select(RefreshTokenDB).where(RefreshTokenDB.user_id == user_id))
-    user=result.scalars().all()
-    for token1 in user:
-        if Utils.password_verify(refresh_token,token1.token):
-           await db.delete(token1)
-           await db.commit()
-           return token1
-    raise HTTPException(status_code=404,detail="Refresh Token Not Found")
-async def validate_refresh_token(db:AsyncSession,user_id:int,refresh_token:str):
-    result=await db.execute(select(RefreshTokenDB).where(RefreshTokenDB.user_id == user_id))
-    user=result.scalars().first()
-    if not user or not Utils.password_verify(refresh_token,user.token):
-        raise HTTPException(status_code=404,detail="Refresh Token Not Found")
-    return user
+    await invalidate_user_entry(redis_conn,user_id)
 def decode_token(token:str):
     try:
         payload=jwt.decode(token,settings.SECRET_KEY,algorithms=[settings.ALGORITHM])
@@ -46,7 +120,24 @@ def decode_token(token:str):
         return payload
     except JWTError:
         raise HTTPException(status_code=404,detail="Token is invalid")
-async def get_current_user(token:str=Depends(oauth2_scheme),db:AsyncSession=Depends(get_db)):
+def principal_cache(redis_conn):
+    return EntityCache(redis_conn,'principal',ttl=settings.ACCESS_TOKEN_EXPIRE_MINUTES*60,stale=0)
+async def invalidate_principal(redis_conn,user_id:int):
+    await principal_cache(redis_conn).invalidate(user_id)
+    await redis_conn.set(f'principal:revoked:{user_id}',1,ex=settings.ACCESS_TOKEN_EXPIRE_MINUTES*60)
+async def load_principal(db:AsyncSession,redis_conn,user_id:int):
+    cache=principal_cache(redis_conn)
+    cached=await cache.get(user_id)
+    if cached:
+        return Principal.model_validate_json(cached)
+    result=await db.execute(select(User.id,User.role).where(User.id == user_id))
+    row=result.first()
+    if not row:
+        raise HTTPException(status_code=404,detail="Token is invalid")
+    principal=Principal(id=row.id,role=row.role)
+    await cache.set(user_id,principal.model_dump_json())
+    return principal
+async def get_current_user(token:str=Depends(oauth2_scheme),db:AsyncSession=Depends(get_lazy_db),redis_conn=Depends(get_redis)):
     try:
         payload=decode_token(token)
         user_id=payload['sub']
@@ -54,14 +145,25 @@ async def get_current_user(token:str=Depends(oauth2_scheme),db:AsyncSession=Depe
             raise HTTPException(status_code=404,detail="Token is invalid")
         if payload['type'] != 'access':
             raise HTTPException(status_code=404,detail="Token is invalid")
-        result=await db.execute(select(User).where(User.id == user_id))
-        user=result.scalars().first()
-        if not user:
-            raise HTTPException(status_code=404,detail="Token is invalid")
-        return user
-    except JWTError:
+        user_id=int(user_id)
+        if settings.TRUST_TOKEN_CLAIMS and not await redis_conn.exists(f'principal:revoked:{user_id}'):
+            return Principal(id=user_id,role=payload['role'])
+        return await load_principal(db,redis_conn,user_id)
+    except (JWTError,KeyError,ValueError):
         raise HTTPException(status_code=404,detail="Token is invalid")
-async def require_admin(current_user:User=Depends(get_current_user)):
+async def token_is_admin(redis_conn,authorization:str):
+    # проверка для middleware без обращения к БД: роль из claims, но с учётом отзыва принципала
+    scheme,_,token=(authorization or '').partition(' ')
+    if scheme.lower()!='bearer' or not token:
+        return False
+    try:
+        payload=decode_token(token)
+    except HTTPException:
+        return False
+    if payload.get('type')!='access' or payload.get('role')!='admin':
+        return False
+    return not await redis_conn.exists(f"principal:revoked:{payload['sub']}")
+async def require_admin(current_user:Principal=Depends(get_current_user)):
     if current_user.role != "admin":
         raise HTTPException(status_code=403,detail="You are not an admin")
     return current_user
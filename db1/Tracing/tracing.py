@@ -0,0 +1,130 @@
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Dict
+from config import settings
+from db1.Metrics.metrics import REGISTRY
+
+logger=logging.getLogger(__name__)
+
+TRACES_KEPT=REGISTRY.counter('sentry_transactions_kept_total','Transactions sent to Sentry',('reason',))
+TRACES_DROPPED=REGISTRY.counter('sentry_transactions_dropped_total','Transactions dropped by tail sampling',('reason',))
+SERVER_ERROR_STATUSES={'internal_error','unknown_error','unavailable','deadline_exceeded','data_loss','unimplemented'}
+
+
+class TokenBucket:
+    def __init__(self,rate:float,capacity:float=None):
+        self.rate=rate
+        self.capacity=capacity if capacity is not None else max(rate,1.0)
+        self.tokens=self.capacity
+        self.updated=time.monotonic()
+    def take(self,amount:float=1.0):
+        now=time.monotonic()
+        self.tokens=min(self.capacity,self.tokens+(now-self.updated)*self.rate)
+        self.updated=now
+        if self.tokens<amount:
+            return False
+        self.tokens-=amount
+        return True
+
+def _seconds(value):
+    if isinstance(value,datetime):
+        return value.timestamp()
+    if isinstance(value,str):
+        return datetime.fromisoformat(value.replace('Z','+00:00')).timestamp()
+    return float(value)
+
+class AdaptiveSampler:
+    # решение принимается в конце транзакции, когда известны статус и длительность: ошибки и медленные запросы
+    # сохраняются всегда, остальные — с частотой маршрута в пределах бюджета в секунду. Поэтому голова записывает
+    # с head_rate (по умолчанию всё): при 5% в голове 95% ошибок отбросились бы раньше, чем их можно распознать
+    def __init__(self,default_rate:float,route_rates:Dict[str,float],slow_seconds:float,budget_per_second:float,head_rate:float=1.0):
+        self.default_rate=default_rate
+        self.route_rates=route_rates
+        self.slow_seconds=slow_seconds
+        self.budget=TokenBucket(budget_per_second)
+        self.head_rate=head_rate
+    def rate(self,route:str):
+        return self.route_rates.get(route,self.default_rate)
+    def traces_sampler(self,sampling_context:dict):
+        # в начале ASGI-транзакции имя — сырой URL (/users/5), шаблон маршрута ещё не известен; отсечь здесь можно
+        # только статические маршруты с частотой 0 (/metrics), частота по шаблону применяется в before_send_transaction
+        name=(sampling_context.get('transaction_context') or {}).get('name')
+        return 0.0 if name in self.route_rates and self.route_rates[name]<=0 else self.head_rate
+    def reason(self,event:dict):
+        status=event.get('contexts',{}).get('trace',{}).get('status')
+        if status in SERVER_ERROR_STATUSES:
+            return 'error'
+        try:
+            duration=_seconds(event['timestamp'])-_seconds(event['start_timestamp'])
+        except (KeyError,TypeError,ValueError):
+            duration=0.0
+        if duration>=self.slow_seconds:
+            return 'slow'
+        return None
+    def before_send_transaction(self,event:dict,hint:dict):
+        reason=self.reason(event)
+        if reason is not None:
+            # ошибки и медленные запросы не отбрасываются, но расходуют бюджет наравне с остальными
+            self.budget.take()
+            TRACES_KEPT.inc(reason)
+            return event
+        # к этому моменту event['transaction'] — шаблон маршрута (/users/{user_id})
+        if random.random()>=self.rate(event.get('transaction')):
+            TRACES_DROPPED.inc('rate')
+            return None
+        if not self.budget.take():
+            TRACES_DROPPED.inc('budget')
+            return None
+        TRACES_KEPT.inc('rate')
+        return event
+
+sampler=AdaptiveSampler(settings.SENTRY_TRACE_RATE,settings.SENTRY_ROUTE_TRACE_RATES,
+                        settings.SENTRY_SLOW_REQUEST_SECONDS,settings.SENTRY_TRACE_BUDGET_PER_SECOND,settings.SENTRY_HEAD_TRACE_RATE)
+
+
+class StackSampler:
+    # локальный сэмплирующий профайлер: раз в interval снимает стек потока event loop
+    # и пишет свёрнутые стеки (формат flamegraph.pl / speedscope). Стеки соседних запросов в том же loop тоже попадут в профиль.
+    _busy=threading.Lock()
+    def __init__(self,interval:float,thread_id:int=None):
+        self.interval=interval
+        self.thread_id=thread_id if thread_id is not None else threading.get_ident()
+        self.stacks=Counter()
+        self._stop=threading.Event()
+        self._thread=threading.Thread(target=self._run,name='stack-sampler',daemon=True)
+    def start(self):
+        if not StackSampler._busy.acquire(blocking=False):
+            return False
+        self._thread.start()
+        return True
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        StackSampler._busy.release()
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame=sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[self.fold(frame)]+=1
+    @staticmethod
+    def fold(frame):
+        names=[]
+        while frame is not None:
+            code=frame.f_code
+            names.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+            frame=frame.f_back
+        return ';'.join(reversed(names))
+    def write(self,name:str):
+        os.makedirs(settings.PROFILE_DIR,exist_ok=True)
+        path=os.path.join(settings.PROFILE_DIR,f'{name}.folded')
+        with open(path,'w') as f:
+            for stack,count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+        logger.info("Profile written to %s (%d samples)",path,sum(self.stacks.values()))
+        return path
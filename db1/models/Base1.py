@@ -1,5 +1,5 @@
 from sqlalchemy.orm import declarative_base,relationship
-from sqlalchemy import Column, Integer, String, ForeignKey,Index,DateTime
+from sqlalchemy import Column, Integer, String, ForeignKey,Index,DateTime,BigInteger,text
 from datetime import datetime
 
 
@@ -15,6 +15,8 @@ class User(Base):
     role = Column(String(20), default="user")
     phone = Column(String, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
+    version = Column(Integer, nullable=False, default=1, server_default="1")
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, server_default=text("timezone('utc', now())"))
     projects = relationship("Project", back_populates="owner")
     tasks = relationship("Task", back_populates="assignee")
     refresh_tokens = relationship(
@@ -22,7 +24,12 @@ class User(Base):
         back_populates="user",
         cascade="all, delete"
     )
-    __table_args__ = (Index('idx_username_email',"username","email"),)
+    __table_args__ = (
+        Index('idx_username_email',"username","email"),
+        Index('idx_username_trgm',"username",postgresql_using='gin',postgresql_ops={"username":"gin_trgm_ops"}),
+        Index('idx_email_trgm',"email",postgresql_using='gin',postgresql_ops={"email":"gin_trgm_ops"}),
+    )
+    __mapper_args__ = {"version_id_col": version}
 class Project(Base):
     __tablename__ = "projects"
 
@@ -30,13 +37,20 @@ class Project(Base):
     title = Column(String(255), nullable=False)
     owner_id = Column(Integer, ForeignKey("users.id"))
     created_at = Column(DateTime, default=datetime.utcnow)
+    version = Column(Integer, nullable=False, default=1, server_default="1")
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, server_default=text("timezone('utc', now())"))
     owner = relationship("User", back_populates="projects")
     tasks = relationship(
         "Task",
         back_populates="project",
         cascade="all, delete-orphan"
     )
-    __table_args__ = (Index('idx_title_owner_id',"title","owner_id"),)
+    __table_args__ = (
+        Index('idx_title_owner_id',"title","owner_id"),
+        Index('idx_owner_id_id',"owner_id","id"),
+        Index('idx_project_title_trgm',"title",postgresql_using='gin',postgresql_ops={"title":"gin_trgm_ops"}),
+    )
+    __mapper_args__ = {"version_id_col": version}
 class Task(Base):
     __tablename__ = "tasks"
 
@@ -46,14 +60,33 @@ class Task(Base):
     project_id = Column(Integer, ForeignKey("projects.id"))
     assignee_id = Column(Integer, ForeignKey("users.id"))
     created_at = Column(DateTime, default=datetime.utcnow)
+    version = Column(Integer, nullable=False, default=1, server_default="1")
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, server_default=text("timezone('utc', now())"))
     project = relationship("Project", back_populates="tasks")
     assignee = relationship("User", back_populates="tasks")
-    __table_args__ = (Index('idx_title',"title"),)
+    __table_args__ = (
+        Index('idx_title',"title"),
+        Index('idx_task_title_trgm',"title",postgresql_using='gin',postgresql_ops={"title":"gin_trgm_ops"}),
+    )
+    __mapper_args__ = {"version_id_col": version}
 class RefreshTokenDB(Base):
     __tablename__ = "refresh_tokens"
 
     id = Column(Integer, primary_key=True)
-    token = Column(String, nullable=False)
-    user_id = Column(Integer, ForeignKey("users.id"), unique=True)
-    expires_at = Column(DateTime, nullable=False)
-    user = relationship("User", back_populates="refresh_tokens")
\ No newline at end of file
+    token = Column(String, nullable=True)
+    token_digest = Column(String(64), unique=True, index=True, nullable=True)
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
+    expires_at = Column(DateTime, nullable=False, index=True)
+    user = relationship("User", back_populates="refresh_tokens")
+class ProjectTaskStats(Base):
+    __tablename__ = "project_task_stats"
+
+    project_id = Column(Integer, ForeignKey("projects.id", ondelete="CASCADE"), primary_key=True)
+    status = Column(String(50), primary_key=True)
+    count = Column(BigInteger, nullable=False, default=0)
+class UserTaskStats(Base):
+    __tablename__ = "user_task_stats"
+
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    status = Column(String(50), primary_key=True)
+    count = Column(BigInteger, nullable=False, default=0)
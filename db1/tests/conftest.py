@@ -0,0 +1,208 @@
+import pytest
+from datetime import datetime
+from contextlib import contextmanager
+from types import SimpleNamespace
+from sqlalchemy import create_engine,event
+from sqlalchemy.orm import Session
+from db1.Cache.cache import STORE_SCRIPT,PURGE_SCRIPT,RELEASE_LOCK_SCRIPT,local_cache as shared_local_cache
+from db1.Cache.bloom import ADD_SCRIPT
+from db1.Maintenance.sweeper import ACQUIRE_LEASE_SCRIPT
+from db1.Database.database import before_cursor_execute,after_cursor_execute,track_queries
+from db1.models.Base1 import Base,User,Project,Task,RefreshTokenDB
+
+
+class FakePipeline:
+    def __init__(self,redis_conn):
+        self.redis_conn=redis_conn
+        self.calls=[]
+    async def __aenter__(self):
+        return self
+    async def __aexit__(self,*exc):
+        return False
+    def __getattr__(self,name):
+        return lambda *args,**kwargs:self.calls.append((name,args,kwargs))
+    async def execute(self):
+        return [await getattr(self.redis_conn,name)(*args,**kwargs) for name,args,kwargs in self.calls]
+
+class FakeRedis:
+    # Lua-скрипты приложения эмулируются по одному методу на скрипт; неизвестный скрипт — ошибка теста
+    def __init__(self):
+        self.values={}
+        self.expires={}
+        self.scripts={STORE_SCRIPT:self.store_script,PURGE_SCRIPT:self.purge_script,RELEASE_LOCK_SCRIPT:self.release_lock_script,
+                    ACQUIRE_LEASE_SCRIPT:self.acquire_lease_script}
+    def pipeline(self,transaction=True):
+        return FakePipeline(self)
+    async def get(self,key):
+        return self.values.get(key)
+    async def mget(self,keys):
+        return [self.values.get(key) for key in keys]
+    async def exists(self,*keys):
+        return sum(key in self.values for key in keys)
+    async def pttl(self,key):
+        return self.expires.get(key,-1)
+    async def set(self,key,value,px=None,nx=False,ex=None):
+        if nx and key in self.values:
+            return None
+        self.values[key]=value
+        self.expires[key]=px if px is not None else -1
+        return True
+    async def eval(self,script,numkeys,*args):
+        return self.scripts[script](args[:numkeys],args[numkeys:])
+    def store_script(self,keys,argv):
+        if keys[1] in self.values:
+            return 0
+        self.values[keys[0]]=argv[0]
+        self.expires[keys[0]]=argv[1]
+        for tag in keys[2:]:
+            self.values.setdefault(tag,set()).add(keys[0])
+        return 1
+    def purge_script(self,keys,argv):
+        purged=[]
+        for key in keys:
+            purged+=[key,*sorted(self.values.pop(f'tags:{key}',()))]
+        for key in purged:
+            self.values.pop(key,None)
+            self.values[f'purged:{key}']='1'
+        return purged
+    def release_lock_script(self,keys,argv):
+        if self.values.get(keys[0])==argv[0]:
+            del self.values[keys[0]]
+            return 1
+        return 0
+    def acquire_lease_script(self,keys,argv):
+        if self.values.get(keys[0],argv[0])!=argv[0]:
+            return 0
+        self.values[keys[0]]=argv[0]
+        self.expires[keys[0]]=argv[1]
+        return 1
+    async def delete(self,*keys):
+        for key in keys:
+            self.values.pop(key,None)
+    async def publish(self,channel,message):
+        return 0
+    async def incrby(self,key,amount):
+        self.values[key]=int(self.values.get(key,0))+amount
+        return self.values[key]
+    async def incr(self,key):
+        return await self.incrby(key,1)
+    async def pexpire(self,key,ms):
+        self.expires[key]=ms
+        return True
+
+class FakeBitRedis(FakeRedis):
+    # битовые карты хранятся как множества установленных смещений
+    def __init__(self):
+        super().__init__()
+        self.scripts[ADD_SCRIPT]=self.add_script
+    def bitfield(self,key,args):
+        bits=self.values.get(key,set())
+        replies=[]
+        for i in range(0,len(args),3 if args[0]=='GET' else 4):
+            offset=args[i+2]
+            replies.append(int(offset in bits))
+            if args[i]=='SET':
+                bits.add(offset)
+                self.values[key]=bits
+        return replies
+    async def execute_command(self,command,key,*args):
+        return self.bitfield(key,args)
+    def add_script(self,keys,argv):
+        if keys[0] not in self.values:
+            return 0
+        self.bitfield(keys[0],argv)
+        return 1
+
+class ScriptedSession:
+    # отдаёт заранее заданные scalar() по очереди и запоминает выполненные выражения
+    def __init__(self,*scalars):
+        self.scalars=list(scalars)
+        self.statements=[]
+        self.commits=0
+    async def execute(self,statement):
+        self.statements.append(statement)
+        value=self.scalars.pop(0) if self.scalars else None
+        return SimpleNamespace(scalar=lambda:value,one=lambda:value,scalars=lambda:SimpleNamespace(all=lambda:value))
+    async def commit(self):
+        self.commits+=1
+    async def rollback(self):
+        pass
+
+class RowsSession(ScriptedSession):
+    # execute() отдаёт .all() с заданными строками — для UPDATE ... RETURNING
+    def __init__(self,rows=()):
+        super().__init__()
+        self.rows=list(rows)
+    async def execute(self,statement):
+        self.statements.append(statement)
+        return SimpleNamespace(all=lambda:self.rows)
+
+class SyncBackedSession:
+    # async-интерфейс поверх синхронной сессии SQLite: сервисы выполняют настоящий SQL без Postgres,
+    # а события курсора видит track_queries
+    replica=None
+    def __init__(self,session:Session):
+        self.session=session
+    async def execute(self,statement):
+        return self.session.execute(statement)
+    async def commit(self):
+        self.session.commit()
+    async def rollback(self):
+        self.session.rollback()
+
+@contextmanager
+def assert_max_queries(limit:int):
+    with track_queries() as stats:
+        yield stats
+    assert stats.statements<=limit,f"{stats.statements} statements, budget {limit}: {list(stats.by_statement)}"
+    assert not stats.repeated(),f"N+1 suspected: {stats.repeated()}"
+
+
+@pytest.fixture
+def max_queries():
+    return assert_max_queries
+
+@pytest.fixture
+def user_graph():
+    # пять пользователей, у каждого проект с задачей и refresh-токен
+    engine=create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    event.listen(engine,'before_cursor_execute',before_cursor_execute)
+    event.listen(engine,'after_cursor_execute',after_cursor_execute)
+    with Session(engine) as db:
+        for i in range(5):
+            user=User(username=f'user{i}',email=f'user{i}@example.com',hashed_password='x',role='user')
+            user.projects=[Project(title='p',tasks=[Task(title='t',assignee=user)])]
+            user.refresh_tokens=[RefreshTokenDB(token_digest=f'digest{i}',expires_at=datetime(2030,1,1))]
+            db.add(user)
+        db.commit()
+    yield engine
+    engine.dispose()
+
+@pytest.fixture
+def graph_session(user_graph):
+    with Session(user_graph) as session:
+        yield SyncBackedSession(session)
+
+@pytest.fixture
+def local_cache():
+    # общий L1-кэш процесса: сервисы создают EntityCache с ним по умолчанию
+    shared_local_cache.clear()
+    yield shared_local_cache
+    shared_local_cache.clear()
+
+@pytest.fixture
+def redis_conn():
+    return FakeRedis()
+
+@pytest.fixture
+def bit_redis():
+    return FakeBitRedis()
+
+@pytest.fixture
+def scripted_session():
+    return ScriptedSession
+
+@pytest.fixture
+def rows_session():
+    return RowsSession
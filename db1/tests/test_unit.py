@@ -1,8 +1,39 @@
 from jose import jwt
+import asyncio
+import json
 import pytest
-from db1.Security.security import Utils
-from db1.Tokens.tokens import create_access_token,create_refresh_token
+from types import SimpleNamespace
+import time
+from datetime import datetime
+from contextlib import nullcontext
+from fastapi import HTTPException
+from starlette.requests import Request
+from redis.exceptions import ConnectionError as RedisConnectionError
+from sqlalchemy import select,update,create_engine,event,text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from db1.Security.security import Utils,HashingPool,UserPolicy,TaskPolicy
+from db1.Tokens.tokens import create_access_token,create_refresh_token,get_current_user,rotate_refresh_token,issue_rotated_tokens,REFRESH_REPLAYS
 from config import settings
+from db1.Cache.cache import LocalCache,EntityCache,CACHE_EVICTIONS,pack_entry,unpack_entry,dependency_keys,invalidate_keys
+from db1.Cache.bloom import BloomFilter,user_filters,add_user_values,rebuild_user_filters
+from db1.Services.services import fetch_many,AuthService,UserService,TaskService
+from db1.Database.database import ReadRouter,LazySession,lazy_engine,read_router,QueryStats,query_stats,before_cursor_execute,after_cursor_execute,track_queries,backoff
+from db1.PydanticModels.Pydantic import Principal,CursorParams
+from db1.Pagination.pagination import encode_cursor,decode_cursor
+from db1.Filters.fields import USER_FIELDS,PROJECT_FIELDS
+from db1.Filters.filters import UserFilter
+from db1.Export.export import export_query,render_ndjson,render_csv
+from db1.Metrics.metrics import Registry
+from db1.Tracing.tracing import AdaptiveSampler
+from db1.Admission.admission import AdmissionLimiter,Overloaded,route_class
+from db1.RateLimit.ratelimit import HybridRateLimiter,client_identifier
+from db1.Maintenance import sweeper
+from db1.Stats.stats import task_deltas,summarize,reconcile_table
+from db1.Conditional.conditional import not_modified
+from db1.models.Base1 import User,Task,ProjectTaskStats,UserTaskStats
 
 
 
@@ -12,6 +43,30 @@ def test_password_hashing_and_verify():
 
     assert Utils.password_verify(password,hashed_password) is True
     assert Utils.password_verify('WrongPassword',hashed_password) is False
+def test_async_password_hashing_and_verify():
+    async def run():
+        hashed_password=await Utils.password_hash_async('12355678')
+        return await Utils.password_verify_async('12355678',hashed_password)
+    assert asyncio.run(run()) is True
+def test_hashing_pool_rejects_when_queue_is_full():
+    pool=HashingPool(workers=1,max_queue=0)
+    async def run():
+        slow=asyncio.create_task(pool.run('hash',time.sleep,0.2))
+        await asyncio.sleep(0)
+        with pytest.raises(HTTPException) as exc:
+            await pool.run('hash',time.sleep,0)
+        await slow
+        return exc.value
+    error=asyncio.run(run())
+    assert error.status_code==503
+    assert error.headers['Retry-After']=='1'
+def test_refresh_token_digest_is_keyed_and_stable(monkeypatch):
+    token=create_refresh_token(1,'user')
+    digest=Utils.token_digest(token)
+    assert digest==Utils.token_digest(token)
+    assert len(digest)==64
+    monkeypatch.setattr(settings,'REFRESH_TOKEN_HMAC_KEY','another_key')
+    assert Utils.token_digest(token)!=digest
 def test_create_access_token():
     user_id=1
     role='user'
@@ -31,4 +86,438 @@ def test_create_refresh_token():
     payload=jwt.decode(token,settings.SECRET_KEY,algorithms=[settings.ALGORITHM])
     assert payload['role'] == role
     assert payload['sub'] == str(user_id)
-    assert payload['type']=='refresh'
\ No newline at end of file
+    assert payload['type']=='refresh'
+def test_local_cache_evicts_least_recently_used_by_size():
+    cache=LocalCache(max_items=10,max_bytes=10,ttl=60)
+    evictions=CACHE_EVICTIONS.value('user')
+    cache.set('user:1','aaaa')
+    cache.set('user:2','bbbb')
+    assert cache.get('user:1')=='aaaa'
+    cache.set('user:3','cccc')
+    assert cache.get('user:2') is None
+    assert cache.get('user:1')=='aaaa'
+    assert cache.get('user:3')=='cccc'
+    assert CACHE_EVICTIONS.value('user')==evictions+1
+def test_local_cache_expires_entries():
+    cache=LocalCache(max_items=10,max_bytes=100,ttl=0)
+    cache.set('task:1','data')
+    assert cache.get('task:1') is None
+    assert len(cache)==0
+def test_get_current_user_trusts_claims_unless_revoked(monkeypatch,redis_conn):
+    monkeypatch.setattr(settings,'TRUST_TOKEN_CLAIMS',True)
+    token=create_access_token(7,'admin')
+    principal=asyncio.run(get_current_user(token=token,db=None,redis_conn=redis_conn))
+    assert principal.id==7
+    assert principal.role=='admin'
+    redis_conn.values.update({'principal:revoked:7':'1','principal:7':'{"id":7,"role":"user"}'})
+    principal=asyncio.run(get_current_user(token=token,db=None,redis_conn=redis_conn))
+    assert principal.role=='user'
+def test_cursor_round_trip_and_rejects_garbage():
+    cursor=encode_cursor(1024,'prev')
+    assert decode_cursor(cursor)==(1024,'prev')
+    with pytest.raises(HTTPException) as exc:
+        decode_cursor('not-a-cursor')
+    assert exc.value.status_code==400
+def test_field_selection_derives_schema_and_rejects_unknown_fields():
+    selection=USER_FIELDS.select('username','projects',USER_FIELDS.cheap)
+    assert selection.columns==('id','username')
+    assert set(selection.schema.model_fields)=={'id','username','projects'}
+    assert not selection.is_full
+    assert USER_FIELDS.select(None,None,USER_FIELDS.full).is_full
+    with pytest.raises(HTTPException) as exc:
+        USER_FIELDS.select('hashed_password',None,USER_FIELDS.cheap)
+    assert exc.value.status_code==400
+def test_user_filter_search_escapes_wildcards_and_orders_by_relevance():
+    user_filter=UserFilter(search='50%_off',search_mode='prefix')
+    query=user_filter.sort(user_filter.filter(select(User.id)))
+    compiled=query.compile()
+    assert '50\\%\\_off%' in compiled.params.values()
+    assert 'similarity' in str(compiled)
+def test_fetch_many_splits_forbidden_and_missing_ids(redis_conn,scripted_session):
+    redis_conn.values.update({'user:1':'{"id":1,"username":"a"}','user:2':'{"id":2,"username":"b"}'})
+    cache=EntityCache(redis_conn,'user',local=LocalCache(max_items=10,max_bytes=1000,ttl=60))
+    policy=UserPolicy(Principal(id=1,role='user'))
+    batch=asyncio.run(fetch_many(scripted_session([]),cache,USER_FIELDS,[1,2,3],policy.can_read))
+    assert batch['items']==['{"id":1,"username":"a"}']
+    assert batch['forbidden']==[2]
+    assert batch['not_found']==[3]
+def test_cache_misses_on_replica_sessions_load_from_primary(redis_conn,monkeypatch):
+    primary=SimpleNamespace(replica=None)
+    monkeypatch.setattr('db1.Cache.cache.async_factory',lambda:nullcontext(primary))
+    cache=EntityCache(redis_conn,'user',local=LocalCache(max_items=10,max_bytes=1000,ttl=60))
+    seen=[]
+    async def loader(db,user_id):
+        seen.append(db)
+        return '{"id":%d}'%user_id
+    asyncio.run(cache.get_or_load(1,loader,SimpleNamespace(replica=object())))
+    direct=SimpleNamespace(replica=None)
+    asyncio.run(cache.get_or_load(2,loader,direct))
+    assert seen==[primary,direct] and 'user:1' in redis_conn.values
+def test_entries_without_policy_fields_are_reloaded(redis_conn):
+    redis_conn.values.update({'project:4':pack_entry({'id':4},'{"id":4}'),'project:5':pack_entry({'id':5},'{"id":5}')})
+    cache=EntityCache(redis_conn,'project',local=LocalCache(max_items=10,max_bytes=1000,ttl=60),required=PROJECT_FIELDS.policy_fields)
+    async def loader(db,project_id):
+        return pack_entry({'id':project_id,'owner_id':1},'{"id":%d}'%project_id)
+    assert unpack_entry(asyncio.run(cache.get_or_load(4,loader,None)))[0]=={'id':4,'owner_id':1}
+    assert unpack_entry(redis_conn.values['project:4'])[0]['owner_id']==1
+    assert asyncio.run(cache.get_many([4,5])).keys()=={4} and asyncio.run(cache.get(5)) is None
+def test_entity_cache_coalesces_concurrent_misses(redis_conn):
+    cache=EntityCache(redis_conn,'task',local=LocalCache(max_items=10,max_bytes=1000,ttl=60))
+    calls=[]
+    async def loader(db,task_id):
+        calls.append(task_id)
+        await asyncio.sleep(0.01)
+        return '{"id":%d}'%task_id
+    async def run():
+        return await asyncio.gather(*[cache.get_or_load(5,loader,None) for _ in range(10)])
+    assert asyncio.run(run())==['{"id":5}']*10
+    assert calls==[5]
+    assert 'lock:task:5' not in redis_conn.values
+def test_entity_cache_serves_stale_value_and_refreshes_in_background(redis_conn):
+    cache=EntityCache(redis_conn,'task',local=LocalCache(max_items=10,max_bytes=1000,ttl=0),stale=30)
+    redis_conn.values['task:6']='{"id":6,"title":"old"}'
+    redis_conn.expires['task:6']=1000
+    async def loader(db,task_id):
+        return '{"id":6,"title":"new"}'
+    async def run():
+        value=await cache.get_or_load(6,loader,None)
+        await asyncio.sleep(0.05)
+        return value
+    assert asyncio.run(run())=='{"id":6,"title":"old"}'
+    assert redis_conn.values['task:6']=='{"id":6,"title":"new"}'
+def test_cache_entry_keeps_policy_fields_next_to_raw_payload():
+    entry=pack_entry({'id':3,'assignee_id':9},'{"id":3,"title":"t"}')
+    assert unpack_entry(entry)==({'id':3,'assignee_id':9},'{"id":3,"title":"t"}')
+    assert unpack_entry('{"id":3}')==({'id':3},'{"id":3}')
+def test_read_router_rotates_over_healthy_replicas_and_falls_back_to_primary():
+    router=ReadRouter(['postgresql+asyncpg://u:p@replica1/db','postgresql+asyncpg://u:p@replica2/db'],'round_robin')
+    first,second=router.replicas
+    assert [router.choose(),router.choose(),router.choose()]==[first,second,first]
+    router.mark_failed(first,'lag')
+    assert router.choose() is second
+    router.mark_failed(second,'down')
+    assert router.choose() is None
+    assert first.engine.url.query['prepared_statement_cache_size']==str(settings.DB_STATEMENT_CACHE_SIZE)
+def test_lazy_session_releases_connection_and_retries_failed_replica_on_primary(monkeypatch):
+    replica=ReadRouter(['postgresql+asyncpg://u:p@replica1/db'],'round_robin').replicas[0]
+    binds,closed=[],[]
+    async def execute(self,*args,**kwargs):
+        binds.append(self.sync_session.bind)
+        if self.sync_session.bind is replica.lazy_engine.sync_engine:
+            raise OperationalError('SELECT 1',{},ConnectionError('replica down'))
+        return 'rows'
+    async def close(self):
+        closed.append(self.sync_session.bind)
+    monkeypatch.setattr(AsyncSession,'execute',execute)
+    monkeypatch.setattr(AsyncSession,'close',close)
+    monkeypatch.setattr(read_router,'mark_failed',lambda failed,reason:setattr(failed,'healthy',False))
+    db=LazySession(bind=replica.lazy_engine)
+    db.replica=replica
+    assert asyncio.run(db.execute(select(User.id)))=='rows'
+    assert binds==[replica.lazy_engine.sync_engine,lazy_engine.sync_engine]
+    assert closed[-1] is lazy_engine.sync_engine and db.replica is None and not replica.healthy
+    assert lazy_engine.get_execution_options()['isolation_level']=='AUTOCOMMIT'
+def test_export_query_selects_columns_and_renders_rows():
+    selection=USER_FIELDS.select('username',None,USER_FIELDS.cheap)
+    sql=str(export_query(selection,UserFilter(username__ilike='ann')).compile())
+    assert 'users.id, users.username' in sql and 'ORDER BY users.id' in sql and 'JOIN' not in sql
+    rows=[(1,'ann',datetime(2024,1,2,3,4,5))]
+    assert render_ndjson(rows,('id','username','created_at'))==b'{"id":1,"username":"ann","created_at":"2024-01-02T03:04:05"}\n'
+    assert render_csv(rows,('id','username','created_at'))==b'1,ann,2024-01-02T03:04:05\r\n'
+def test_metrics_histogram_buckets_and_labelled_gauge_render():
+    registry=Registry()
+    latency=registry.histogram('latency_seconds','Latency',('route',),buckets=(0.1,1.0))
+    for value in (0.1,0.5,3.0):
+        latency.observe(value,'/users')
+    registry.gauge('pool_idle','Idle',('pool',),function=lambda:[(('primary',),4)])
+    rendered=registry.render()
+    assert 'latency_seconds_bucket{route="/users",le="0.1"} 1' in rendered
+    assert 'latency_seconds_bucket{route="/users",le="1.0"} 2' in rendered
+    assert 'latency_seconds_bucket{route="/users",le="+Inf"} 3' in rendered
+    assert 'pool_idle{pool="primary"} 4' in rendered
+def test_cursor_events_count_statements_of_current_request():
+    sync_engine=create_engine('sqlite://')
+    event.listen(sync_engine,'before_cursor_execute',before_cursor_execute)
+    event.listen(sync_engine,'after_cursor_execute',after_cursor_execute)
+    stats=QueryStats()
+    token=query_stats.set(stats)
+    try:
+        with sync_engine.connect() as conn:
+            conn.execute(text('SELECT 1'))
+            conn.execute(text('SELECT 2'))
+    finally:
+        query_stats.reset(token)
+    assert stats.statements==2 and stats.duration>0
+def test_full_user_graph_loads_within_query_budget_and_lazy_loads_are_flagged(user_graph,max_queries):
+    with Session(user_graph) as db,max_queries(5):
+        users=db.execute(select(User).options(*USER_FIELDS.full.options())).scalars().all()
+        [USER_FIELDS.cache_entry(user) for user in users]
+    with Session(user_graph) as db,track_queries() as stats:
+        [USER_FIELDS.cache_entry(user) for user in db.execute(select(User)).scalars().all()]
+    assert stats.repeated() and max(stats.repeated().values())==5
+def test_cached_user_reads_stay_within_query_budget(graph_session,max_queries,redis_conn,local_cache):
+    # /users/{id} и /users/batch: промах — один SELECT плюс selectin-загрузки связей, попадание — ни одного запроса
+    service=UserService(graph_session,redis_conn,UserPolicy(Principal(id=1,role='admin')))
+    with max_queries(5):
+        meta,payload=asyncio.run(service.get_by_id_raw(1))
+    assert meta['id']==1 and json.loads(payload)['refresh_tokens']
+    with max_queries(0):
+        asyncio.run(service.get_by_id_raw(1))
+    with max_queries(5):
+        batch=asyncio.run(service.get_many([1,2,3,4,5]))
+    assert len(batch['items'])==5 and not batch['not_found']
+    local_cache.clear()
+    with max_queries(0):
+        assert len(asyncio.run(service.get_many([1,2,3,4,5]))['items'])==5
+def test_adaptive_sampler_keeps_errors_and_slow_requests_within_budget(monkeypatch):
+    sampler=AdaptiveSampler(0.0,{'/metrics':0.0,'/users/{user_id}':1.0},slow_seconds=1.0,budget_per_second=2)
+    def head(name):
+        return sampler.traces_sampler({'transaction_context':{'name':name}})
+    # голова пишет всё, кроме статических маршрутов с частотой 0: ошибки иначе не дошли бы до before_send
+    assert (head('/metrics'),head('/users/5'),head('/tasks'))==(0.0,1.0,1.0)
+    def event(route,status='ok',duration=0.01):
+        return {'transaction':route,'contexts':{'trace':{'status':status}},'start_timestamp':100.0,'timestamp':100.0+duration}
+    assert sampler.before_send_transaction(event('/tasks'),{}) is None
+    assert sampler.before_send_transaction(event('/tasks',status='internal_error'),{}) is not None
+    assert sampler.before_send_transaction(event('/tasks',duration=2.5),{}) is not None
+    # частота ищется по шаблону маршрута; бюджет уже израсходован ошибкой и медленным запросом
+    assert sampler.before_send_transaction(event('/users/{user_id}'),{}) is None
+def test_admission_limiter_sheds_when_queue_is_full_and_routes_are_classified():
+    assert [route_class('POST','/users/login'),route_class('GET','/users/5'),route_class('GET','/tasks/export'),route_class('PUT','/users/5')]==['auth','read','export','write']
+    async def scenario():
+        limiter=AdmissionLimiter('test',concurrency=1,max_queue=1)
+        release=asyncio.Event()
+        async def hold():
+            async with limiter.admit(1.0):
+                await release.wait()
+        holder=asyncio.create_task(hold())
+        await asyncio.sleep(0)
+        queued=asyncio.create_task(hold())
+        await asyncio.sleep(0)
+        with pytest.raises(Overloaded) as full:
+            async with limiter.admit(1.0):
+                pass
+        release.set()
+        await asyncio.gather(holder,queued)
+        return full.value.reason,limiter.active,limiter.waiting
+    assert asyncio.run(scenario())==('queue_full',0,0)
+def test_lazy_session_retries_transient_errors_with_backoff(monkeypatch):
+    class Deadlock(Exception):
+        sqlstate='40P01'
+    calls,sleeps=[],[]
+    async def execute(self,*args,**kwargs):
+        calls.append(1)
+        if len(calls)<3:
+            raise OperationalError('UPDATE',{},Deadlock())
+        return 'rows'
+    async def close(self):
+        pass
+    async def sleep(delay):
+        sleeps.append(delay)
+    monkeypatch.setattr(AsyncSession,'execute',execute)
+    monkeypatch.setattr(AsyncSession,'close',close)
+    monkeypatch.setattr('db1.Database.database.asyncio.sleep',sleep)
+    assert asyncio.run(LazySession(bind=lazy_engine).execute(select(User.id)))=='rows'
+    assert len(calls)==3 and len(sleeps)==2
+    assert all(0<=backoff(attempt)<=settings.DB_RETRY_MAX_DELAY for attempt in range(1,10))
+def test_client_identifier_trusts_forwarded_for_only_behind_configured_proxies(monkeypatch):
+    def request(peer,forwarded=None):
+        headers=[(b'x-forwarded-for',forwarded.encode())] if forwarded else []
+        return Request({'type':'http','client':(peer,1234),'headers':headers})
+    monkeypatch.setattr(settings,'TRUSTED_PROXIES',['10.0.0.0/8'])
+    # прямой клиент подделывает заголовок — ключ всё равно его адрес
+    assert client_identifier(request('203.0.113.9','1.2.3.4'))=='203.0.113.9'
+    # за прокси берётся самый правый недоверенный хоп, а не подставленный клиентом первый
+    assert client_identifier(request('10.0.0.2','1.2.3.4, 198.51.100.7, 10.0.0.3'))=='198.51.100.7'
+    assert client_identifier(request('10.0.0.2'))=='10.0.0.2'
+def test_rate_limiter_counts_locally_syncs_in_batches_and_degrades_without_redis(monkeypatch,redis_conn):
+    monkeypatch.setattr(settings,'RATE_LIMIT_ERROR',0.5)
+    monkeypatch.setattr('db1.RateLimit.ratelimit.time.time',lambda:1000.0)
+    async def scenario():
+        limiter=HybridRateLimiter()
+        limiter.bind(redis_conn)
+        redis_conn.values['rl:login:ann:60:16']=3
+        results=[(await limiter.hit('login:ann',times=6,period=60))[0] for _ in range(4)]
+        synced=dict(redis_conn.values)
+        async def broken(*args,**kwargs):
+            raise RedisConnectionError('down')
+        redis_conn.incr=broken
+        strict=await limiter.hit('login:bob',times=1,period=60,strict=True)
+        return results,synced,strict,limiter.degraded,await limiter.hit('login:bob',times=1,period=60,strict=True)
+    results,synced,strict,degraded,second=asyncio.run(scenario())
+    assert results==[True,True,True,False]
+    assert synced['rl:login:ann:60:16']==6
+    assert strict==(True,0) and degraded and second[0] is False
+def test_token_sweeper_deletes_in_batches_until_short_batch_and_invalidates_users(monkeypatch,redis_conn):
+    batches=[[1,2,2],[3,4,5],[6]]
+    class Session:
+        async def __aenter__(self):
+            return self
+        async def __aexit__(self,*exc):
+            return False
+    async def purge(db,batch_size,now):
+        return batches.pop(0)
+    invalidated=[]
+    async def invalidate_many(self,ids):
+        invalidated.extend(ids)
+    async def sleep(delay):
+        pass
+    monkeypatch.setattr(sweeper,'purge_expired_tokens',purge)
+    monkeypatch.setattr(sweeper,'async_factory',Session)
+    monkeypatch.setattr(sweeper.asyncio,'sleep',sleep)
+    monkeypatch.setattr(EntityCache,'invalidate_many',invalidate_many)
+    monkeypatch.setattr(settings,'TOKEN_SWEEP_BATCH',3)
+    purged=sweeper.TOKENS_PURGED.value()
+    assert asyncio.run(sweeper.TokenSweeper(redis_conn).sweep())==7
+    assert batches==[] and invalidated==[1,2,2,3,4,5,6]
+    assert sweeper.TOKENS_PURGED.value()-purged==7
+def test_refresh_rotation_is_one_statement_and_replay_revokes_all_tokens(monkeypatch,redis_conn,scripted_session):
+    monkeypatch.setattr(settings,'REFRESH_TOKEN_LEGACY_FALLBACK',False)
+    rotated=scripted_session('admin')
+    redis_conn.values['user:7']='{"id":7}\n{"id":7,"refresh_tokens":[{"id":1}]}'
+    assert asyncio.run(rotate_refresh_token(rotated,redis_conn,'7','old','new'))=='admin'
+    assert len(rotated.statements)==1 and rotated.commits==1
+    # закэшированный UserOut со старым списком токенов снят
+    assert 'user:7' not in redis_conn.values and 'purged:user:7' in redis_conn.values
+    assert str(rotated.statements[0]).startswith('WITH retired AS')
+    replayed=scripted_session(None)
+    replays=REFRESH_REPLAYS.value()
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(rotate_refresh_token(replayed,redis_conn,7,'old','new'))
+    assert exc.value.status_code==401 and REFRESH_REPLAYS.value()-replays==1
+    assert str(replayed.statements[1]).startswith('DELETE FROM refresh_tokens WHERE refresh_tokens.user_id')
+    assert redis_conn.values['principal:revoked:7']==1
+    assert create_refresh_token(1,'user')!=create_refresh_token(1,'user')
+def test_rotated_refresh_token_carries_the_current_role(redis_conn,scripted_session,local_cache):
+    redis_conn.values['principal:7']='{"id":7,"role":"user"}'
+    db=scripted_session('user')
+    access,refresh=asyncio.run(issue_rotated_tokens(db,redis_conn,'7','old'))
+    assert jwt.decode(refresh,settings.SECRET_KEY,algorithms=[settings.ALGORITHM])['role']=='user' and len(db.statements)==1
+    # роль сменили между кэшем принципала и ротацией: токен перевыпускается с ролью из БД
+    db=scripted_session('admin')
+    access,refresh=asyncio.run(issue_rotated_tokens(db,redis_conn,7,'old'))
+    assert [jwt.decode(token,settings.SECRET_KEY,algorithms=[settings.ALGORITHM])['role'] for token in (access,refresh)]==['admin','admin']
+    assert str(db.statements[1]).startswith('UPDATE refresh_tokens SET token_digest')
+def test_bloom_filter_answers_free_without_db_and_rechecks_maybe_taken(bit_redis,scripted_session):
+    bloom=BloomFilter(bit_redis,'username',capacity=1000,error_rate=0.01)
+    # до сборки add не создаёт частичную карту, а без метки ready фильтр не отвечает
+    asyncio.run(bloom.add('ann'))
+    assert 'bloom:username' not in bit_redis.values
+    bit_redis.values['bloom:username']=set()
+    asyncio.run(bloom.add('ann','bob'))
+    assert asyncio.run(bloom.might_contain('ann')) is None
+    bit_redis.values['bloom:username:ready']=1
+    assert asyncio.run(bloom.might_contain('ann')) and asyncio.run(bloom.might_contain('bob'))
+    free=[name for name in (f'user{i}' for i in range(200)) if asyncio.run(bloom.might_contain(name)) is False]
+    assert len(free)>=190
+    del bit_redis.values['bloom:username']
+    assert asyncio.run(bloom.might_contain('ann')) is None
+    filters=user_filters(bit_redis)
+    bit_redis.values.update({filters['username'].key:set(),filters['username'].ready_key:1})
+    asyncio.run(filters['username'].add('ann'))
+    db=scripted_session(True)
+    answer=asyncio.run(AuthService(db,bit_redis).availability({'username':'free_name','email':None}))
+    assert answer=={'username':True} and db.statements==[]
+    answer=asyncio.run(AuthService(db,bit_redis).availability({'username':'ann','email':None}))
+    assert answer=={'username':False} and len(db.statements)==1
+def test_bloom_rebuild_runs_on_the_lease_holder_and_others_wait_for_ready(bit_redis,monkeypatch):
+    rebuilt=[]
+    async def rebuild(self,column):
+        rebuilt.append(self.key)
+        bit_redis.values.update({self.key:set(),self.ready_key:1})
+    async def sleep(delay):
+        pass
+    monkeypatch.setattr(BloomFilter,'rebuild',rebuild)
+    monkeypatch.setattr('db1.Cache.bloom.asyncio.sleep',sleep)
+    asyncio.run(rebuild_user_filters(bit_redis))
+    assert rebuilt==['bloom:username','bloom:email']
+    # другой воркер аренду не получает и при готовом фильтре ничего не стримит
+    bit_redis.values['lock:bloom-rebuild']='other-worker'
+    asyncio.run(rebuild_user_filters(bit_redis))
+    assert len(rebuilt)==2
+def test_bloom_add_failure_after_commit_is_logged_not_raised(bit_redis,caplog):
+    async def unavailable(*args):
+        raise RedisConnectionError("down")
+    bit_redis.eval=unavailable
+    asyncio.run(add_user_values(bit_redis,{'username':'ann','email':None}))
+    assert "Failed to add" in caplog.text
+
+def test_bulk_status_update_is_one_statement_with_array_parameter(redis_conn,rows_session):
+    ids=list(range(1,10001))
+    db=rows_session([SimpleNamespace(id=i,project_id=1,status='done',assignee_id=2,previous_status='pending',previous_assignee_id=2) for i in ids[:-1]])
+    redis_conn.values.update({'task:1':'x','project:1':'x','user:2':'x','task:10000':'x'})
+    service=TaskService(db,redis_conn,TaskPolicy(SimpleNamespace(id=1,role='admin')))
+    result=asyncio.run(service.update_status_many(ids,'done'))
+    assert result['not_found']==[10000] and len(result['ids'])==9999
+    # UPDATE плюс по одному upsert'у в project_task_stats и user_task_stats
+    assert len(db.statements)==3 and db.commits==1
+    compiled=db.statements[0].compile(dialect=postgresql.dialect())
+    assert '= ANY' in str(compiled) and 'version=(tasks.version +' in str(compiled)
+    assert [value for value in compiled.params.values() if isinstance(value,list)]==[ids]
+    assert {key for key in redis_conn.values if not key.startswith('purged:')}=={'task:10000'}
+    # отказ по правам — до UPDATE, строки не блокируются
+    denied=rows_session()
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(TaskService(denied,redis_conn,TaskPolicy(SimpleNamespace(id=1,role='user'))).update_status_many(ids,'done'))
+    assert exc.value.status_code==403 and denied.statements==[]
+def test_task_deltas_net_out_per_project_user_and_status():
+    deltas=task_deltas([(1,2,'pending',-1),(1,2,'done',1),(1,2,'pending',-1),(1,3,'done',1),(None,3,'done',1),(1,2,None,1)])
+    assert deltas[ProjectTaskStats]=={(1,'pending'):-2,(1,'done'):2}
+    assert deltas[UserTaskStats]=={(2,'pending'):-2,(2,'done'):1,(3,'done'):2}
+    assert summarize([(None,None)])=={'counts':{},'total':0}
+    assert summarize([('done',3),('pending',2),('archived',0)])=={'counts':{'done':3,'pending':2},'total':5}
+def test_reconcile_finds_drift_without_lock_and_repairs_only_drifted_keys(scripted_session):
+    clean=scripted_session([])
+    assert asyncio.run(reconcile_table(clean,ProjectTaskStats))==0 and len(clean.statements)==1 and clean.commits==1
+    # 3 разошёлся из-за транзакции в полёте и под блокировкой уже сходится; чинится только 5
+    db=scripted_session([3,5],None,[5])
+    assert asyncio.run(reconcile_table(db,ProjectTaskStats))==1 and db.commits==1
+    full_scan,lock,recheck,cleared,refilled=[str(statement.compile(dialect=postgresql.dialect())) for statement in db.statements]
+    assert 'LOCK TABLE project_task_stats' in lock and 'ANY' not in full_scan
+    assert all('= ANY' in sql for sql in (recheck,cleared,refilled))
+    assert [value for value in db.statements[3].compile(dialect=postgresql.dialect()).params.values()]==[[5]]
+def test_tagged_entries_are_purged_with_the_entities_they_embed(redis_conn):
+    user=pack_entry({'id':1},'{"id":1,"projects":[{"id":4,"tasks":[{"id":7}]}],"tasks":[{"id":7},{"id":8}]}')
+    assert dependency_keys(unpack_entry(user)[1])==['project:4','task:7','task:8']
+    local=LocalCache(max_items=10,max_bytes=10000,ttl=60)
+    users=EntityCache(redis_conn,'user',local=local)
+    asyncio.run(users.set(1,user))
+    asyncio.run(EntityCache(redis_conn,'project',local=local).set(4,pack_entry({'id':4,'owner_id':1},'{"id":4,"tasks":[{"id":7}]}')))
+    assert asyncio.run(invalidate_keys(redis_conn,['task:7'],local))==['task:7','project:4','user:1']
+    assert local.get('user:1') is None and 'user:1' not in redis_conn.values
+    # загрузка, начатая до инвалидации, не возвращает в кэш старую запись
+    asyncio.run(users.set(1,user))
+    assert 'user:1' not in redis_conn.values and local.get('user:1') is None
+def test_entry_etag_follows_nested_versions_and_answers_304():
+    now=datetime(2026,1,2,3,4,5)
+    def project(task_version):
+        task=SimpleNamespace(id=7,title='t',status='done',project_id=4,assignee_id=1,created_at=now,updated_at=now,version=task_version)
+        return SimpleNamespace(id=4,title='p',owner_id=1,created_at=now,updated_at=now,version=2,tasks=[task])
+    first=unpack_entry(PROJECT_FIELDS.cache_entry(project(1)))[0]
+    second=unpack_entry(PROJECT_FIELDS.cache_entry(project(2)))[0]
+    assert first['etag']!=second['etag'] and first['modified']=='Fri, 02 Jan 2026 03:04:05 GMT'
+    assert unpack_entry(PROJECT_FIELDS.cache_entry(project(1)))[0]['etag']==first['etag']
+    def request(**headers):
+        return Request({'type':'http','headers':[(name.replace('_','-').encode(),value.encode()) for name,value in headers.items()]})
+    assert not_modified(request(if_none_match=f'W/"x", {first["etag"]}'),first['etag'],first['modified'])
+    assert not not_modified(request(if_none_match=second['etag']),first['etag'],first['modified'])
+    assert not_modified(request(if_modified_since='Fri, 02 Jan 2026 03:04:05 GMT'),first['etag'],first['modified'])
+    assert not not_modified(request(if_modified_since='Fri, 02 Jan 2026 03:04:04 GMT'),first['etag'],first['modified'])
+    assert not not_modified(request(),first['etag'],first['modified'])
+def test_list_validators_come_from_the_returned_page(graph_session,max_queries):
+    def request(query:bytes):
+        return Request({'type':'http','scheme':'http','server':('test',80),'path':'/users/cursor','query_string':query,'headers':[]})
+    service=UserService(graph_session,None,UserPolicy(Principal(id=1,role='admin')))
+    def page(query=b'size=2&expand=tasks',cursor=None):
+        selection=USER_FIELDS.list_dependency()(fields='username',expand='tasks')
+        return asyncio.run(service.get_all_cursor(UserFilter(),CursorParams(size=2,cursor=cursor),request(query),selection))
+    # страница и её валидаторы — те же два запроса (users + selectin tasks), без агрегата по всей таблице
+    with max_queries(2):
+        first,(etag,last_modified)=page()
+    assert [item.username for item in first['items']]==['user0','user1'] and last_modified
+    assert page()[1][0]==etag and page(b'size=2')[1][0]!=etag
+    assert page(cursor=first['next_cursor'])[1][0]!=etag
+    # правка вложенной задачи со страницы меняет ETag, хотя сами users не менялись
+    graph_session.session.execute(update(Task).where(Task.id == 1).values(version=Task.version+1))
+    graph_session.session.commit()
+    assert page()[1][0]!=etag
@@ -1,63 +1,118 @@
 from __future__ import annotations
 import logging
+import json
+import os
 import uuid
 import time
+import asyncio
 import sentry_sdk
 import redis.asyncio as redis
 from contextlib import asynccontextmanager
+from typing import Optional
 from fastapi import FastAPI,Request,status,Depends,HTTPException
-from fastapi_limiter import FastAPILimiter
-from fastapi_limiter.depends import RateLimiter
 from fastapi_pagination import add_pagination, Page
-from db1.PydanticModels.Pydantic import UserOut,UserSimpleOut,CreateUser,TokenResponse,RefreshToken,UpdateUser
-from db1.Tokens.tokens import  create_access_token,create_refresh_token,save_refresh_token,delete_refresh_token,jwt,JWTError,get_current_user,validate_refresh_token
-from db1.Services.services import AuthService,UserService
-from db1.Security.security import UserPolicy,OAuth2PasswordRequestForm
-from db1.Database.database import engine,AsyncSession,get_db
-from db1.Filters.filters import UserFilter
-from db1.models.Base1 import User
-from db1.Database.database import retry, stop_after_attempt, wait_exponential, retry_if_exception_type,OperationalError
+from db1.PydanticModels.Pydantic import UserOut,UserSimpleOut,CreateUser,TokenResponse,RefreshToken,UpdateUser,Principal,CursorParams,CursorPage,BatchOut,ProjectOut,TaskOut,AvailabilityOut,TaskStatsOut,BulkCreateTasks,BulkCreateProjects,BulkTaskStatus,BulkTaskAssignee,BulkOut
+from db1.Tokens.tokens import  create_access_token,create_refresh_token,save_refresh_token,delete_refresh_token,jwt,JWTError,get_current_user,issue_rotated_tokens,require_admin,token_is_admin
+from db1.Services.services import AuthService,UserService,ProjectService,TaskService
+from db1.Cache.bloom import rebuild_user_filters
+from db1.Security.security import UserPolicy,ProjectPolicy,TaskPolicy,OAuth2PasswordRequestForm
+from db1.Database.database import engine,AsyncSession,get_db,get_lazy_db,get_read_db,read_router,QueryStats,track_queries
+from db1.Filters.filters import UserFilter,ProjectFilter,TaskFilter,batch_ids
+from db1.Filters.fields import USER_FIELDS,PROJECT_FIELDS,TASK_FIELDS,FieldSelection
+from db1.Export.export import ExportFormat,export_response
+from db1.Conditional.conditional import conditional_json_response,not_modified,not_modified_response,validator_headers
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy import select
-from db1.models.Base1 import Base
+from fastapi.responses import PlainTextResponse,Response,JSONResponse
+from sqlalchemy.orm.exc import StaleDataError
+from db1.Cache.cache import listen_invalidations,get_redis
+from db1.Metrics.metrics import REGISTRY
+from db1.Tracing.tracing import sampler,StackSampler
+from db1.Admission.admission import AdmissionMiddleware
+from db1.RateLimit.ratelimit import RateLimit,rate_limiter
+from db1.Maintenance.sweeper import TokenSweeper
+from db1.Stats.stats import TaskStatsReconciler
 from config import settings
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
+sql_logger = logging.getLogger('db1.sql')
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     app.state.redis = await redis.from_url("redis://localhost:6379",
         decode_responses=True)
-    await FastAPILimiter.init(app.state.redis)
+    rate_limiter.bind(app.state.redis)
+    rate_limit_sync=asyncio.create_task(rate_limiter.run())
+    invalidation_listener=asyncio.create_task(listen_invalidations(app.state.redis))
+    replica_monitor=asyncio.create_task(read_router.monitor()) if read_router.replicas else None
+    token_sweeper=asyncio.create_task(TokenSweeper(app.state.redis).run())
+    stats_reconciler=asyncio.create_task(TaskStatsReconciler(app.state.redis).run())
+    user_filters_build=asyncio.create_task(rebuild_user_filters(app.state.redis))
     yield
+    invalidation_listener.cancel()
+    rate_limit_sync.cancel()
+    token_sweeper.cancel()
+    stats_reconciler.cancel()
+    user_filters_build.cancel()
+    if replica_monitor:
+        replica_monitor.cancel()
+    await read_router.dispose()
+    await engine.dispose()
     await app.state.redis.close()
 
-async def get_redis(request: Request):
-    return request.app.state.redis
-
 
 sentry_sdk.init(
     dsn=settings.SENTRY_DSN,
-    traces_sample_rate=1.0,
-    profiles_sample_rate=1.0,
+    traces_sampler=sampler.traces_sampler,
+    before_send_transaction=sampler.before_send_transaction,
+    profiles_sample_rate=settings.SENTRY_PROFILES_SAMPLE_RATE,
 )
-app=FastAPI(lifespan=lifespan)
+app=FastAPI(lifespan=lifespan,dependencies=[Depends(RateLimit(settings.RATE_LIMIT_DEFAULT_TIMES,settings.RATE_LIMIT_DEFAULT_SECONDS))])
 origins = [
     "http://localhost:3000",
     "http://127.0.0.1:3000"
 ]
 
+# добавленный последним — внешний слой: CORS оборачивает admission, и отказы 503 тоже получают CORS-заголовки
+app.add_middleware(AdmissionMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag","Last-Modified"],
 )
 add_pagination(app)
 
+@app.exception_handler(StaleDataError)
+async def stale_data_handler(request:Request,exc:StaleDataError):
+    # version_id_col: строку успели изменить между SELECT и UPDATE
+    return JSONResponse(status_code=409,content={'detail':"Resource was modified concurrently"})
+
+
+HTTP_LATENCY=REGISTRY.histogram('http_request_duration_seconds','Request latency by route template and status',('method','route','status'))
+HTTP_IN_FLIGHT=REGISTRY.gauge('http_requests_in_flight','Requests currently being handled',('method',))
+DB_STATEMENTS=REGISTRY.histogram('db_statements_per_request','SQL statements executed per request',('route',),buckets=(0,1,2,3,5,8,13,21,34,55,89))
+DB_TIME=REGISTRY.histogram('db_time_per_request_seconds','Time spent in SQL statements per request',('route',))
+
+def route_template(request:Request):
+    # шаблон пути, а не сам путь: /users/{user_id} — одна серия, а не по серии на каждый id
+    route=request.scope.get('route')
+    return route.path if route is not None else 'unmatched'
+
+def log_queries(request_id:str,method:str,route:str,status_code:int,stats:QueryStats):
+    repeated=stats.repeated()
+    level=logging.WARNING if repeated else logging.DEBUG
+    if not sql_logger.isEnabledFor(level):
+        return
+    sql_logger.log(level,json.dumps({
+        'event':'n_plus_one_suspected' if repeated else 'request_queries',
+        'request_id':request_id,'method':method,'route':route,'status':status_code,
+        'statements':stats.statements,'rows':stats.rows,'db_ms':round(stats.duration*1000,2),
+        'repeated':[{'count':count,'sql':statement[:200]} for statement,count in repeated.items()],
+    }))
 
 @app.middleware("http")
 async def add_process_time_header(request: Request, call_next):
@@ -65,24 +120,53 @@ async def add_process_time_header(request: Request, call_next):
     sentry_sdk.set_tag("request_id", request_id)
     request.state.request_id = request_id
 
-    start_time = time.time()
-
-    response = await call_next(request)
+    profiler=None
+    if 'x-profile' in request.headers and await token_is_admin(request.app.state.redis,request.headers.get('authorization')):
+        profiler=StackSampler(settings.PROFILE_INTERVAL)
+        if not profiler.start():
+            profiler=None
+
+    HTTP_IN_FLIGHT.inc(request.method)
+    start_time = time.perf_counter()
+    status_code=500
+    with track_queries() as stats:
+        try:
+            response = await call_next(request)
+            status_code=response.status_code
+        finally:
+            process_time = time.perf_counter() - start_time
+            HTTP_IN_FLIGHT.dec(request.method)
+            route=route_template(request)
+            HTTP_LATENCY.observe(process_time,request.method,route,status_code)
+            DB_STATEMENTS.observe(stats.statements,route)
+            DB_TIME.observe(stats.duration,route)
+            log_queries(request_id,request.method,route,status_code,stats)
+            if profiler is not None:
+                await asyncio.to_thread(profiler.stop)
 
-    process_time = time.time() - start_time
     response.headers["X-Request-ID"] = request_id
     response.headers["X-Process-Time"] = f"{process_time:.4f}"
+    if settings.SQL_DEBUG_HEADER:
+        response.headers["X-DB-Queries"] = stats.header()
+    if profiler is not None:
+        response.headers["X-Profile-File"] = os.path.basename(await asyncio.to_thread(profiler.write,request_id))
 
     return response
 
-@retry(
-    stop=stop_after_attempt(3),
-    wait=wait_exponential(1, min=1, max=4),
-    retry=retry_if_exception_type(OperationalError)
-)
+def raw_json_response(content:str):
+    # тело уже сериализовано при записи в кэш — отдаём его как есть, без повторной валидации response_model
+    return Response(content=content,media_type='application/json')
+
+def raw_batch_response(batch:dict):
+    return raw_json_response('{"items":['+','.join(batch['items'])+'],"not_found":'+json.dumps(batch['not_found'])+',"forbidden":'+json.dumps(batch['forbidden'])+'}')
+
+@app.get('/metrics',response_class=PlainTextResponse)
+async def metrics():
+    return REGISTRY.render()
+
 @app.post('/users/register', response_model=UserSimpleOut, status_code=status.HTTP_201_CREATED)
-async def register(user: CreateUser, db: AsyncSession = Depends(get_db)):
-    auth = AuthService(db)
+async def register(user: CreateUser, db: AsyncSession = Depends(get_db), redis_conn=Depends(get_redis)):
+    auth = AuthService(db, redis_conn)
     new_user_obj = await auth.register_user(
         username=user.username,
         password=user.password,
@@ -91,28 +175,18 @@ async def register(user: CreateUser, db: AsyncSession = Depends(get_db)):
     return new_user_obj
 
 
-@retry(
-    stop=stop_after_attempt(3),
-    wait=wait_exponential(1, min=1, max=4),
-    retry=retry_if_exception_type(OperationalError)
-)
-@app.post('/users/login',response_model=TokenResponse,dependencies=[Depends(RateLimiter(times=6,minutes=60))])
-async def login(form_data:OAuth2PasswordRequestForm=Depends(),db:AsyncSession=Depends(get_db)):
+@app.post('/users/login',response_model=TokenResponse,dependencies=[Depends(RateLimit(times=6,seconds=3600,strict=True))])
+async def login(form_data:OAuth2PasswordRequestForm=Depends(),db:AsyncSession=Depends(get_db),redis_conn=Depends(get_redis)):
     auth=AuthService(db)
     user=await auth.login_user(username=form_data.username,password=form_data.password)
     access_token=create_access_token(user_id=user.id,role=user.role)
     refresh_token=create_refresh_token(user_id=user.id,role=user.role)
-    await save_refresh_token(db,user_id=user.id,refresh_token=refresh_token)
+    await save_refresh_token(db,redis_conn,user_id=user.id,refresh_token=refresh_token)
     return TokenResponse(access_token=access_token,refresh_token=refresh_token,token_type="Bearer")
 
 
-@retry(
-    stop=stop_after_attempt(3),
-    wait=wait_exponential(1, min=1, max=4),
-    retry=retry_if_exception_type(OperationalError)
-)
 @app.post('/users/refresh',response_model=TokenResponse)
-async def refresh(data:RefreshToken,db:AsyncSession=Depends(get_db)):
+async def refresh(data:RefreshToken,db:AsyncSession=Depends(get_db),redis_conn=Depends(get_redis)):
     try:
         payload=jwt.decode(data.refresh_token,settings.SECRET_KEY,algorithms=[settings.ALGORITHM])
         user_id=payload['sub']
@@ -120,26 +194,14 @@ async def refresh(data:RefreshToken,db:AsyncSession=Depends(get_db)):
             raise HTTPException(status_code=400,detail="Invalid token")
         if payload['type'] != 'refresh':
             raise HTTPException(status_code=400,detail="Invalid token")
-    except JWTError:
+        user_id=int(user_id)
+    except (JWTError,KeyError,ValueError):
         raise HTTPException(status_code=400,detail="Invalid token")
-    result=await db.execute(select(User).where(User.id == user_id))
-    user=result.scalars().first()
-    if not user:
-        raise HTTPException(status_code=404,detail="User not found")
-    await validate_refresh_token(db,user_id=user.id,refresh_token=data.refresh_token)
-    await delete_refresh_token(db,user_id=user.id,refresh_token=data.refresh_token)
-    new_access=create_access_token(user_id=user.id,role=user.role)
-    new_refresh=create_refresh_token(user_id=user.id,role=user.role)
-    await save_refresh_token(db,user_id=user.id,refresh_token=new_refresh)
+    new_access,new_refresh=await issue_rotated_tokens(db,redis_conn,user_id=user_id,refresh_token=data.refresh_token)
     return TokenResponse(access_token=new_access,refresh_token=new_refresh,token_type="Bearer")
 
-@retry(
-    stop=stop_after_attempt(3),
-    wait=wait_exponential(1, min=1, max=4),
-    retry=retry_if_exception_type(OperationalError)
-)
 @app.post('/users/logout')
-async def logout(data:RefreshToken,db:AsyncSession=Depends(get_db)):
+async def logout(data:RefreshToken,db:AsyncSession=Depends(get_db),redis_conn=Depends(get_redis)):
     try:
         payload=jwt.decode(data.refresh_token,settings.SECRET_KEY,algorithms=[settings.ALGORITHM])
         user_id=payload['sub']
@@ -147,53 +209,112 @@ async def logout(data:RefreshToken,db:AsyncSession=Depends(get_db)):
             raise HTTPException(status_code=400,detail="Invalid token")
     except JWTError:
         raise HTTPException(status_code=400,detail="Invalid token")
-    await delete_refresh_token(db,user_id=user_id,refresh_token=data.refresh_token)
+    await delete_refresh_token(db,redis_conn,user_id=user_id,refresh_token=data.refresh_token)
     await db.commit()
     return {'message':'Success'}
 
-@retry(
-    stop=stop_after_attempt(3),
-    wait=wait_exponential(1, min=1, max=4),
-    retry=retry_if_exception_type(OperationalError)
-)
-@app.get('/users',response_model=Page[UserOut])
-async def read_users(db:AsyncSession=Depends(get_db),redis_conn=Depends(get_redis),user_filter:UserFilter=Depends(),current_user:User=Depends(get_current_user)):
+@app.get('/users',response_model=Page[USER_FIELDS.partial],response_model_exclude_unset=True)
+async def read_users(request:Request,response:Response,db:AsyncSession=Depends(get_read_db),redis_conn=Depends(get_redis),user_filter:UserFilter=Depends(),selection:FieldSelection=Depends(USER_FIELDS.list_dependency()),current_user:Principal=Depends(get_current_user)):
     policy=UserPolicy(current_user)
     service=UserService(db,redis_conn,policy)
-    user=await service.get_all(user_filter)
+    user,(etag,last_modified)=await service.get_all(user_filter,request,selection)
+    if not_modified(request,etag,last_modified):
+        return not_modified_response(etag,last_modified)
+    response.headers.update(validator_headers(etag,last_modified))
     return user
 
-@retry(
-    stop=stop_after_attempt(3),
-    wait=wait_exponential(1, min=1, max=4),
-    retry=retry_if_exception_type(OperationalError)
-)
-@app.get('/users/{user_id}',response_model=UserOut)
-async def get_user(user_id:int,db:AsyncSession=Depends(get_db),redis_conn=Depends(get_redis),current_user:User=Depends(get_current_user)):
+@app.get('/users/cursor',response_model=CursorPage[USER_FIELDS.partial],response_model_exclude_unset=True)
+async def read_users_cursor(request:Request,response:Response,db:AsyncSession=Depends(get_read_db),redis_conn=Depends(get_redis),user_filter:UserFilter=Depends(),params:CursorParams=Depends(),selection:FieldSelection=Depends(USER_FIELDS.list_dependency()),current_user:Principal=Depends(get_current_user)):
     policy=UserPolicy(current_user)
     service=UserService(db,redis_conn,policy)
-    new_user=await service.get_by_id(user_id)
+    page,(etag,last_modified)=await service.get_all_cursor(user_filter,params,request,selection)
+    if not_modified(request,etag,last_modified):
+        return not_modified_response(etag,last_modified)
+    response.headers.update(validator_headers(etag,last_modified))
+    return page
+
+@app.get('/users/export',dependencies=[Depends(require_admin)])
+async def export_users(user_filter:UserFilter=Depends(),format:ExportFormat='ndjson',selection:FieldSelection=Depends(USER_FIELDS.export_dependency())):
+    return export_response(selection,user_filter,format,'users')
+
+@app.get('/projects/export',dependencies=[Depends(require_admin)])
+async def export_projects(project_filter:ProjectFilter=Depends(),format:ExportFormat='ndjson',selection:FieldSelection=Depends(PROJECT_FIELDS.export_dependency())):
+    return export_response(selection,project_filter,format,'projects')
+
+@app.get('/tasks/export',dependencies=[Depends(require_admin)])
+async def export_tasks(task_filter:TaskFilter=Depends(),format:ExportFormat='ndjson',selection:FieldSelection=Depends(TASK_FIELDS.export_dependency())):
+    return export_response(selection,task_filter,format,'tasks')
+
+@app.get('/users/availability',response_model=AvailabilityOut,response_model_exclude_none=True)
+async def users_availability(username:Optional[str]=None,email:Optional[str]=None,db:AsyncSession=Depends(get_lazy_db),redis_conn=Depends(get_redis)):
+    if username is None and email is None:
+        raise HTTPException(status_code=400,detail="Pass username and/or email")
+    return await AuthService(db,redis_conn).availability({'username':username,'email':email})
+
+@app.get('/users/batch',response_model=BatchOut[UserOut])
+async def get_users_batch(ids:list[int]=Depends(batch_ids),db:AsyncSession=Depends(get_read_db),redis_conn=Depends(get_redis),current_user:Principal=Depends(get_current_user)):
+    service=UserService(db,redis_conn,UserPolicy(current_user))
+    return raw_batch_response(await service.get_many(ids))
+
+@app.get('/projects/batch',response_model=BatchOut[ProjectOut])
+async def get_projects_batch(ids:list[int]=Depends(batch_ids),db:AsyncSession=Depends(get_read_db),redis_conn=Depends(get_redis),current_user:Principal=Depends(get_current_user)):
+    service=ProjectService(db,redis_conn,ProjectPolicy(current_user))
+    return raw_batch_response(await service.get_many(ids))
+
+@app.get('/tasks/batch',response_model=BatchOut[TaskOut])
+async def get_tasks_batch(ids:list[int]=Depends(batch_ids),db:AsyncSession=Depends(get_read_db),redis_conn=Depends(get_redis),current_user:Principal=Depends(get_current_user)):
+    service=TaskService(db,redis_conn,TaskPolicy(current_user))
+    return raw_batch_response(await service.get_many(ids))
+
+@app.get('/users/{user_id}/task-stats',response_model=TaskStatsOut)
+async def get_user_task_stats(user_id:int,db:AsyncSession=Depends(get_read_db),redis_conn=Depends(get_redis),current_user:Principal=Depends(get_current_user)):
+    service=UserService(db,redis_conn,UserPolicy(current_user))
+    return await service.task_stats(user_id)
+
+@app.get('/projects/{project_id}/task-stats',response_model=TaskStatsOut)
+async def get_project_task_stats(project_id:int,db:AsyncSession=Depends(get_read_db),redis_conn=Depends(get_redis),current_user:Principal=Depends(get_current_user)):
+    service=ProjectService(db,redis_conn,ProjectPolicy(current_user))
+    return await service.task_stats(project_id)
+
+@app.post('/projects/bulk',response_model=BulkOut,status_code=status.HTTP_201_CREATED)
+async def create_projects_bulk(data:BulkCreateProjects,db:AsyncSession=Depends(get_db),redis_conn=Depends(get_redis),current_user:Principal=Depends(get_current_user)):
+    service=ProjectService(db,redis_conn,ProjectPolicy(current_user))
+    return await service.create_many(data.items)
+
+@app.post('/tasks/bulk',response_model=BulkOut,status_code=status.HTTP_201_CREATED)
+async def create_tasks_bulk(data:BulkCreateTasks,db:AsyncSession=Depends(get_db),redis_conn=Depends(get_redis),current_user:Principal=Depends(get_current_user)):
+    service=TaskService(db,redis_conn,TaskPolicy(current_user))
+    return await service.create_many(data.items)
+
+@app.patch('/tasks/bulk/status',response_model=BulkOut)
+async def update_tasks_status_bulk(data:BulkTaskStatus,db:AsyncSession=Depends(get_db),redis_conn=Depends(get_redis),current_user:Principal=Depends(get_current_user)):
+    service=TaskService(db,redis_conn,TaskPolicy(current_user))
+    return await service.update_status_many(data.ids,data.status)
+
+@app.patch('/tasks/bulk/assignee',response_model=BulkOut)
+async def reassign_tasks_bulk(data:BulkTaskAssignee,db:AsyncSession=Depends(get_db),redis_conn=Depends(get_redis),current_user:Principal=Depends(get_current_user)):
+    service=TaskService(db,redis_conn,TaskPolicy(current_user))
+    return await service.reassign_many(data.ids,data.assignee_id)
+
+@app.get('/users/{user_id}',response_model=USER_FIELDS.partial,response_model_exclude_unset=True)
+async def get_user(user_id:int,request:Request,db:AsyncSession=Depends(get_read_db),redis_conn=Depends(get_redis),selection:FieldSelection=Depends(USER_FIELDS.detail_dependency()),current_user:Principal=Depends(get_current_user)):
+    policy=UserPolicy(current_user)
+    service=UserService(db,redis_conn,policy)
+    if selection.is_full:
+        meta,payload=await service.get_by_id_raw(user_id)
+        return conditional_json_response(request,payload,meta.get('etag'),meta.get('modified'))
+    new_user=await service.get_by_id(user_id,selection)
     return new_user
 
-@retry(
-    stop=stop_after_attempt(3),
-    wait=wait_exponential(1, min=1, max=4),
-    retry=retry_if_exception_type(OperationalError)
-)
 @app.put('/users/{user_id}',response_model=UserOut)
-async def update_user(user_id:int,update_user1:UpdateUser,redis_conn=Depends(get_redis),db:AsyncSession=Depends(get_db),current_user:User=Depends(get_current_user)):
+async def update_user(user_id:int,update_user1:UpdateUser,redis_conn=Depends(get_redis),db:AsyncSession=Depends(get_db),current_user:Principal=Depends(get_current_user)):
     policy=UserPolicy(current_user)
     service=UserService(db,redis_conn,policy)
     put_user=await service.update(user_id,update_user1)
     return put_user
 
-@retry(
-    stop=stop_after_attempt(3),
-    wait=wait_exponential(1, min=1, max=4),
-    retry=retry_if_exception_type(OperationalError)
-)
 @app.delete('/users/{user_id}',response_model=UserOut)
-async def delete_user(user_id:int,db:AsyncSession=Depends(get_db),redis_conn=Depends(get_redis),current_user:User=Depends(get_current_user)):
+async def delete_user(user_id:int,db:AsyncSession=Depends(get_db),redis_conn=Depends(get_redis),current_user:Principal=Depends(get_current_user)):
     policy=UserPolicy(current_user)
     service=UserService(db,redis_conn,policy)
     delete_user1=await service.delete(user_id)
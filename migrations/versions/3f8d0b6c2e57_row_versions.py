@@ -0,0 +1,35 @@
+"""row versions
+
+Revision ID: 3f8d0b6c2e57
+Revises: 9c2f4e6a1b83
+Create Date: 2026-10-18 19:12:48.220731
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3f8d0b6c2e57'
+down_revision: Union[str, Sequence[str], None] = '9c2f4e6a1b83'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+TABLES = ('users', 'projects', 'tasks')
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # a constant and a stable expression as DEFAULT let PostgreSQL 11+ add the columns without rewriting the tables
+    for table in TABLES:
+        op.add_column(table, sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+        op.add_column(table, sa.Column('updated_at', sa.DateTime(), server_default=sa.text("timezone('utc', now())"), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    for table in TABLES:
+        op.drop_column(table, 'updated_at')
+        op.drop_column(table, 'version')
@@ -0,0 +1,28 @@
+"""keyset pagination indexes
+
+Revision ID: 4c1d7b2e9a60
+Revises: 58f6e68bf395
+Create Date: 2026-10-18 11:02:13.640127
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '4c1d7b2e9a60'
+down_revision: Union[str, Sequence[str], None] = '58f6e68bf395'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_index('idx_owner_id_id', 'projects', ['owner_id', 'id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('idx_owner_id_id', table_name='projects')
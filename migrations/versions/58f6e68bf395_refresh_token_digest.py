@@ -0,0 +1,39 @@
+"""refresh token digest
+
+Revision ID: 58f6e68bf395
+Revises: 83b4031e8ef7
+Create Date: 2026-10-18 10:20:41.318204
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '58f6e68bf395'
+down_revision: Union[str, Sequence[str], None] = '83b4031e8ef7'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('refresh_tokens', sa.Column('token_digest', sa.String(length=64), nullable=True))
+    op.create_index('ix_refresh_tokens_token_digest', 'refresh_tokens', ['token_digest'], unique=True)
+    # existing rows keep their argon2 hash in `token` and are moved to a digest on first use
+    op.alter_column('refresh_tokens', 'token', existing_type=sa.String(), nullable=True)
+    op.drop_constraint('refresh_tokens_user_id_key', 'refresh_tokens', type_='unique')
+    op.create_index('ix_refresh_tokens_user_id', 'refresh_tokens', ['user_id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_refresh_tokens_user_id', table_name='refresh_tokens')
+    # digest-only rows cannot be turned back into argon2 hashes; they are dropped and those sessions must log in again
+    op.execute("DELETE FROM refresh_tokens WHERE token IS NULL")
+    op.create_unique_constraint('refresh_tokens_user_id_key', 'refresh_tokens', ['user_id'])
+    op.alter_column('refresh_tokens', 'token', existing_type=sa.String(), nullable=False)
+    op.drop_index('ix_refresh_tokens_token_digest', table_name='refresh_tokens')
+    op.drop_column('refresh_tokens', 'token_digest')
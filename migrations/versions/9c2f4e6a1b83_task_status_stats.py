@@ -0,0 +1,49 @@
+"""task status stats
+
+Revision ID: 9c2f4e6a1b83
+Revises: e5a91c3f7b42
+Create Date: 2026-10-18 17:40:12.905113
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9c2f4e6a1b83'
+down_revision: Union[str, Sequence[str], None] = 'e5a91c3f7b42'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('project_task_stats',
+    sa.Column('project_id', sa.Integer(), nullable=False),
+    sa.Column('status', sa.String(length=50), nullable=False),
+    sa.Column('count', sa.BigInteger(), nullable=False),
+    sa.ForeignKeyConstraint(['project_id'], ['projects.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('project_id', 'status')
+    )
+    op.create_table('user_task_stats',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('status', sa.String(length=50), nullable=False),
+    sa.Column('count', sa.BigInteger(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('user_id', 'status')
+    )
+    # initial backfill; afterwards the services maintain the counters and TaskStatsReconciler repairs drift
+    op.execute("INSERT INTO project_task_stats (project_id, status, count) "
+               "SELECT project_id, status, count(*) FROM tasks "
+               "WHERE project_id IS NOT NULL AND status IS NOT NULL GROUP BY project_id, status")
+    op.execute("INSERT INTO user_task_stats (user_id, status, count) "
+               "SELECT assignee_id, status, count(*) FROM tasks "
+               "WHERE assignee_id IS NOT NULL AND status IS NOT NULL GROUP BY assignee_id, status")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('user_task_stats')
+    op.drop_table('project_task_stats')
@@ -0,0 +1,43 @@
+"""trigram search indexes
+
+Revision ID: b7e3f09a1d25
+Revises: 4c1d7b2e9a60
+Create Date: 2026-10-18 11:41:52.207719
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b7e3f09a1d25'
+down_revision: Union[str, Sequence[str], None] = '4c1d7b2e9a60'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+TRIGRAM_INDEXES = [
+    ('idx_username_trgm', 'users', 'username'),
+    ('idx_email_trgm', 'users', 'email'),
+    ('idx_project_title_trgm', 'projects', 'title'),
+    ('idx_task_title_trgm', 'tasks', 'title'),
+]
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    # built concurrently so large tables stay writable while the index is created
+    with op.get_context().autocommit_block():
+        for name, table, column in TRIGRAM_INDEXES:
+            op.create_index(name, table, [column], unique=False, postgresql_using='gin',
+                            postgresql_ops={column: 'gin_trgm_ops'}, postgresql_concurrently=True,
+                            if_not_exists=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        for name, table, _ in TRIGRAM_INDEXES:
+            op.drop_index(name, table_name=table, postgresql_concurrently=True, if_exists=True)
@@ -0,0 +1,33 @@
+"""refresh token expires_at index
+
+Revision ID: e5a91c3f7b42
+Revises: b7e3f09a1d25
+Create Date: 2026-10-18 15:02:37.418265
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e5a91c3f7b42'
+down_revision: Union[str, Sequence[str], None] = 'b7e3f09a1d25'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # the sweeper looks up expired rows by expires_at; built concurrently so logins keep inserting tokens meanwhile
+    with op.get_context().autocommit_block():
+        op.create_index(op.f('ix_refresh_tokens_expires_at'), 'refresh_tokens', ['expires_at'], unique=False,
+                        postgresql_concurrently=True, if_not_exists=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.drop_index(op.f('ix_refresh_tokens_expires_at'), table_name='refresh_tokens',
+                      postgresql_concurrently=True, if_exists=True)